@@ -30,46 +30,86 @@
 
 # Author: David Alexander, Jim Drake
 
-import cProfile, logging, os.path, sys
+import cProfile, logging, numpy as np, os.path, time
 from multiprocessing import Process
 from threading import Thread
-from collections import OrderedDict, defaultdict
+from collections import defaultdict, deque
 from .options import options
-from GenomicConsensus import reference, consensus, utils, windows
+from GenomicConsensus import reference, consensus
+from .checkpoint import CheckpointJournal, runFingerprint
+from .resultShards import ShardedResult, closeShards
+from .Worker import WorkerHandoff
+from .faults import ChunkFailure, writeFailureSummary
+from .progress import ProgressTracker, ProgressReporter
+from .instrumentation import RunStats, writeRunReport
+from .profiling import sampledStacks
+from .tracing import startTracing, stopTracing, tracing, traceSpan, traceCounter
 from .io.VariantsGffWriter import VariantsGffWriter
-from pbcore.io import FastaWriter, FastqWriter
+from .io.StreamingFastxWriters import StreamingFastaWriter, StreamingFastqWriter
 
 class ResultCollector(object):
     """
     Gathers results and writes to a file.
     """
-    def __init__(self, resultsQueue, algorithmName, algorithmConfig):
+    def __init__(self, resultsQueue, algorithmName, algorithmConfig,
+                 activity=None):
         self._resultsQueue = resultsQueue
         self._algorithmName = algorithmName
         self._algorithmConfig = algorithmConfig
+        self._activity = activity
 
     def _run(self):
+        if options.traceFile:
+            startTracing(options.traceDirectory, self.name)
         self.onStart()
 
         sentinelsReceived = 0
         while sentinelsReceived < options.numWorkers:
+            startTime = time.time()
             result = self._resultsQueue.get()
+            traceSpan("waitForResult", "queue", startTime, time.time())
             if result is None:
                 sentinelsReceived += 1
+            elif isinstance(result, RunStats):
+                # A worker's stage timings, sent as it finishes
+                self.runStats.merge(result)
+            elif isinstance(result, ChunkFailure):
+                # A worker redoing the unit of a hung one reports
+                # again the failures met before the hang
+                if (result.window, result.attempt) not in self.failuresSeen:
+                    self.failuresSeen.add((result.window, result.attempt))
+                    self.failures.append(result)
+            elif isinstance(result, WorkerHandoff):
+                # A worker retired early; its replacement will send
+                # the sentinel
+                logging.debug("%s handed off after %d chunks (%.0f MB resident)" %
+                              (result.workerName, result.chunksProcessed,
+                               result.residentMegabytes))
+                self.runStats.count("workersRecycled")
+            elif isinstance(result, list):
+                # Batched results
+                for result_ in result:
+                    self.onResult(result_)
             else:
                 self.onResult(result)
 
         self.onFinish()
+        stopTracing()
 
     def run(self):
-        if options.doProfiling:
-            cProfile.runctx("self._run()",
-                            globals=globals(),
-                            locals=locals(),
-                            filename=os.path.join(options.temporaryDirectory,
-                                                  "profile-%s.out" % (self.name)))
-        else:
-            self._run()
+        samplesFilename = None
+        if options.sampleProfile:
+            samplesFilename = os.path.join(options.temporaryDirectory,
+                                           "samples-%s.folded" % self.name)
+        with sampledStacks(samplesFilename, options.sampleInterval / 1000.):
+            if options.doProfiling:
+                cProfile.runctx("self._run()",
+                                globals=globals(),
+                                locals=locals(),
+                                filename=os.path.join(options.temporaryDirectory,
+                                                      "profile-%s.out" % (self.name)))
+            else:
+                self._run()
 
 
     # ==================================
@@ -77,85 +117,188 @@ class ResultCollector(object):
     #
 
     def onStart(self):
-        self.referenceBasesProcessedById = OrderedDict()
-        for refId in reference.byName:
-            self.referenceBasesProcessedById[refId] = 0
-        self.variantsByRefId             = defaultdict(list)
-        self.consensusChunksByRefId      = defaultdict(list)
+        self.startTime = time.time()
+        self.runStats  = RunStats()
+        self.failures  = []
+        self.failuresSeen = set()   # (window, attempt)
+
+        # Reorder buffer.  Output is written in reference order, as
+        # soon as a contiguous prefix of the current contig is
+        # complete; only the chunks that arrive ahead of that prefix
+        # are held, keyed by their start.
+        self.pendingChunksByRefId = defaultdict(dict)
+        self.contigsToWrite       = deque(reference.enumerateIds(options.referenceWindows))
+        self.spansToWrite         = None   # remaining spans of contigsToWrite[0]
+        self.cursor               = None   # output position in spansToWrite[0]
+        self.numPendingChunks     = 0
+        self.maxPendingChunks     = 0
+
+        # progress of the run, for --progressFile/--prometheusFile
+        self.progress = ProgressTracker(
+            [ (refId, reference.numReferenceBases(refId, options.referenceWindows))
+              for refId in self.contigsToWrite ],
+            self._activity, self._resultsQueue)
+        self.progressReporter = None
+        if options.progressFile or options.prometheusFile:
+            self.progressReporter = ProgressReporter(self.progress,
+                                                     options.progressFile,
+                                                     options.prometheusFile,
+                                                     options.progressInterval,
+                                                     reference.idToName)
 
         # open file writers
         self.fastaWriter = self.fastqWriter = self.gffWriter = None
         if options.fastaOutputFilename:
-            self.fastaWriter = FastaWriter(options.fastaOutputFilename)
+            self.fastaWriter = StreamingFastaWriter(options.fastaOutputFilename)
         if options.fastqOutputFilename:
-            self.fastqWriter = FastqWriter(options.fastqOutputFilename)
+            self.fastqWriter = StreamingFastqWriter(options.fastqOutputFilename)
         if options.gffOutputFilename:
             self.gffWriter = VariantsGffWriter(options.gffOutputFilename,
                                                vars(options),
                                                reference.byName.values())
 
+        # replay the windows completed by a previous run, if any, and
+        # journal the new ones
+        self.journal = None
+        if options.checkpointDir:
+            self.journal = CheckpointJournal(options.checkpointDir,
+                                             runFingerprint(options, self._algorithmName))
+            self._replayJournal()
+            self.journal.openForAppend()
+        if self.progressReporter:
+            self.progressReporter.start()
+
     def onResult(self, result):
-        window, cssAndVariants = result
-        css, variants = cssAndVariants
+        startTime = time.time()
+        if isinstance(result, ShardedResult):
+            # The consensus and variants stay in the shard file until
+            # they are written out
+            window, css, variants = result.window, result, result.variants
+            if self.journal:
+                self.journal.append(window,
+                                    consensus.Consensus(window, css.sequence,
+                                                        np.array(css.confidence)),
+                                    list(variants))
+        else:
+            window, cssAndVariants = result
+            css, variants = cssAndVariants
+            if self.journal:
+                self.journal.append(window, css, variants)
         self._recordNewResults(window, css, variants)
-        self._flushContigIfCompleted(window)
+        self._flushCompletedPrefix()
+        self.progress.recordChunk(window)
+        if tracing():
+            traceSpan("result", "collector", startTime, time.time(),
+                      window=reference.windowToString(window))
+            traceCounter("reorderBuffer", pendingChunks=self.numPendingChunks)
 
     def onFinish(self):
         logging.info("Analysis completed.")
+        logging.debug("Reorder buffer held at most %d chunks" % self.maxPendingChunks)
+        if self.contigsToWrite:
+            logging.warn("Output is incomplete: no results for %s:%d" %
+                         (self.contigsToWrite[0], self.cursor or 0))
+        logging.debug("Stage timings (all workers): %s" % self.runStats.summary())
+        if self.failures:
+            noCalls = sum(1 for failure in self.failures if failure.outcome == "noCall")
+            logging.warn("%d failed attempts at chunks; %d chunks were given no-calls" %
+                         (len(self.failures), noCalls))
+        if options.failureSummary:
+            writeFailureSummary(options.failureSummary, self.failures,
+                                reference.windowToString)
+        if options.runReport:
+            writeRunReport(options.runReport, self.runStats,
+                           algorithm=self._algorithmName,
+                           numWorkers=options.numWorkers,
+                           wallSeconds=round(time.time() - self.startTime, 3))
+        if self.progressReporter: self.progressReporter.stop()
+        if self.journal: self.journal.close()
+        closeShards()
         if self.fastaWriter: self.fastaWriter.close()
         if self.fastqWriter: self.fastqWriter.close()
         if self.gffWriter:   self.gffWriter.close()
         logging.info("Output files completed.")
 
+    def _replayJournal(self):
+        windowsReplayed = 0
+        for window, css, variants in self.journal.records():
+            self._recordNewResults(window, css, variants)
+            self._flushCompletedPrefix()
+            self.progress.recordChunk(window, replayed=True)
+            windowsReplayed += 1
+        if windowsReplayed:
+            logging.info("Replayed %d windows from checkpoint journal" % windowsReplayed)
+
     def _recordNewResults(self, window, css, variants):
         refId, refStart, refEnd = window
-        self.consensusChunksByRefId[refId].append(css)
-        self.variantsByRefId[refId] += variants
-        self.referenceBasesProcessedById[refId] += (refEnd - refStart)
+        self.pendingChunksByRefId[refId][refStart] = (css, variants)
+        self.numPendingChunks += 1
+        self.maxPendingChunks = max(self.maxPendingChunks, self.numPendingChunks)
+
+    def _flushCompletedPrefix(self):
+        """
+        Write out the chunks that extend the completed prefix of the
+        output, moving on to the next span and contig as each is
+        finished.
+        """
+        while self.contigsToWrite:
+            refId = self.contigsToWrite[0]
+            pending = self.pendingChunksByRefId[refId]
+            if self.spansToWrite is None:
+                self.spansToWrite = deque(reference.enumerateSpans(refId, options.referenceWindows))
+            while self.spansToWrite:
+                span = self.spansToWrite[0]
+                _, spanStart, spanEnd = span
+                if self.cursor is None:
+                    self._beginSpan(span)
+                    self.cursor = spanStart
+                while self.cursor < spanEnd and self.cursor in pending:
+                    css, variants = pending.pop(self.cursor)
+                    self.numPendingChunks -= 1
+                    self._writeChunk(css, variants)
+                    self.cursor = css.refWindow[2]
+                if self.cursor < spanEnd:
+                    # Waiting on the chunk at the cursor
+                    return
+                self._endSpan()
+                self.spansToWrite.popleft()
+                self.cursor = None
+            del self.pendingChunksByRefId[refId]
+            self.contigsToWrite.popleft()
+            self.spansToWrite = None
 
-    def _flushContigIfCompleted(self, window):
-        refId, _, _ = window
+    def _beginSpan(self, span):
+        #
+        # If the user asked to analyze a window or a set of
+        # windows, we output a FAST[AQ] contig per analyzed
+        # window.  Otherwise we output a fasta contig per
+        # reference contig.
+        #
+        # We try to be intelligent about naming the output
+        # contigs, to include window information where applicable.
+        #
+        refId, s, e = span
         refEntry = reference.byName[refId]
         refName = refEntry.fullName
-        basesProcessed = self.referenceBasesProcessedById[refId]
-        requiredBases = reference.numReferenceBases(refId, options.referenceWindows)
-        if basesProcessed == requiredBases:
-            # This contig is done, so we can dump to file and delete
-            # the data structures.
-            if self.gffWriter:
-                self.gffWriter.writeVariants(sorted(self.variantsByRefId[refId]))
-            del self.variantsByRefId[refId]
-
-            #
-            # If the user asked to analyze a window or a set of
-            # windows, we output a FAST[AQ] contig per analyzed
-            # window.  Otherwise we output a fasta contig per
-            # reference contig.
-            #
-            # We try to be intelligent about naming the output
-            # contigs, to include window information where applicable.
-            #
-            for span in reference.enumerateSpans(refId, options.referenceWindows):
-                _, s, e = span
-                if (s == 0) and (e == refEntry.length):
-                    spanName = refName
-                else:
-                    spanName = refName + "_%d_%d" % (s, e)
-                cssName = consensus.consensusContigName(spanName, self._algorithmName)
-                # Gather just the chunks pertaining to this span
-                chunksThisSpan = [ chunk for chunk in self.consensusChunksByRefId[refId]
-                                   if windows.windowsIntersect(chunk.refWindow, span) ]
-                css = consensus.join(chunksThisSpan)
-
-                if self.fastaWriter:
-                    self.fastaWriter.writeRecord(cssName,
-                                                 css.sequence)
-                if self.fastqWriter:
-                    self.fastqWriter.writeRecord(cssName,
-                                                 css.sequence,
-                                                 css.confidence)
-
-            del self.consensusChunksByRefId[refId]
+        if (s == 0) and (e == refEntry.length):
+            spanName = refName
+        else:
+            spanName = refName + "_%d_%d" % (s, e)
+        cssName = consensus.consensusContigName(spanName, self._algorithmName)
+        if self.fastaWriter: self.fastaWriter.beginRecord(cssName)
+        if self.fastqWriter: self.fastqWriter.beginRecord(cssName)
+
+    def _writeChunk(self, css, variants):
+        if self.gffWriter:
+            self.gffWriter.writeVariants(sorted(variants))
+        if self.fastaWriter:
+            self.fastaWriter.extend(css.sequence)
+        if self.fastqWriter:
+            self.fastqWriter.extend(css.sequence, css.confidence)
+
+    def _endSpan(self):
+        if self.fastaWriter: self.fastaWriter.endRecord()
+        if self.fastqWriter: self.fastqWriter.endRecord()
 
 class ResultCollectorProcess(ResultCollector, Process):
     def __init__(self, *args):
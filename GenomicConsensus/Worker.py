@@ -30,13 +30,44 @@
 
 # Author: David Alexander, Jim Drake
 
-import cProfile, logging, os.path
-from multiprocessing import Process
+import cProfile, logging, os.path, resource, time, traceback
+from multiprocessing import Process, Value
 from threading import Thread
 from .options import options
-from .reference import windowToString
+from .consensus import Consensus
+from .faults import MAX_ATTEMPTS, ChunkFailure, ChunkWatch
+from .reference import windowToString, sequenceInWindow
+from .resultShards import ResultShardWriter
+from .readCache import DecodedReadCache, CachingAlignmentFile, setWorkerCache
+from .readIndex import setSidecarInput
+from .instrumentation import workerStats
+from .profiling import sampledStacks
+from .tracing import startTracing, stopTracing, tracing, traceSpan
 from .io.utils import loadCmpH5, loadBam
 
+class WorkerHandoff(object):
+    """
+    Sent on the results queue, in place of the end-of-work sentinel,
+    by a worker that retires early (--maxChunksPerWorker,
+    --maxWorkerRss).  The driver starts a replacement, which will send
+    the sentinel in its turn.
+    """
+    def __init__(self, workerName, chunksProcessed, residentMegabytes):
+        self.workerName        = workerName
+        self.chunksProcessed   = chunksProcessed
+        self.residentMegabytes = residentMegabytes
+
+def residentMegabytes():
+    """
+    Resident set size of this process, in MB
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize() / 2.**20
+    except IOError:
+        # No procfs; the peak is the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
 class Worker(object):
     """
     Base class for compute worker that read reference coordinates
@@ -46,54 +77,217 @@ class Worker(object):
     All tasks that are O(genome length * coverage depth) should be
     distributed to compute workers, leaving the collector
     worker only O(genome length) work to do.
+
+    A work unit is either a single WorkChunk or, when batching is
+    enabled, a list of contiguous WorkChunks; in the latter case the
+    results are sent back as a list as well.  With --resultShards,
+    each result is written to the worker's shard file and only a
+    descriptor is sent back.  With --readCacheSize, the alignment
+    records (and decoded reads) are cached across chunks.  The time
+    spent on chunks is recorded in the WorkerActivity, if given, for
+    progress reporting.
+
+    With --maxChunksPerWorker or --maxWorkerRss, a worker that reaches
+    the limit retires after its current work unit: it sends a
+    WorkerHandoff instead of a sentinel, sets `retired` and exits
+    cleanly, and the driver starts a fresh worker in its place.
+
+    An exception from onChunk does not end the worker: the chunk is
+    retried with onFallbackChunk, then given a no-call, and each
+    failure is reported to the collector (see faults.py).  With
+    --chunkTimeout, the work unit in progress is kept in a ChunkWatch,
+    and a worker started to replace a hung one is given the unit to
+    redo (`retry`: the unit and the attempts to resume its chunks at).
     """
-    def __init__(self, workQueue, resultsQueue, algorithmConfig):
+    def __init__(self, workQueue, resultsQueue, algorithmConfig,
+                 chunkLatency=None, activity=None, retry=None):
         self._workQueue = workQueue
         self._resultsQueue = resultsQueue
         self._algorithmConfig = algorithmConfig
+        self._chunkLatency = chunkLatency
+        self._activity = activity
+        self._activitySlot = activity.claimSlot() if activity is not None else None
+        self._retry = retry
+        self._shardWriter = None
+        self._readCache = None
+        self._chunksProcessed = 0
+        self._retired = Value("b", 0, lock=False)
+        self.chunkWatch = ChunkWatch() if options.chunkTimeout else None
+
+    @property
+    def retired(self):
+        return bool(self._retired.value)
+
+    def releaseActivitySlot(self):
+        if self._activitySlot is not None:
+            self._activity.releaseSlot(self._activitySlot)
+            self._activitySlot = None
+
+    def _noCallResult(self, workChunk):
+        window = workChunk.window
+        css = Consensus.noCallConsensus(options.noEvidenceConsensusCall,
+                                        window, sequenceInWindow(window))
+        return (window, (css, []))
+
+    def _reportFailure(self, workChunk, attempt, error):
+        failure = ChunkFailure(workChunk.window, attempt, error, self.name)
+        logging.warn("%s failed on %s (attempt %d; next: %s): %s" %
+                     (self.name, windowToString(workChunk.window), attempt,
+                      failure.outcome, error.strip().splitlines()[-1]))
+        self._resultsQueue.put(failure)
+
+    def _attemptChunk(self, workChunk, index, attempt):
+        """
+        Compute the result for workChunk, starting at `attempt`
+        """
+        while attempt <= MAX_ATTEMPTS:
+            if self.chunkWatch is not None:
+                self.chunkWatch.beginChunk(index, attempt)
+            try:
+                if attempt == 1:
+                    return self.onChunk(workChunk)
+                else:
+                    return self.onFallbackChunk(workChunk)
+            except Exception:
+                if options.pdb:
+                    raise
+                self._reportFailure(workChunk, attempt, traceback.format_exc())
+                attempt += 1
+            finally:
+                if self.chunkWatch is not None:
+                    self.chunkWatch.endChunk()
+        return self._noCallResult(workChunk)
+
+    def _processChunk(self, workChunk, index=0, attempt=1):
+        if workChunk.hasCoverage:
+            msg = "%s received work unit, coords=%s"
+        else:
+            msg = "%s received work unit, coords=%s (inadequate coverage)"
+        logging.debug(msg % (self.name, windowToString(workChunk.window)))
+
+        startTime = time.time()
+        readsBefore = workerStats().counters["readsFetched"]
+        result = self._attemptChunk(workChunk, index, attempt)
+        endTime = time.time()
+        self._chunksProcessed += 1
+        if self._chunkLatency is not None:
+            self._chunkLatency.record(endTime - startTime)
+        if self._activitySlot is not None:
+            self._activity.recordChunk(self._activitySlot, endTime - startTime)
+        if tracing():
+            window, (css, variants) = result
+            traceSpan("chunk", "worker", startTime, endTime,
+                      window=windowToString(window),
+                      hasCoverage=workChunk.hasCoverage,
+                      reads=workerStats().counters["readsFetched"] - readsBefore,
+                      consensusBytes=2 * len(css.sequence),
+                      variants=len(variants))
+        if self._shardWriter is not None:
+            result = self._shardWriter.write(result)
+        return result
+
+    def _processUnit(self, datum, attempts=None):
+        if attempts is None:
+            attempts = {}
+        self.onWorkUnit(datum)
+        if self.chunkWatch is not None:
+            self.chunkWatch.beginUnit(datum, attempts)
+        if isinstance(datum, list):
+            results = [ self._processChunk(chunk, i, attempts.get(i, 1))
+                        for (i, chunk) in enumerate(datum) ]
+            self._putResult(results)
+        else:
+            result = self._processChunk(datum, 0, attempts.get(0, 1))
+            self._putResult(result)
+
+    def _getWork(self):
+        startTime = time.time()
+        datum = self._workQueue.get()
+        traceSpan("waitForWork", "queue", startTime, time.time())
+        return datum
+
+    def _putResult(self, result):
+        startTime = time.time()
+        self._resultsQueue.put(result)
+        traceSpan("putResult", "queue", startTime, time.time())
+
+    def _shouldRetire(self):
+        if options.maxChunksPerWorker and self._chunksProcessed >= options.maxChunksPerWorker:
+            return True
+        return bool(options.maxWorkerRss) and residentMegabytes() > options.maxWorkerRss
+
+    def _retire(self):
+        rss = residentMegabytes()
+        logging.info("%s retiring after %d chunks (%.0f MB resident)" %
+                     (self.name, self._chunksProcessed, rss))
+        self._retired.value = 1
+        self._resultsQueue.put(workerStats())
+        self._resultsQueue.put(WorkerHandoff(self.name, self._chunksProcessed, rss))
 
     def _run(self):
+        if options.readIndexSidecar:
+            setSidecarInput(options.inputFilename)
         if options.usingBam:
             self._inAlnFile = loadBam(options.inputFilename, options.referenceFilename)
         else:
             self._inAlnFile = loadCmpH5(options.inputFilename, options.referenceFilename,
                                         disableChunkCache=options.disableHdf5ChunkCache)
+        if options.readCacheSize > 0:
+            self._readCache = DecodedReadCache(options.readCacheSize * 2**20)
+            self._inAlnFile = CachingAlignmentFile(self._inAlnFile, self._readCache)
+            setWorkerCache(self._readCache)
+        if options.resultShards:
+            self._shardWriter = ResultShardWriter(options.resultShardDirectory, self.name)
+        if options.traceFile:
+            startTracing(options.traceDirectory, self.name)
         self.onStart()
 
+        if self._retry is not None:
+            # Redo the unit of the hung worker we replace
+            unit, attempts = self._retry
+            self._processUnit(unit, attempts)
         while True:
-            datum = self._workQueue.get()
+            datum = self._getWork()
             if datum is None:
-                # Sentinel indicating end of input.  Place a sentinel
-                # on the results queue and end this worker process.
+                # Sentinel indicating end of input.  Send the stage
+                # timings, place a sentinel on the results queue and
+                # end this worker process.
+                self._resultsQueue.put(workerStats())
                 self._resultsQueue.put(None)
                 break
-            else:
-                if datum.hasCoverage:
-                    msg = "%s received work unit, coords=%s"
-                else:
-                    msg = "%s received work unit, coords=%s (inadequate coverage)"
-                logging.debug(msg % (self.name, windowToString(datum.window)))
-
-                result = self.onChunk(datum)
-                self._resultsQueue.put(result)
+            self._processUnit(datum)
+            if self._shouldRetire():
+                self._retire()
+                break
 
         self.onFinish()
+        stopTracing()
+        self.releaseActivitySlot()
+        if self._readCache is not None:
+            self._readCache.logStats(self.name)
+        if self._shardWriter is not None:
+            self._shardWriter.close()
 
 
     def run(self):
-        if options.pdb:
-            import ipdb
-            with ipdb.launch_ipdb_on_exception():
-                self._run()
+        samplesFilename = None
+        if options.sampleProfile:
+            samplesFilename = os.path.join(options.temporaryDirectory,
+                                           "samples-%s.folded" % self.name)
+        with sampledStacks(samplesFilename, options.sampleInterval / 1000.):
+            if options.pdb:
+                import ipdb
+                with ipdb.launch_ipdb_on_exception():
+                    self._run()
 
-        elif options.doProfiling:
-            cProfile.runctx("self._run()",
-                            globals=globals(),
-                            locals=locals(),
-                            filename=os.path.join(options.temporaryDirectory,
-                                                  "profile-%s.out" % (self.name)))
-        else:
-            self._run()
+            elif options.doProfiling:
+                cProfile.runctx("self._run()",
+                                globals=globals(),
+                                locals=locals(),
+                                filename=os.path.join(options.temporaryDirectory,
+                                                      "profile-%s.out" % (self.name)))
+            else:
+                self._run()
 
     #==
     # Begin overridable interface
@@ -102,28 +296,46 @@ class Worker(object):
     def onStart(self):
         pass
 
-    def onChunk(self, workChunk):
+    def onWorkUnit(self, workUnit):
+        """
+        Called before the chunks of each work unit are processed
+        """
+        pass
+
+    def onChunk(self, workChunk, depthLimit=None):
         """
         This function is the heart of the matter.
 
         workChunk -> result
+
+        `depthLimit` is the number of reads to use at any position;
+        None means --coverage.
         """
         pass
 
+    def onFallbackChunk(self, workChunk):
+        """
+        A second attempt at a chunk on which onChunk has failed.  By
+        default, onChunk again with the read depth limited to
+        --fallbackCoverage.
+        """
+        return self.onChunk(workChunk,
+                            depthLimit=min(options.coverage, options.fallbackCoverage))
+
     def onFinish(self):
         pass
 
 class WorkerProcess(Worker, Process):
     """Worker that executes as a process."""
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         Process.__init__(self)
-        super(WorkerProcess,self).__init__(*args)
+        super(WorkerProcess,self).__init__(*args, **kwargs)
         self.daemon = True
 
 class WorkerThread(Worker, Thread):
     """Worker that executes as a thread (for debugging purposes only)."""
-    def __init__(self, *args):
+    def __init__(self, *args, **kwargs):
         Thread.__init__(self)
-        super(WorkerThread,self).__init__(*args)
+        super(WorkerThread,self).__init__(*args, **kwargs)
         self.daemon = True
         self.exitcode = 0
@@ -44,12 +44,17 @@ from GenomicConsensus.variants import filterVariants, annotateVariants
 from GenomicConsensus.arrow.evidence import ArrowEvidence
 from GenomicConsensus.arrow import diploid
 from GenomicConsensus.utils import die
+from GenomicConsensus.coverageIndex import coverageIndexFor
+from GenomicConsensus.targeted import targetedConsensusAndVariants
+from GenomicConsensus.instrumentation import timed, count
 
 import GenomicConsensus.arrow.model as M
 import GenomicConsensus.arrow.utils as U
 
 def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
-                                  depthLimit, arrowConfig):
+                                  depthLimit, arrowConfig,
+                                  draftFlank=None, intervalMaps=None,
+                                  candidateRows=None, loadedReads=None):
     """
     High-level routine for calling the consensus for a
     window of the genome given a cmp.h5.
@@ -58,24 +63,56 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
     identify subintervals where a good consensus can be called.
     Creates the desired "no evidence consensus" where there is
     inadequate coverage.
+
+    `draftFlank`, if not None, is (flankEnd, flankSequence): a polished
+    consensus for [winStart, flankEnd), carried over from the previous
+    window.  When the rest of the first interval shows no evidence of
+    a difference from the reference, the flank followed by the
+    reference is used as its consensus in place of the POA, and, as
+    for an interval passing the reference screen, is only polished
+    again under referenceScreen "seed".
+
+    `intervalMaps` is an output parameter; if not None, it should be
+    an empty list on entry; on return it holds, for each interval of
+    the window, (interval, cssOffset, targetPositions, polished):
+    where the consensus of the interval starts in the window
+    consensus, the consensus position of each reference position of
+    the interval (and of its end), and whether the interval was
+    polished.
+
+    `candidateRows` and `loadedReads`, if given, are the rows of the
+    reads intersecting an enclosing window and the records already
+    loaded for it (see `readsInWindow`), so that they are not looked
+    up or read again.
     """
     winId, winStart, winEnd = refWindow
     logging.info("Arrow operating on %s" %
                  reference.windowToString(refWindow))
+    count("windows")
+
+    # The reads intersecting the window, as rows of the alignment
+    # index; records are loaded only for the reads used in each interval
+    candidateRows = U.readRowsInWindow(alnFile, refWindow,
+                                       minMapQV=arrowConfig.minMapQV,
+                                       barcode=options.barcode,
+                                       candidateRows=candidateRows)
 
     if options.fancyChunking:
         # 1) identify the intervals with adequate coverage for arrow
         #    consensus; restrict to intervals of length > 10
-        alnHits = U.readsInWindow(alnFile, refWindow,
-                                  depthLimit=20000,
-                                  minMapQV=arrowConfig.minMapQV,
-                                  strategy="long-and-strand-balanced",
-                                  stratum=options.readStratum,
-                                  barcode=options.barcode)
-        starts = np.fromiter((hit.tStart for hit in alnHits), np.int)
-        ends   = np.fromiter((hit.tEnd   for hit in alnHits), np.int)
-        intervals = kSpannedIntervals(refWindow, arrowConfig.minPoaCoverage,
-                                      starts, ends, minLength=10)
+        #    (the coverage index bounds the depth from above, so a
+        #    window it shows to be too shallow is skipped outright)
+        coverage = coverageIndexFor(alnFile, arrowConfig.minMapQV, options.barcode)
+        if coverage.maxDepth(refWindow) < arrowConfig.minPoaCoverage:
+            intervals = []
+        else:
+            rows = U.selectReadRows(alnFile, candidateRows, refWindow,
+                                    depthLimit=20000,
+                                    strategy="long-and-strand-balanced")
+            starts = alnFile.index.tStart[rows].astype(np.int)
+            ends   = alnFile.index.tEnd[rows].astype(np.int)
+            intervals = kSpannedIntervals(refWindow, arrowConfig.minPoaCoverage,
+                                          starts, ends, minLength=10)
         coverageGaps = holes(refWindow, intervals)
         allIntervals = sorted(intervals + coverageGaps)
         if len(allIntervals) > 1:
@@ -89,6 +126,10 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
     # 3) call consensusForAlignments on the interval
     subConsensi = []
     variants = []
+    cssOffset = 0
+
+    if intervalMaps is not None:
+        assert intervalMaps == []
 
     for interval in allIntervals:
         intStart, intEnd = interval
@@ -96,14 +137,21 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
         subWin = subWindow(refWindow, interval)
 
         windowRefSeq = referenceContig[intStart:intEnd]
-        alns = U.readsInWindow(alnFile, subWin,
-                               depthLimit=depthLimit,
-                               minMapQV=arrowConfig.minMapQV,
-                               strategy="long-and-strand-balanced",
-                               stratum=options.readStratum,
-                               barcode=options.barcode)
-        clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
-        clippedAlns = U.filterAlns(subWin, clippedAlns_, arrowConfig)
+        with timed("fetch"):
+            alns = U.readsInWindow(alnFile, subWin,
+                                   depthLimit=depthLimit,
+                                   minMapQV=arrowConfig.minMapQV,
+                                   strategy="long-and-strand-balanced",
+                                   stratum=options.readStratum,
+                                   barcode=options.barcode,
+                                   candidateRows=candidateRows,
+                                   loadedReads=loadedReads)
+        with timed("clip"):
+            clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
+        with timed("filterAlns"):
+            clippedAlns = U.filterAlns(subWin, clippedAlns_, arrowConfig)
+        count("readsFetched", len(alns))
+        count("readsRejected.filterAlns", len(clippedAlns_) - len(clippedAlns))
 
         if len([ a for a in clippedAlns
                  if a.spansReferenceRange(*interval) ]) >= arrowConfig.minPoaCoverage:
@@ -112,11 +160,30 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
                           (reference.windowToString(subWin),
                            " ".join([str(hit.readName) for hit in alns])))
 
+            # Windows showing no evidence of a difference from the
+            # reference are polished from the reference, or not at all
+            draft, polish = None, True
+            with timed("referenceScreen"):
+                if (arrowConfig.referenceScreen != "off" and
+                    U.agreesWithReference(subWin, intRefSeq, clippedAlns,
+                                          arrowConfig.referenceScreenAlleleFraction)):
+                    logging.debug("%s: Passed reference screen" %
+                                  reference.windowToString(subWin))
+                    draft, polish = intRefSeq, (arrowConfig.referenceScreen == "seed")
+                    count("intervals.passedReferenceScreen")
+                elif draftFlank is not None and intStart == winStart:
+                    draft = _draftFromFlank(subWin, intRefSeq, clippedAlns, draftFlank, arrowConfig)
+                    if draft is not None:
+                        polish = (arrowConfig.referenceScreen == "seed")
+                        count("intervals.draftFromFlank")
+
             alnsUsed = [] if options.reportEffectiveCoverage else None
             css = U.consensusForAlignments(subWin,
                                            intRefSeq,
                                            clippedAlns,
                                            arrowConfig,
+                                           draft=draft,
+                                           polish=polish,
                                            alnsUsed=alnsUsed)
 
             # Tabulate the coverage implied by these alignments, as
@@ -124,10 +191,16 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
             siteCoverage = U.coverageInWindow(subWin, alns)
             effectiveSiteCoverage = U.coverageInWindow(subWin, alnsUsed) if options.reportEffectiveCoverage else None
 
-            variants_ = U.variantsFromConsensus(subWin, windowRefSeq,
-                                                css.sequence, css.confidence, siteCoverage, effectiveSiteCoverage,
-                                                options.aligner,
-                                                ai=None)
+            # The alignment to the reference gives both the variants
+            # and the reference-to-consensus coordinate mapping
+            with timed("variants"):
+                ga = U.alignToReference(windowRefSeq, css.sequence, options.aligner)
+                variants_ = U.variantsFromAlignment(ga, subWin, css.confidence,
+                                                    siteCoverage, effectiveSiteCoverage)
+                if intervalMaps is not None:
+                    targetPositions = np.array(cc.TargetToQueryPositions(ga), dtype=int)
+            polished = css.ai is not None
+            count("intervals.polished" if polished else "intervals.noCall")
 
             filteredVars =  filterVariants(options.minCoverage,
                                            options.minConfidence,
@@ -162,7 +235,14 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
         else:
             css = ArrowConsensus.noCallConsensus(arrowConfig.noEvidenceConsensus,
                                                  subWin, intRefSeq)
+            if intervalMaps is not None:
+                targetPositions = np.arange(intEnd - intStart + 1)
+            polished = False
+            count("intervals.inadequateCoverage")
         subConsensi.append(css)
+        if intervalMaps is not None:
+            intervalMaps.append((interval, cssOffset, targetPositions, polished))
+        cssOffset += len(css.sequence)
 
     # 4) glue the subwindow consensus objects together to form the
     #    full window consensus
@@ -172,15 +252,115 @@ def consensusAndVariantsForWindow(alnFile, refWindow, referenceContig,
     return css, variants
 
 
+def _draftFromFlank(subWin, intRefSeq, clippedAlns, draftFlank, arrowConfig):
+    """
+    The draft for an interval starting where the carried-over flank
+    does: the polished flank, then the reference for the rest of the
+    interval if that shows no evidence of a difference from it.  None
+    (use the POA) otherwise.
+    """
+    refId, intStart, intEnd = subWin
+    flankEnd, flankSequence = draftFlank
+    if flankEnd > intEnd:
+        return None
+    if flankEnd < intEnd and not U.agreesWithReference(
+            (refId, flankEnd, intEnd), intRefSeq[flankEnd-intStart:], clippedAlns,
+            arrowConfig.referenceScreenAlleleFraction):
+        return None
+    logging.debug("%s: Drafting from the previous window's flank" %
+                  reference.windowToString(subWin))
+    return flankSequence + intRefSeq[flankEnd-intStart:]
+
+
+def consensusPosition(intervalMaps, refPos):
+    """
+    The position in the window consensus corresponding to the
+    reference position `refPos` (which may be the window end), from
+    the intervalMaps of consensusAndVariantsForWindow
+    """
+    for (intStart, intEnd), cssOffset, targetPositions, _ in intervalMaps:
+        if intStart <= refPos <= intEnd:
+            return cssOffset + int(targetPositions[refPos - intStart])
+    raise ValueError("Position %d is outside the window" % refPos)
+
+
+def variantsOnlyForWindow(alnFile, refWindow, referenceContig,
+                          depthLimit, arrowConfig):
+    """
+    Consensus and variants for a window under --variantsOnly: only the
+    neighborhoods of candidate variant loci are polished, by
+    consensusAndVariantsForWindow.
+    """
+    _, winStart, winEnd = refWindow
+    # The reads are looked up and loaded once for the window; each
+    # neighborhood picks its reads out of these, loading only those
+    # the window's depth limit left out
+    candidateRows = U.readRowsInWindow(alnFile, refWindow,
+                                       minMapQV=arrowConfig.minMapQV,
+                                       barcode=options.barcode)
+    with timed("fetch"):
+        rows = U.selectReadRows(alnFile, candidateRows, refWindow,
+                                depthLimit=depthLimit,
+                                strategy="long-and-strand-balanced").tolist()
+        alns = alnFile[rows] if rows else []
+    loadedReads = dict(zip(rows, alns))
+
+    def callWindow(subWin):
+        return consensusAndVariantsForWindow(alnFile, subWin, referenceContig,
+                                             depthLimit, arrowConfig,
+                                             candidateRows=candidateRows,
+                                             loadedReads=loadedReads)
+
+    return targetedConsensusAndVariants(refWindow,
+                                        referenceContig[winStart:winEnd],
+                                        alns,
+                                        callWindow,
+                                        arrowConfig.minPoaCoverage,
+                                        arrowConfig.referenceScreenAlleleFraction,
+                                        arrowConfig.noEvidenceConsensus)
+
+
 class ArrowWorker(object):
 
     @property
     def arrowConfig(self):
         return self._algorithmConfig
 
-    def onChunk(self, workChunk):
+    def onStart(self):
+        # The polished right end of the last enlarged window, kept as
+        # (refId, start, end, sequence, targetPositions), to draft the
+        # next window when it is the adjacent chunk (--carryDraft)
+        self._carriedFlank = None
+
+    def onWorkUnit(self, workUnit):
+        # Drafts are only carried between the chunks of one batch, so
+        # that they do not depend on what this worker happened to
+        # process before it
+        self._carriedFlank = None
+
+    def _draftFlankFor(self, eWindow):
+        refId, eStart, _ = eWindow
+        if not options.carryDraft or self._carriedFlank is None:
+            return None
+        flankRefId, flankStart, flankEnd, flankSequence, targetPositions = self._carriedFlank
+        if flankRefId != refId or not (flankStart <= eStart < flankEnd):
+            return None
+        return (flankEnd, flankSequence[targetPositions[eStart - flankStart]:])
+
+    def _carryFlank(self, eWindow, css, intervalMaps):
+        refId, _, eEnd = eWindow
+        self._carriedFlank = None
+        if intervalMaps:
+            (intStart, intEnd), cssOffset, targetPositions, polished = intervalMaps[-1]
+            if polished and intEnd == eEnd:
+                self._carriedFlank = (refId, intStart, intEnd,
+                                      css.sequence[cssOffset:], targetPositions)
+
+    def onChunk(self, workChunk, depthLimit=None):
         referenceWindow  = workChunk.window
         refId, refStart, refEnd = referenceWindow
+        if depthLimit is None:
+            depthLimit = options.coverage
 
         refSeqInWindow = reference.sequenceInWindow(referenceWindow)
 
@@ -205,17 +385,38 @@ class ArrowWorker(object):
         #
         # Get the consensus for the enlarged window.
         #
-        css_, variants_ = \
-            consensusAndVariantsForWindow(self._inAlnFile, eWindow,
-                                          refContig, options.coverage, self.arrowConfig)
+        intervalMaps = None
+        if options.variantsOnly:
+            css_, variants_ = variantsOnlyForWindow(self._inAlnFile, eWindow,
+                                                    refContig, depthLimit,
+                                                    self.arrowConfig)
+        elif options.carryDraft:
+            intervalMaps = []
+            css_, variants_ = consensusAndVariantsForWindow(self._inAlnFile, eWindow,
+                                                            refContig, depthLimit,
+                                                            self.arrowConfig,
+                                                            draftFlank=self._draftFlankFor(eWindow),
+                                                            intervalMaps=intervalMaps)
+            self._carryFlank(eWindow, css_, intervalMaps)
+        else:
+            css_, variants_ = consensusAndVariantsForWindow(self._inAlnFile, eWindow,
+                                                            refContig, depthLimit,
+                                                            self.arrowConfig)
 
         #
         # Restrict the consensus and variants to the reference window.
+        # Under --carryDraft, the clip points come from the alignments
+        # of the interval consensi to the reference, made for variant
+        # calling; otherwise the enlarged consensus is aligned again.
         #
-        ga = cc.Align(refSequenceInEnlargedWindow, css_.sequence)
-        targetPositions = cc.TargetToQueryPositions(ga)
-        cssStart = targetPositions[refStart-eStart]
-        cssEnd   = targetPositions[refEnd-eStart]
+        if intervalMaps:
+            cssStart = consensusPosition(intervalMaps, refStart)
+            cssEnd   = consensusPosition(intervalMaps, refEnd)
+        else:
+            ga = cc.Align(refSequenceInEnlargedWindow, css_.sequence)
+            targetPositions = cc.TargetToQueryPositions(ga)
+            cssStart = targetPositions[refStart-eStart]
+            cssEnd   = targetPositions[refEnd-eStart]
 
         cssSequence    = css_.sequence[cssStart:cssEnd]
         cssQv          = css_.confidence[cssStart:cssEnd]
@@ -293,7 +494,10 @@ def configure(options, alnFile):
                          minReadScore=options.minReadScore,
                          minHqRegionSnr=options.minHqRegionSnr,
                          minZScore=options.minZScore,
-                         minAccuracy=options.minAccuracy)
+                         minAccuracy=options.minAccuracy,
+                         referenceScreen=options.referenceScreen,
+                         referenceScreenAlleleFraction=options.referenceScreenAlleleFraction,
+                         windowTimeBudget=options.windowTimeBudget)
 
 def slaveFactories(threaded):
     # By default we use slave processes. The tuple ordering is important.
@@ -36,6 +36,7 @@ from os.path import join
 from pkg_resources import resource_filename, Requirement
 
 from GenomicConsensus.utils import die
+from GenomicConsensus.readCache import workerCache
 from GenomicConsensus.arrow.utils import fst, snd
 from pbcore.chemistry import ChemistryLookupError
 from pbcore.io import CmpH5Alignment
@@ -65,7 +66,10 @@ class ArrowConfig(object):
                  minReadScore=0.75,
                  minHqRegionSnr=3.75,
                  minZScore=-3.5,
-                 minAccuracy=0.82):
+                 minAccuracy=0.82,
+                 referenceScreen="off",
+                 referenceScreenAlleleFraction=0.3,
+                 windowTimeBudget=0):
 
         self.minMapQV                   = minMapQV
         self.minPoaCoverage             = minPoaCoverage
@@ -80,6 +84,9 @@ class ArrowConfig(object):
         self.minHqRegionSnr             = minHqRegionSnr
         self.minZScore                  = minZScore
         self.minAccuracy                = minAccuracy
+        self.referenceScreen            = referenceScreen
+        self.referenceScreenAlleleFraction = referenceScreenAlleleFraction
+        self.windowTimeBudget           = windowTimeBudget
 
     def extractMappedRead(self, aln, windowStart):
         """
@@ -92,20 +99,35 @@ class ArrowConfig(object):
 
         assert aln.referenceSpan > 0
 
-        def baseFeature(featureName):
+        def baseFeature(aln, featureName):
             if aln.reader.hasBaseFeature(featureName):
                 rawFeature = aln.baseFeature(featureName, aligned=False, orientation="native")
                 return rawFeature.clip(0,255).astype(np.uint8)
             else:
                 return np.zeros((aln.readLength,), dtype=np.uint8)
 
+        def decode(aln):
+            return (aln.read(aligned=False, orientation="native"),
+                    (cc.Uint8Vector(baseFeature(aln, "Ipd").tolist()),
+                     cc.Uint8Vector(baseFeature(aln, "PulseWidth").tolist())))
+
+        # The decoded read is sliced from the whole read, if this
+        # worker has already decoded it for another window; the
+        # features are kept as ConsensusCore2 vectors, which slice
+        # without a round trip through Python
+        cache = workerCache()
+        decoded = None
+        if cache is not None:
+            decoded = cache.nativeReadAndFeatures(aln, decode)
+        seq, (ipd, pw) = decoded or decode(aln)
+
         name = aln.readName
         chemistry = aln.sequencingChemistry
         strand = cc.StrandType_REVERSE if aln.isReverseStrand else cc.StrandType_FORWARD
         read = cc.Read(name,
-                       aln.read(aligned=False, orientation="native"),
-                       cc.Uint8Vector(baseFeature("Ipd").tolist()),
-                       cc.Uint8Vector(baseFeature("PulseWidth").tolist()),
+                       seq,
+                       ipd,
+                       pw,
                        cc.SNR(aln.hqRegionSnr),
                        chemistry)
         return cc.MappedRead(read,
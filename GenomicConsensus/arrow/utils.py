@@ -36,7 +36,9 @@ from traceback import format_exception
 
 from GenomicConsensus.variants import *
 from GenomicConsensus.utils import *
+from GenomicConsensus.polishing import agreesWithReference, WindowBudget, noConfidence
 from GenomicConsensus.consensus import ArrowConsensus
+from GenomicConsensus.instrumentation import timed, count
 from pbcore.io.rangeQueries import projectIntoRange
 import ConsensusCore2 as cc
 
@@ -124,16 +126,43 @@ def bestSubset(mutationsAndScores, separation):
 
     return output
 
-def refineConsensus(ai, arrowConfig):
+# With a window time budget, Polish is called repeatedly, checking the
+# budget in between.  Every call starts with a scan of all the
+# mutations of the template (later iterations only look near the
+# mutations applied), so the calls get longer as polishing goes on:
+# this many iterations, then twice as many, and so on.  A window that
+# converges within the first call (most do) costs no more than without
+# a budget; one polished to maxIterations (40) costs two extra scans.
+FIRST_POLISH_ITERATIONS_PER_BUDGET_CHECK = 8
+
+def refineConsensus(ai, arrowConfig, budget=None):
     """
     Given a MultiReadMutationScorer, identify and apply favorable
     template mutations.  Return (consensus, didConverge) :: (str, bool)
+
+    If a WindowBudget with a limit is given, polishing stops early,
+    unconverged, once it is exceeded.
     """
-    cfg = cc.PolishConfig(arrowConfig.maxIterations,
-                          arrowConfig.mutationSeparation,
-                          arrowConfig.mutationNeighborhood)
-    polishResult = cc.Polish(ai, cfg)
-    return str(ai), polishResult.hasConverged
+    if budget is None or not budget.limited:
+        iterationsPerCall = arrowConfig.maxIterations
+    else:
+        iterationsPerCall = FIRST_POLISH_ITERATIONS_PER_BUDGET_CHECK
+    iterations = 0
+    while iterations < arrowConfig.maxIterations:
+        n = min(iterationsPerCall, arrowConfig.maxIterations - iterations)
+        cfg = cc.PolishConfig(n,
+                              arrowConfig.mutationSeparation,
+                              arrowConfig.mutationNeighborhood)
+        polishResult = cc.Polish(ai, cfg)
+        count("polish.mutationsTested", polishResult.mutationsTested)
+        count("polish.mutationsApplied", polishResult.mutationsApplied)
+        iterations += n
+        if polishResult.hasConverged:
+            return str(ai), True
+        if budget is not None and budget.exceeded:
+            break
+        iterationsPerCall *= 2
+    return str(ai), False
 
 def consensusConfidence(ai, positions=None):
     """
@@ -210,6 +239,13 @@ def referenceSpanWithinWindow(referenceWindow, aln):
     return min(winEnd, aln.referenceEnd) - \
            max(winStart, aln.referenceStart)
 
+# The names of the ConsensusCore2 read States, for the rejection counters
+_STATE_NAMES = dict((getattr(cc, name), name[len("State_"):])
+                    for name in dir(cc) if name.startswith("State_"))
+
+def _stateName(state):
+    return _STATE_NAMES.get(state, str(state))
+
 def lifted(queryPositions, mappedRead):
     """
     Lift a mappedRead into a new coordinate system by using the
@@ -279,16 +315,19 @@ def variantsFromConsensus(refWindow, refSequenceInWindow, cssSequenceInWindow,
     Compare the consensus and the reference in this window, returning
     a list of variants.
     """
-    refId, refStart, refEnd = refWindow
+    ga = alignToReference(refSequenceInWindow, cssSequenceInWindow, aligner)
+    return variantsFromAlignment(ga, refWindow, cssQvInWindow, siteCoverage, effectiveSiteCoverage)
 
+def alignToReference(refSequenceInWindow, cssSequenceInWindow, aligner="affine"):
+    """
+    Pairwise alignment of the consensus to the reference, with the
+    aligner chosen by --aligner
+    """
     if aligner == "affine":
         align = cc.AlignAffine
     else:
         align = cc.Align
-
-    ga = align(refSequenceInWindow, cssSequenceInWindow)
-
-    return variantsFromAlignment(ga, refWindow, cssQvInWindow, siteCoverage, effectiveSiteCoverage)
+    return align(refSequenceInWindow, cssSequenceInWindow)
 
 
 def filterAlns(refWindow, alns, arrowConfig):
@@ -348,7 +387,13 @@ def consensusForAlignments(refWindow, refSequence, alns, arrowConfig, draft=None
     draft starting point.
 
     If `polish` is False, the arrow polishing procedure will not be
-    used, and the draft consensus will be returned.
+    used, and the draft consensus will be returned, with confidence
+    values computed against the draft.
+
+    With `arrowConfig.windowTimeBudget` set, a window whose budget
+    runs out returns early: the draft, if it runs out before
+    polishing, or the template polished so far, in either case with
+    QVs of 0.
 
     `alnsUsed` is an output parameter; if not None, it should be an
     empty list on entry; on return from this function, the list will
@@ -356,6 +401,7 @@ def consensusForAlignments(refWindow, refSequence, alns, arrowConfig, draft=None
     consensus (those not filtered out).
     """
     _, refStart, refEnd = refWindow
+    budget = WindowBudget(arrowConfig.windowTimeBudget, refWindow)
 
     if alnsUsed is not None:
         assert alnsUsed == []
@@ -369,20 +415,23 @@ def consensusForAlignments(refWindow, refSequence, alns, arrowConfig, draft=None
         assert len(fwdSequences) >= arrowConfig.minPoaCoverage
 
         try:
-            p = cc.PoaConsensus.FindConsensus(fwdSequences[:arrowConfig.maxPoaCoverage])
+            with timed("poa"):
+                p = cc.PoaConsensus.FindConsensus(fwdSequences[:arrowConfig.maxPoaCoverage])
         except:
             logging.info("%s: POA could not be generated" % (refWindow,))
+            count("poa.failed")
             return ArrowConsensus.noCallConsensus(arrowConfig.noEvidenceConsensus,
                                                   refWindow, refSequence)
         draft = p.Sequence
 
-    ga = cc.Align(refSequence, draft)
+    with timed("extractReads"):
+        ga = cc.Align(refSequence, draft)
 
-    # Extract reads into ConsensusCore2-compatible objects, and map them into the
-    # coordinates relative to the POA consensus
-    mappedReads = [ arrowConfig.extractMappedRead(aln, refStart) for aln in alns ]
-    queryPositions = cc.TargetToQueryPositions(ga)
-    mappedReads = [ lifted(queryPositions, mr) for mr in mappedReads ]
+        # Extract reads into ConsensusCore2-compatible objects, and map them into the
+        # coordinates relative to the POA consensus
+        mappedReads = [ arrowConfig.extractMappedRead(aln, refStart) for aln in alns ]
+        queryPositions = cc.TargetToQueryPositions(ga)
+        mappedReads = [ lifted(queryPositions, mr) for mr in mappedReads ]
 
     # Load the mapped reads into the mutation scorer, and iterate
     # until convergence.
@@ -392,8 +441,12 @@ def consensusForAlignments(refWindow, refSequence, alns, arrowConfig, draft=None
         if (mr.TemplateEnd <= mr.TemplateStart or
             mr.TemplateEnd - mr.TemplateStart < 2 or
             mr.Length() < 2):
+            count("readsRejected.tooShort")
             continue
-        if not sufficientlyAccurate(mr, draft, arrowConfig.minAccuracy):
+        with timed("sufficientlyAccurate"):
+            accurate = sufficientlyAccurate(mr, draft, arrowConfig.minAccuracy)
+        if not accurate:
+            count("readsRejected.lowAccuracy")
             tpl = draft[mr.TemplateStart:mr.TemplateEnd]
             if mr.Strand == cc.StrandType_FORWARD:
                 pass
@@ -403,34 +456,54 @@ def consensusForAlignments(refWindow, refSequence, alns, arrowConfig, draft=None
                 tpl = "INACTIVE/UNMAPPED"
             logging.debug("%s: skipping read '%s' due to insufficient accuracy, (poa, read): ('%s', '%s')" % (refWindow, mr.Name, tpl, mr.Seq))
             continue
-        if ai.AddRead(mr) == cc.State_VALID:
+        with timed("addRead"):
+            state = ai.AddRead(mr)
+        if state == cc.State_VALID:
             coverage += 1
             if alnsUsed is not None:
                 alnsUsed.append(alns[i])
+        else:
+            count("readsRejected.%s" % _stateName(state))
 
     if coverage < arrowConfig.minPoaCoverage:
         logging.info("%s: Inadequate coverage to call consensus" % (refWindow,))
         return ArrowConsensus.noCallConsensus(arrowConfig.noEvidenceConsensus,
                                               refWindow, refSequence)
 
+    return consensusFromIntegrator(refWindow, refSequence, ai, draft,
+                                   arrowConfig, budget, polish)
+
+def consensusFromIntegrator(refWindow, refSequence, ai, draft,
+                            arrowConfig, budget, polish=True):
+    """
+    The ArrowConsensus for the window, from the integrator `ai`
+    holding its reads and the `draft`: polished unless `polish` is
+    False, within the WindowBudget `budget`.
+    """
     if not polish:
-        confidence = np.zeros(len(draft), dtype=int)
+        confidence = budget.confidence(consensusConfidence, ai, len(draft),
+                                       arrowConfig.computeConfidence)
         return ArrowConsensus(refWindow, draft, confidence, ai)
 
+    if budget.exceededAt("draft"):
+        return ArrowConsensus(refWindow, draft, noConfidence(len(draft)), ai)
+
     # Iterate until covergence
-    _, converged = refineConsensus(ai, arrowConfig)
+    with timed("polish"):
+        arrowCss, converged = refineConsensus(ai, arrowConfig, budget)
+    if not converged and budget.exceededAt("polish"):
+        # The best template so far
+        return ArrowConsensus(refWindow, arrowCss, noConfidence(len(arrowCss)), ai)
     if converged:
-        arrowCss = str(ai)
-        if arrowConfig.computeConfidence:
-            confidence = consensusConfidence(ai)
-        else:
-            confidence = np.zeros(shape=len(arrowCss), dtype=int)
+        confidence = budget.confidence(consensusConfidence, ai, len(arrowCss),
+                                       arrowConfig.computeConfidence)
         return ArrowConsensus(refWindow,
                               arrowCss,
                               confidence,
                               ai)
     else:
         logging.info("%s: Arrow did not converge to MLE" % (refWindow,))
+        count("polish.notConverged")
         return ArrowConsensus.noCallConsensus(arrowConfig.noEvidenceConsensus,
                                               refWindow, refSequence)
 
@@ -0,0 +1,108 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# batching.py: grouping of work chunks into batches for the work queue
+#
+# Every message on the work and results queues costs a pickle/unpickle
+# round trip and a lock acquisition.  With the default 500bp chunks
+# that overhead is paid millions of times on a large genome, and the
+# driver and collector become the bottleneck at high worker counts.
+# When batching is enabled the driver sends lists of contiguous
+# chunks, and workers send back lists of results.
+#
+# The batch size adapts to the measured per-chunk processing time: we
+# aim for batches that take roughly `targetSeconds` to process, so
+# cheap chunks (coverage cutouts, plurality) get batched aggressively
+# while expensive chunks are still dealt out one at a time.
+#
+
+import multiprocessing
+
+__all__ = [ "ChunkLatencyEstimate",
+            "adaptiveBatchSize",
+            "batched" ]
+
+class ChunkLatencyEstimate(object):
+    """
+    Exponentially-weighted moving average of the per-chunk processing
+    time, in seconds.  Workers record their timings; the driver reads
+    the estimate when sizing the next batch.  The value lives in
+    shared memory, so it must be constructed before the workers are
+    forked.
+    """
+    def __init__(self, smoothing=0.1):
+        self._smoothing = smoothing
+        self._seconds = multiprocessing.Value("d", 0.0)
+
+    def record(self, seconds):
+        with self._seconds.get_lock():
+            if self._seconds.value == 0.0:
+                self._seconds.value = seconds
+            else:
+                self._seconds.value += self._smoothing * (seconds - self._seconds.value)
+
+    @property
+    def seconds(self):
+        return self._seconds.value
+
+
+def adaptiveBatchSize(latencyEstimate, targetSeconds, maxBatchSize):
+    """
+    Number of chunks to put in the next batch.  We dispatch single
+    chunks until there is a measurement to go on.
+    """
+    latency = latencyEstimate.seconds
+    if latency <= 0:
+        return 1
+    return max(1, min(maxBatchSize, int(targetSeconds / latency)))
+
+
+def _abuts(chunk1, chunk2):
+    id1, _, end1   = chunk1.window
+    id2, start2, _ = chunk2.window
+    return (id1 == id2) and (end1 == start2)
+
+def batched(chunks, batchSize):
+    """
+    Group runs of contiguous chunks (same contig, abutting windows)
+    into lists.  `batchSize` is a nullary function consulted at the
+    start of each batch, giving the maximum size of that batch.
+    """
+    batch = []
+    limit = batchSize()
+    for chunk in chunks:
+        if batch and (len(batch) >= limit or not _abuts(batch[-1], chunk)):
+            yield batch
+            batch = []
+            limit = batchSize()
+        batch.append(chunk)
+    if batch:
+        yield batch
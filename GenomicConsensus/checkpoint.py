@@ -0,0 +1,211 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# checkpoint.py: on-disk journal of finished windows, allowing an
+# interrupted run to be resumed.
+#
+# The result collector appends each finished window (its consensus
+# and variants) to the journal before doing anything else with it.
+# When a run is restarted with the same --checkpointDir, the driver
+# skips the windows already in the journal and the collector replays
+# them, so only the unfinished windows are recomputed.
+#
+# The journal is a sequence of pickled records.  The first record is
+# a header identifying the run settings that determine the chunking
+# and the results; a journal written with different settings is
+# rejected.  Each window then has a record (window, resultsLength),
+# followed by its consensus and variants, pickled, in resultsLength
+# bytes; the driver, which only needs the windows, skips over the
+# results without reading them.  A truncated final record (the
+# process was killed mid-write) is discarded.
+#
+
+import cPickle, itertools, logging, os, os.path, time
+
+__all__ = [ "CheckpointJournal",
+            "runFingerprint" ]
+
+JOURNAL_VERSION = 2
+
+TRUNCATED_RECORD_WARNING = "Discarding truncated record at end of checkpoint journal"
+
+# Options that determine the chunk windows or the results computed for
+# them.  Changing any of these invalidates a journal.
+FINGERPRINT_OPTIONS = [ "inputFilename",
+                        "referenceFilename",
+                        "algorithm",
+                        "parametersFile",
+                        "parametersSpec",
+                        "referenceWindowsAsString",
+                        "referenceChunkSize",
+                        "referenceChunkOverlap",
+                        "fancyChunking",
+                        "coverage",
+                        "minCoverage",
+                        "minConfidence",
+                        "minMapQV",
+                        "noEvidenceConsensusCall",
+                        "diploid",
+                        "fastMode",
+                        "pluralitySweep",
+                        "sweepBlockSize",
+                        "referenceScreen",
+                        "referenceScreenAlleleFraction",
+                        "variantsOnly",
+                        "carryDraft",
+                        "windowTimeBudget",
+                        "_barcode" ]
+
+def runFingerprint(options, algorithmName):
+    fingerprint = dict((name, getattr(options, name, None))
+                       for name in FINGERPRINT_OPTIONS)
+    fingerprint["algorithm"] = algorithmName
+    return fingerprint
+
+
+class CheckpointJournal(object):
+
+    JOURNAL_FILENAME = "journal.pickle"
+
+    def __init__(self, directory, fingerprint, syncInterval=10.0):
+        self.directory    = directory
+        self.filename     = os.path.join(directory, self.JOURNAL_FILENAME)
+        self.fingerprint  = fingerprint
+        self.syncInterval = syncInterval
+        self._file        = None
+        self._lastSync    = 0
+
+    def _header(self):
+        return { "version"     : JOURNAL_VERSION,
+                 "fingerprint" : self.fingerprint }
+
+    def _readRecords(self, withResults=True):
+        """
+        Generate (offset, record) for each intact record in the
+        journal, where offset is the file position just after the
+        record.  The first record is the header; the others are
+        (window, css, variants), or, if not `withResults`, just the
+        window.
+        """
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, "rb") as f:
+            fileLength = os.fstat(f.fileno()).st_size
+            for i in itertools.count():
+                try:
+                    record = cPickle.load(f)
+                except EOFError:
+                    return
+                except Exception:
+                    logging.warn(TRUNCATED_RECORD_WARNING)
+                    return
+                if i > 0:
+                    window, resultsLength = record
+                    if f.tell() + resultsLength > fileLength:
+                        logging.warn(TRUNCATED_RECORD_WARNING)
+                        return
+                    if withResults:
+                        record = (window,) + cPickle.loads(f.read(resultsLength))
+                    else:
+                        f.seek(resultsLength, os.SEEK_CUR)
+                        record = window
+                yield f.tell(), record
+
+    def validate(self):
+        """
+        Check that an existing journal was written by a run with the
+        same settings.  Returns an error message, or None if the
+        journal is usable (or does not exist yet).
+        """
+        for _, header in self._readRecords(withResults=False):
+            if not isinstance(header, dict) or header.get("version") != JOURNAL_VERSION:
+                return "Checkpoint journal %s has an unrecognized format" % self.filename
+            if header["fingerprint"] != self.fingerprint:
+                differing = sorted(k for k in self.fingerprint
+                                   if header["fingerprint"].get(k) != self.fingerprint[k])
+                return ("Checkpoint journal %s was written by a run with different settings (%s)" %
+                        (self.filename, ", ".join(differing)))
+            return None
+        return None
+
+    def records(self):
+        """
+        Generate the (window, css, variants) records in the journal.
+        """
+        for i, (_, record) in enumerate(self._readRecords()):
+            if i > 0:
+                yield record
+
+    def completedWindows(self):
+        """
+        The windows in the journal, read without their results
+        """
+        return set(window for (_, window)
+                   in itertools.islice(self._readRecords(withResults=False), 1, None))
+
+    def openForAppend(self):
+        """
+        Open the journal for appending, first truncating any partial
+        record left at its end, or writing the header if the journal
+        is new.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        validLength = 0
+        for offset, _ in self._readRecords(withResults=False):
+            validLength = offset
+        self._file = open(self.filename, "ab")
+        if validLength == 0:
+            self._file.truncate(0)
+            cPickle.dump(self._header(), self._file, cPickle.HIGHEST_PROTOCOL)
+        else:
+            self._file.truncate(validLength)
+        self._sync()
+
+    def append(self, window, css, variants):
+        assert self._file is not None
+        results = cPickle.dumps((css, variants), cPickle.HIGHEST_PROTOCOL)
+        cPickle.dump((window, len(results)), self._file, cPickle.HIGHEST_PROTOCOL)
+        self._file.write(results)
+        self._file.flush()
+        if time.time() - self._lastSync > self.syncInterval:
+            self._sync()
+
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._lastSync = time.time()
+
+    def close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
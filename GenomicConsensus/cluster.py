@@ -0,0 +1,375 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# cluster.py: distribution of work units to worker agents on other hosts
+#
+# In coordinator mode (--coordinatorAddress) the driver does not launch
+# compute workers itself.  Instead it serves its work units over TCP,
+# using multiprocessing.managers, to worker agents started on any
+# number of hosts with
+#
+#     variantCaller --worker-agent HOST:PORT -j N
+#
+# Each agent forks N ordinary Worker processes, which talk to the
+# coordinator through a WorkChannel in place of their work and results
+# queues.  The result collector runs in the driver as usual.
+#
+# Agents may join and leave at any point in the run.  A work unit
+# handed to an agent is leased to it: the agent process heartbeats on
+# behalf of its workers, and if it leaves or its heartbeats stop, its
+# outstanding work units are put back at the head of the queue for
+# another agent.  A result for a work unit that has already been
+# completed (a late result from an agent presumed dead) is dropped.
+#
+# A worker under an agent sends the stage timings and counters of each
+# work unit along with its result, and reports its failed chunks as
+# they happen, so that both reach the result collector (the run report
+# and the failure summary) before the coordinator's sentinels do.
+#
+# The agents must see the input, reference and output paths at the
+# same locations as the driver (i.e. a shared filesystem).  The
+# connection is authenticated with the key in the environment variable
+# GENOMICCONSENSUS_AUTHKEY, which must be set identically for the
+# driver and the agents.
+#
+
+import collections, logging, os, socket, threading, time
+from multiprocessing.managers import BaseManager
+from .instrumentation import RunStats, takeWorkerStats
+from .Worker import WorkerHandoff
+from .faults import ChunkFailure
+
+__all__ = [ "AUTHKEY_ENVIRONMENT_VARIABLE",
+            "Coordinator",
+            "WorkChannel",
+            "authkeyFromEnvironment",
+            "connectToCoordinator",
+            "parseAddress",
+            "serveCoordinator" ]
+
+AUTHKEY_ENVIRONMENT_VARIABLE = "GENOMICCONSENSUS_AUTHKEY"
+
+HEARTBEAT_INTERVAL = 5.0        # seconds
+LEASE_TIMEOUT      = 60.0       # seconds without a heartbeat before an agent
+                                # is presumed dead
+
+# Replies to Coordinator.getWork
+WORK, WAIT, DONE = "work", "wait", "done"
+
+def parseAddress(s):
+    """
+    "host:port" -> (host, port)
+    """
+    host, _, port = s.rpartition(":")
+    try:
+        return (host or "", int(port))
+    except ValueError:
+        raise ValueError("Invalid address %r; expected HOST:PORT" % s)
+
+def authkeyFromEnvironment():
+    return os.environ.get(AUTHKEY_ENVIRONMENT_VARIABLE)
+
+
+class Coordinator(object):
+    """
+    Holds the work units waiting to be processed, and the leases on
+    those handed out to agents.  The driver feeds it through `put`, in
+    place of the local work queue; agents call in through a manager
+    proxy.  Results are forwarded to the collector's results queue.
+
+    Once the driver has signaled the end of input (by putting None)
+    and every work unit has been completed, the coordinator places
+    `numSentinels` end-of-results sentinels on the results queue, as
+    the local workers would have.
+    """
+    def __init__(self, resultsQueue, numSentinels, runOptions,
+                 maxPending=200, leaseTimeout=LEASE_TIMEOUT,
+                 chunkLatency=None, clock=time.time):
+        self._resultsQueue  = resultsQueue
+        self._numSentinels  = numSentinels
+        self._runOptions    = runOptions
+        self._maxPending    = maxPending
+        self._leaseTimeout  = leaseTimeout
+        self._chunkLatency  = chunkLatency
+        self._clock         = clock
+
+        self._lock          = threading.Condition()
+        self._pending       = collections.deque()     # (seq, workUnit)
+        self._leases        = {}                      # seq -> (agentId, workUnit, leaseTime)
+        self._lastHeartbeat = {}                      # agentId -> time
+        self._nextSeq       = 0
+        self._nextAgentId   = 0
+        self._inputFinished = False
+        self._finished      = False
+        self._closed        = False
+
+    # -- Driver interface (in process) --
+
+    def put(self, workUnit):
+        """
+        Add a work unit, blocking while the backlog is full.  None
+        marks the end of input.
+        """
+        with self._lock:
+            if workUnit is None:
+                self._inputFinished = True
+                self._finishIfComplete()
+                return
+            while len(self._pending) >= self._maxPending and not self._closed:
+                self._lock.wait(1.0)
+            self._pending.append((self._nextSeq, workUnit))
+            self._nextSeq += 1
+            self._lock.notify_all()
+
+    def close(self):
+        """
+        Abort the run: agents are told there is no more work.
+        """
+        with self._lock:
+            self._closed = True
+            self._pending.clear()
+            self._lock.notify_all()
+
+    @property
+    def finished(self):
+        return self._finished
+
+    # -- Agent interface (via proxy) --
+
+    def register(self, hostname):
+        with self._lock:
+            agentId = "%s/%d" % (hostname, self._nextAgentId)
+            self._nextAgentId += 1
+            self._lastHeartbeat[agentId] = self._clock()
+        logging.info("Worker agent %s joined" % agentId)
+        return agentId
+
+    def unregister(self, agentId):
+        with self._lock:
+            self._dropAgent(agentId)
+        logging.info("Worker agent %s left" % agentId)
+
+    def runOptions(self):
+        return self._runOptions
+
+    def heartbeat(self, agentId):
+        with self._lock:
+            self._lastHeartbeat[agentId] = self._clock()
+            return not (self._closed or self._finished)
+
+    def getWork(self, agentId, timeout=1.0):
+        """
+        Lease the next work unit to the agent.  Returns (WORK, seq,
+        workUnit), or (WAIT, None, None) if there is nothing to do yet,
+        or (DONE, None, None) once the run is over.
+        """
+        with self._lock:
+            self.reapExpired()
+            self._lastHeartbeat[agentId] = self._clock()
+            if not self._pending and not (self._closed or self._finished):
+                self._lock.wait(timeout)
+            if self._closed or self._finished:
+                return (DONE, None, None)
+            if not self._pending:
+                return (WAIT, None, None)
+            seq, workUnit = self._pending.popleft()
+            self._leases[seq] = (agentId, workUnit, self._clock())
+            self._lock.notify_all()
+            return (WORK, seq, workUnit)
+
+    def complete(self, agentId, seq, result, stats=None):
+        """
+        Accept the result for a leased work unit, and the RunStats of
+        its computation.  Returns False if the result was dropped as a
+        duplicate.
+        """
+        with self._lock:
+            lease = self._leases.pop(seq, None)
+            if lease is None:
+                # Either the lease expired and the unit is back in the
+                # pending queue, or another agent has completed it.
+                requeued = [ item for item in self._pending if item[0] == seq ]
+                if not requeued:
+                    logging.debug("Dropping duplicate result from %s" % agentId)
+                    return False
+                self._pending.remove(requeued[0])
+                workUnit, leaseTime = requeued[0][1], None
+            else:
+                _, workUnit, leaseTime = lease
+            if self._closed:
+                return False
+            if stats is not None:
+                self._resultsQueue.put(stats)
+            self._resultsQueue.put(result)
+            if self._chunkLatency is not None and leaseTime is not None:
+                numChunks = len(workUnit) if isinstance(workUnit, list) else 1
+                self._chunkLatency.record((self._clock() - leaseTime) / numChunks)
+            self._finishIfComplete()
+            return True
+
+    def reportFailure(self, agentId, failure):
+        """
+        Forward a ChunkFailure from an agent's worker to the collector
+        """
+        with self._lock:
+            if self._closed or self._finished:
+                return
+            failure.workerName = "%s:%s" % (agentId, failure.workerName)
+            self._resultsQueue.put(failure)
+
+    def reapExpired(self):
+        """
+        Drop the agents whose heartbeats have stopped, requeueing
+        their work units.
+        """
+        with self._lock:
+            now = self._clock()
+            for agentId, lastHeartbeat in self._lastHeartbeat.items():
+                if now - lastHeartbeat > self._leaseTimeout:
+                    logging.warn("Worker agent %s has not been heard from in %d seconds" %
+                                 (agentId, now - lastHeartbeat))
+                    self._dropAgent(agentId)
+
+    # -- Internals (called with the lock held) --
+
+    def _dropAgent(self, agentId):
+        self._lastHeartbeat.pop(agentId, None)
+        orphaned = sorted(seq for (seq, lease) in self._leases.iteritems()
+                          if lease[0] == agentId)
+        if orphaned:
+            logging.info("Requeueing %d work units from agent %s" % (len(orphaned), agentId))
+        for seq in reversed(orphaned):
+            _, workUnit, _ = self._leases.pop(seq)
+            self._pending.appendleft((seq, workUnit))
+        self._lock.notify_all()
+
+    def _finishIfComplete(self):
+        if (self._inputFinished and not self._finished and
+            not self._pending and not self._leases):
+            self._finished = True
+            for i in xrange(self._numSentinels):
+                self._resultsQueue.put(None)
+            self._lock.notify_all()
+
+
+class _CoordinatorServerManager(BaseManager):
+    pass
+
+class _CoordinatorClientManager(BaseManager):
+    pass
+
+_EXPOSED = ("register", "unregister", "runOptions",
+            "heartbeat", "getWork", "complete", "reportFailure")
+
+_CoordinatorClientManager.register("coordinator", exposed=_EXPOSED)
+
+def serveCoordinator(coordinator, address, authkey):
+    """
+    Serve the coordinator from background threads in this process.
+    Returns the address actually bound (useful with port 0).
+    """
+    _CoordinatorServerManager.register("coordinator",
+                                       callable=lambda: coordinator,
+                                       exposed=_EXPOSED)
+    manager = _CoordinatorServerManager(address=address, authkey=authkey)
+    server = manager.get_server()
+
+    def reaper():
+        while not coordinator.finished:
+            time.sleep(HEARTBEAT_INTERVAL)
+            coordinator.reapExpired()
+
+    for target in (server.serve_forever, reaper):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+    return server.address
+
+def connectToCoordinator(address, authkey):
+    manager = _CoordinatorClientManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.coordinator()
+
+
+class WorkChannel(object):
+    """
+    Stands in for both the work queue and the results queue of a
+    Worker running under an agent, so that Worker._run is unchanged:
+    `get` leases a work unit from the coordinator and `put` returns
+    its result.  The connection is made lazily, in the worker process
+    itself, as manager proxies cannot be shared across a fork.
+    """
+    def __init__(self, address, authkey, agentId, pollInterval=1.0):
+        self._address = address
+        self._authkey = authkey
+        self._agentId = agentId
+        self._pollInterval = pollInterval
+        self._coordinator = None
+        self._seq = None
+
+    def get(self):
+        try:
+            if self._coordinator is None:
+                self._coordinator = connectToCoordinator(self._address, self._authkey)
+            while True:
+                status, seq, workUnit = self._coordinator.getWork(self._agentId,
+                                                                  self._pollInterval)
+                if status == WORK:
+                    self._seq = seq
+                    return workUnit
+                elif status == DONE:
+                    return None
+        except (EOFError, IOError, socket.error):
+            # The coordinator has gone away, which it does as soon as
+            # the run is complete.
+            logging.info("Lost connection to coordinator; finishing")
+            return None
+
+    def put(self, result):
+        if result is None or isinstance(result, WorkerHandoff):
+            # End-of-work sentinel or a retiring worker's handoff; the
+            # coordinator keeps its own count, and the agent replaces
+            # the worker.
+            return
+        try:
+            if isinstance(result, ChunkFailure):
+                self._coordinator.reportFailure(self._agentId, result)
+                return
+            if isinstance(result, RunStats):
+                # The worker's stats at the end of its work, which have
+                # already gone to the coordinator with its results
+                return
+            assert self._seq is not None
+            self._coordinator.complete(self._agentId, self._seq, result,
+                                       takeWorkerStats())
+        except (EOFError, IOError, socket.error):
+            pass
+        self._seq = None
@@ -0,0 +1,309 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# coverageIndex.py: read depth along each contig, from the alignment
+# index
+#
+# The depth along a contig is kept run-length encoded: a run of
+# constant depth starts at each position where a read starts or ends.
+# Alongside each run is the number of aligned bases before it (a prefix
+# sum of depth), so the aligned bases in any interval take two binary
+# searches.  Depth in a window, the intervals covered to a given depth,
+# and the aligned bases in a set of intervals are all answered by
+# slicing these arrays.
+#
+# The coverage index counts every read passing the run's filters, so
+# it answers questions about the input ("is this window covered?",
+# "how much work is in this chunk?").  The coverage reported for a
+# variant is that of the reads actually used for it, which is still
+# computed from those reads (coverageInWindow).  The intervals of a
+# window spanned by k reads (kSpannedIntervals) depend on where the
+# selected reads end, not just on depth, so they too are found from
+# the reads; the index only rules out windows too shallow to have any.
+#
+# With --readIndexSidecar the index for all contigs is kept in a .gccov
+# file next to the input, and memory-mapped by the workers and later
+# runs.  The file is a JSON header (contig table and fingerprint)
+# followed by the runs of all contigs as a single array of records.
+#
+
+import json, logging, numpy as np, os, os.path, struct, tempfile, weakref
+
+from .readIndex import readIndexFor, sidecarInput, sidecarFilename, sidecarFingerprint
+
+__all__ = [ "ContigCoverage",
+            "CoverageIndex",
+            "coverageIndexFor" ]
+
+RUN_DTYPE = np.dtype([ ("position",    "<i8"),
+                       ("basesBefore", "<i8"),
+                       ("depth",       "<i4"),
+                       ("_pad",        "<i4") ])
+
+GCCOV_MAGIC   = "GCCOV001"
+GCCOV_ALIGN   = 8
+
+class ContigCoverage(object):
+    """
+    Depth along one contig.  depth[i] is the depth over
+    [position[i], position[i+1]); the depth is zero before the first
+    position and from the last one on.
+    """
+    def __init__(self, runs):
+        self.position       = runs["position"]
+        self.basesBeforeRun = runs["basesBefore"]
+        self.depth          = runs["depth"]
+
+    @staticmethod
+    def runsFromReads(tStart, tEnd):
+        events   = np.concatenate((tStart, tEnd)).astype(np.int64)
+        deltas   = np.concatenate((np.ones(len(tStart), dtype=np.int64),
+                                   -np.ones(len(tEnd), dtype=np.int64)))
+        position, which = np.unique(events, return_inverse=True)
+        depth = np.cumsum(np.bincount(which, weights=deltas,
+                                      minlength=len(position))).astype(np.int64)
+        runs = np.zeros(len(position), dtype=RUN_DTYPE)
+        runs["position"] = position
+        runs["depth"]    = depth
+        if len(position):
+            runs["basesBefore"][1:] = np.cumsum(depth[:-1] * np.diff(position))
+        return runs
+
+    @classmethod
+    def fromReads(cls, tStart, tEnd):
+        return cls(cls.runsFromReads(tStart, tEnd))
+
+    def _runAt(self, positions):
+        # Index of the run containing each position; -1 before the first
+        return np.searchsorted(self.position, positions, side="right") - 1
+
+    def _lookup(self, values, positions):
+        # values[run] at each position, 0 before the first run
+        run = self._runAt(positions)
+        if not len(self.position):
+            return np.zeros(np.shape(positions), dtype=np.int64), run
+        return np.where(run >= 0, values[np.maximum(run, 0)], 0), run
+
+    def depthInWindow(self, start, end):
+        """
+        Depth at each position of [start, end), as an array
+        """
+        depth, _ = self._lookup(self.depth, np.arange(start, end))
+        return depth
+
+    def maxDepth(self, start, end):
+        if end <= start or not len(self.position):
+            return 0
+        first = max(self._runAt(start), 0)
+        last  = self._runAt(end - 1)
+        if last < 0:
+            return 0
+        return int(self.depth[first:last+1].max())
+
+    def basesBefore(self, x):
+        """
+        Aligned bases to the left of position(s) x
+        """
+        x = np.asarray(x, dtype=np.int64)
+        basesBeforeRun, run = self._lookup(self.basesBeforeRun, x)
+        depth, _ = self._lookup(self.depth, x)
+        runStart, _ = self._lookup(self.position, x)
+        return basesBeforeRun + depth * np.where(run >= 0, x - runStart, 0)
+
+    def alignedBases(self, intervals):
+        """
+        Aligned bases falling within each of the (start, end)
+        intervals, as an array
+        """
+        if len(intervals) == 0:
+            return np.zeros(0, dtype=np.int64)
+        starts, ends = map(np.array, zip(*intervals))
+        return self.basesBefore(ends) - self.basesBefore(starts)
+
+    def coveredIntervals(self, k, start, end):
+        """
+        The maximal intervals of [start, end) with depth at least k,
+        as a list of (start, end)
+        """
+        if not len(self.position):
+            return []
+        first = max(self._runAt(start), 0)
+        last  = self._runAt(end - 1)
+        if last < 0:
+            return []
+        covered = np.concatenate(([False], self.depth[first:last+1] >= k, [False]))
+        edges = np.flatnonzero(covered[1:] != covered[:-1])
+        intervals = []
+        bounds = np.append(self.position, np.iinfo(np.int64).max)
+        for runStart, runEnd in zip(edges[::2], edges[1::2]):
+            s = max(int(bounds[first + runStart]), start)
+            e = min(int(bounds[first + runEnd]), end)
+            if s < e:
+                intervals.append((s, e))
+        return intervals
+
+
+_EMPTY = ContigCoverage(np.zeros(0, dtype=RUN_DTYPE))
+
+class CoverageIndex(object):
+    """
+    Depth along every contig, for the reads passing the filters of a
+    ReadIndex.  Contigs are encoded as they are first used, unless the
+    whole index was loaded from (or built for) a sidecar file.
+    """
+    def __init__(self, readIndex, runs=None, contigTable=None):
+        self._readIndex = readIndex
+        self._runs = runs
+        self._contigTable = contigTable   # tId -> (offset, count) into runs
+        self._contigs = {}
+
+    @classmethod
+    def build(cls, readIndex):
+        """
+        Encode every contig at once (for saving)
+        """
+        allRuns, contigTable, offset = [], {}, 0
+        for tId, lo, hi in readIndex.contigSlices():
+            runs = ContigCoverage.runsFromReads(readIndex.tStart[lo:hi], readIndex.tEnd[lo:hi])
+            allRuns.append(runs)
+            contigTable[tId] = (offset, len(runs))
+            offset += len(runs)
+        runs = np.concatenate(allRuns) if allRuns else np.zeros(0, dtype=RUN_DTYPE)
+        return cls(readIndex, runs, contigTable)
+
+    def contig(self, refId):
+        coverage = self._contigs.get(refId)
+        if coverage is None:
+            if self._runs is not None:
+                offset, count = self._contigTable.get(self._readIndex.tIdOf(refId), (0, 0))
+                coverage = ContigCoverage(self._runs[offset:offset+count]) if count else _EMPTY
+            else:
+                contigReads = self._readIndex.contig(refId)
+                coverage = ContigCoverage.fromReads(contigReads.tStart, contigReads.tEnd)
+            self._contigs[refId] = coverage
+        return coverage
+
+    def depthInWindow(self, window):
+        refId, start, end = window
+        return self.contig(refId).depthInWindow(start, end)
+
+    def maxDepth(self, window):
+        refId, start, end = window
+        return self.contig(refId).maxDepth(start, end)
+
+    def coveredIntervals(self, window, k):
+        refId, start, end = window
+        return self.contig(refId).coveredIntervals(k, start, end)
+
+    #
+    # .gccov sidecar files
+    #
+
+    def save(self, filename, fingerprint):
+        header = json.dumps({ "fingerprint" : fingerprint,
+                              "contigs"     : [ [tId, offset, count] for (tId, (offset, count))
+                                                in sorted(self._contigTable.iteritems()) ] })
+        headerLength = len(GCCOV_MAGIC) + 4 + len(header)
+        padding = -headerLength % GCCOV_ALIGN
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpFilename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(GCCOV_MAGIC)
+                f.write(struct.pack("<I", len(header) + padding))
+                f.write(header + " " * padding)
+                f.write(self._runs.tostring())
+            os.rename(tmpFilename, filename)
+        except:
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+            raise
+
+    @classmethod
+    def load(cls, filename, readIndex, fingerprint):
+        """
+        The CoverageIndex in `filename`, memory-mapped, or None if
+        there is no such file or it was written for a different input
+        or filters.
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            with open(filename, "rb") as f:
+                if f.read(len(GCCOV_MAGIC)) != GCCOV_MAGIC:
+                    raise ValueError("not a .gccov file")
+                headerLength, = struct.unpack("<I", f.read(4))
+                header = json.loads(f.read(headerLength))
+            if header["fingerprint"] != json.loads(json.dumps(fingerprint)):
+                return None
+            offset = len(GCCOV_MAGIC) + 4 + headerLength
+            if os.path.getsize(filename) > offset:
+                runs = np.memmap(filename, dtype=RUN_DTYPE, mode="r", offset=offset)
+            else:
+                runs = np.zeros(0, dtype=RUN_DTYPE)
+        except Exception as e:
+            logging.warn("Ignoring unreadable coverage index %s (%s)" % (filename, e))
+            return None
+        contigTable = dict((tId, (offset, count)) for (tId, offset, count) in header["contigs"])
+        return cls(readIndex, runs, contigTable)
+
+
+_coverageIndices = weakref.WeakKeyDictionary()   # alnFile -> {(minMapQV, barcode): CoverageIndex}
+
+def _loadOrBuild(alnFile, minMapQV, barcode):
+    readIndex = readIndexFor(alnFile, minMapQV, barcode)
+    inputFilename = sidecarInput()
+    if inputFilename is None:
+        return CoverageIndex(readIndex)
+    filename = sidecarFilename(inputFilename, minMapQV, barcode, extension="gccov")
+    fingerprint = sidecarFingerprint(inputFilename, alnFile, minMapQV, barcode)
+    coverageIndex = CoverageIndex.load(filename, readIndex, fingerprint)
+    if coverageIndex is not None:
+        logging.debug("Loaded coverage index from %s" % filename)
+        return coverageIndex
+    coverageIndex = CoverageIndex.build(readIndex)
+    try:
+        coverageIndex.save(filename, fingerprint)
+        logging.info("Saved coverage index to %s" % filename)
+    except (IOError, OSError) as e:
+        logging.warn("Could not save coverage index to %s (%s)" % (filename, e))
+    return coverageIndex
+
+def coverageIndexFor(alnFile, minMapQV=0, barcode=None):
+    """
+    The CoverageIndex for the file and filters, created (or loaded
+    from the sidecar file) on first use.
+    """
+    byFilter = _coverageIndices.setdefault(alnFile, {})
+    key = (minMapQV, barcode)
+    if key not in byFilter:
+        byFilter[key] = _loadOrBuild(alnFile, minMapQV, barcode)
+    return byFilter[key]
@@ -0,0 +1,177 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+#
+# faults.py: per-chunk fault tolerance
+#
+# A chunk whose computation raises is not allowed to take the run down
+# with it.  The worker retries it once with a fallback configuration
+# (see Worker.onFallbackChunk) and, if that fails too, emits a no-call
+# consensus for it.  Each failed attempt is reported to the result
+# collector as a ChunkFailure, and the collector lists them in the
+# failure summary (--failureSummary) at the end of the run.
+#
+# A chunk that hangs is handled by the driver (--chunkTimeout).  Each
+# worker keeps the work unit it is processing, and since when, in a
+# ChunkWatch in shared memory.  When a chunk has run for too long the
+# driver kills the worker and starts a replacement, which redoes the
+# unit with the hung chunk at its next attempt (fallback, then
+# no-call).
+#
+# Killing a process that writes to a multiprocessing.Queue is only
+# safe if it is not part way through writing to the queue's pipe, and
+# has no object left for its feeder thread to write.  Under
+# --chunkTimeout the results queue is therefore a SynchronousQueue,
+# and the driver kills a worker only while holding the queue's write
+# lock.
+#
+
+import cPickle, json, time, Queue
+from contextlib import contextmanager
+from multiprocessing import Array, Value
+from multiprocessing.queues import Queue as MultiprocessingQueue
+
+__all__ = [ "MAX_ATTEMPTS",
+            "ChunkFailure",
+            "ChunkWatch",
+            "SynchronousQueue",
+            "writeFailureSummary" ]
+
+# Attempt 1 is the normal computation, attempt 2 the fallback; past
+# that the chunk gets a no-call
+MAX_ATTEMPTS = 2
+
+class ChunkFailure(object):
+    """
+    A failed attempt at a chunk, sent to the result collector
+    """
+    def __init__(self, window, attempt, error, workerName):
+        self.window     = window
+        self.attempt    = attempt
+        self.error      = error
+        self.workerName = workerName
+
+    @property
+    def outcome(self):
+        return "fallback" if self.attempt < MAX_ATTEMPTS else "noCall"
+
+    def toDict(self, windowToString=str):
+        return { "window"  : windowToString(self.window),
+                 "attempt" : self.attempt,
+                 "outcome" : self.outcome,
+                 "worker"  : self.workerName,
+                 "error"   : self.error }
+
+
+class ChunkWatch(object):
+    """
+    The work unit a worker is processing, the chunk within it and the
+    attempt at that chunk, and when the chunk was started.  Lives in
+    shared memory, so it must be constructed before the worker is
+    forked; the worker writes it and the driver reads it.
+    """
+    MAX_UNIT_BYTES = 65536
+
+    def __init__(self):
+        self._since   = Value("d", 0.0, lock=False)
+        self._index   = Value("i", 0, lock=False)
+        self._attempt = Value("i", 1, lock=False)
+        self._length  = Value("i", 0, lock=False)
+        self._unit    = Array("c", self.MAX_UNIT_BYTES, lock=False)
+
+    def beginUnit(self, unit, attempts):
+        """
+        `attempts`: {index in unit: attempt} for the chunks of a unit
+        being redone
+        """
+        pickled = cPickle.dumps((unit, attempts), cPickle.HIGHEST_PROTOCOL)
+        if len(pickled) > self.MAX_UNIT_BYTES:
+            self._length.value = -1
+        else:
+            self._unit[:len(pickled)] = pickled
+            self._length.value = len(pickled)
+
+    def beginChunk(self, index, attempt):
+        self._index.value = index
+        self._attempt.value = attempt
+        self._since.value = time.time()
+
+    def endChunk(self):
+        self._since.value = 0.0
+
+    def busySeconds(self, now):
+        since = self._since.value
+        return now - since if since else 0.0
+
+    def current(self):
+        """
+        (unit, attempts, index, attempt) for the chunk in progress, or
+        None if the unit was too large to record
+        """
+        length = self._length.value
+        if length < 0:
+            return None
+        unit, attempts = cPickle.loads(self._unit[:length])
+        return unit, attempts, self._index.value, self._attempt.value
+
+
+class SynchronousQueue(MultiprocessingQueue):
+    """
+    A multiprocessing.Queue whose put writes the object to the pipe
+    before returning, instead of leaving it to a feeder thread.  A
+    process that has returned from put, or is waiting to write, can be
+    killed without losing or corrupting anything, provided that no
+    process is writing at the time (see writesHeld).
+    """
+    def put(self, obj, block=True, timeout=None):
+        assert not self._closed
+        with self._wlock:
+            # The slot is taken under the write lock, so a writer
+            # killed while waiting for the lock holds none
+            if not self._sem.acquire(block, timeout):
+                raise Queue.Full
+            self._writer.send(obj)
+
+    @contextmanager
+    def writesHeld(self):
+        """
+        Keep all processes from writing to the queue: while this is
+        held, none is part way through writing an object
+        """
+        with self._wlock:
+            yield
+
+
+def writeFailureSummary(filename, failures, windowToString=str):
+    with open(filename, "w") as f:
+        json.dump([ failure.toDict(windowToString) for failure in failures ],
+                  f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,144 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# instrumentation.py: per-stage timers and counters
+#
+# The consensus hot paths time their stages (read fetch, clipping,
+# POA, polishing, ...) and count events (reads fetched, reads rejected
+# and why, mutations tested, ...) into the RunStats of the current
+# worker, with
+#
+#     with timed("polish"):
+#         ...
+#     count("readsFetched", len(alns))
+#
+# Each worker sends its RunStats to the result collector just before
+# its end-of-work sentinel (a worker under a remote agent sends them
+# with each result instead, see cluster.py); the collector merges
+# them and, with --runReport, writes the totals as a JSON run report.
+# The cost is a couple of clock reads and dictionary updates per
+# stage, so the instrumentation is always on.  With --traceFile, the
+# longer stages also appear in the trace timeline (see tracing.py).
+#
+
+import json, threading, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from .tracing import MIN_STAGE_SECONDS, traceSpan
+
+__all__ = [ "RunStats",
+            "workerStats",
+            "takeWorkerStats",
+            "timed",
+            "count",
+            "writeRunReport" ]
+
+class RunStats(object):
+    """
+    Seconds spent in and calls to each stage, and event counters
+    """
+    def __init__(self):
+        self.stageSeconds = defaultdict(float)
+        self.stageCalls   = defaultdict(int)
+        self.counters     = defaultdict(int)
+
+    def addTime(self, stage, seconds):
+        self.stageSeconds[stage] += seconds
+        self.stageCalls[stage] += 1
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def merge(self, other):
+        for stage, seconds in other.stageSeconds.iteritems():
+            self.stageSeconds[stage] += seconds
+        for stage, calls in other.stageCalls.iteritems():
+            self.stageCalls[stage] += calls
+        for name, n in other.counters.iteritems():
+            self.counters[name] += n
+
+    def toDict(self):
+        return { "stages"   : dict((stage, { "calls"   : self.stageCalls[stage],
+                                             "seconds" : round(seconds, 6) })
+                                   for (stage, seconds) in self.stageSeconds.iteritems()),
+                 "counters" : dict(self.counters) }
+
+    def summary(self):
+        return ", ".join("%s %.1fs" % (stage, seconds) for (stage, seconds)
+                         in sorted(self.stageSeconds.iteritems(), key=lambda kv: (-kv[1], kv[0])))
+
+
+_local = threading.local()
+
+def workerStats():
+    """
+    The RunStats of this worker (process or thread)
+    """
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        stats = _local.stats = RunStats()
+    return stats
+
+def takeWorkerStats():
+    """
+    The RunStats of this worker so far, which then starts afresh, for
+    sending the stats a piece at a time
+    """
+    stats = workerStats()
+    _local.stats = RunStats()
+    return stats
+
+@contextmanager
+def timed(stage):
+    stats = workerStats()
+    startTime = time.time()
+    try:
+        yield
+    finally:
+        endTime = time.time()
+        stats.addTime(stage, endTime - startTime)
+        if endTime - startTime >= MIN_STAGE_SECONDS:
+            traceSpan(stage, "stage", startTime, endTime)
+
+def count(name, n=1):
+    workerStats().count(name, n)
+
+def writeRunReport(filename, stats, **runInfo):
+    """
+    Write the stats, along with `runInfo` (algorithm, worker count,
+    wall time...), as JSON
+    """
+    report = dict(runInfo)
+    report.update(stats.toDict())
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,120 @@
+#################################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# FASTA/FASTQ writers that accept a record's sequence in pieces, so
+# that a contig-sized record never has to be held in memory.  The
+# output is byte-identical to that of pbcore's FastaWriter (60-column
+# lines) and FastqWriter (single-line sequence and quality).
+#
+# A FASTQ record's quality line follows its complete sequence line,
+# so the quality string is spilled to a temporary file until the
+# record is ended.
+#
+
+import gzip, numpy as np, shutil, tempfile
+
+__all__ = [ "StreamingFastaWriter",
+            "StreamingFastqWriter" ]
+
+def _openOutput(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "wb")
+    else:
+        return open(filename, "w")
+
+class StreamingFastaWriter(object):
+
+    COLUMNS = 60
+
+    def __init__(self, filename):
+        self.file = _openOutput(filename)
+        self._column = None
+
+    def beginRecord(self, header):
+        assert self._column is None, "Record already in progress"
+        self.file.write(">%s\n" % header)
+        self._column = 0
+
+    def extend(self, sequence):
+        pos = 0
+        while pos < len(sequence):
+            if self._column == self.COLUMNS:
+                self.file.write("\n")
+                self._column = 0
+            n = min(self.COLUMNS - self._column, len(sequence) - pos)
+            self.file.write(sequence[pos:pos+n])
+            self._column += n
+            pos += n
+
+    def endRecord(self):
+        self.file.write("\n")
+        self._column = None
+
+    def writeRecord(self, header, sequence):
+        self.beginRecord(header)
+        self.extend(sequence)
+        self.endRecord()
+
+    def close(self):
+        self.file.close()
+
+
+class StreamingFastqWriter(object):
+
+    def __init__(self, filename):
+        self.file = _openOutput(filename)
+        self._qualities = None
+
+    def beginRecord(self, header):
+        assert self._qualities is None, "Record already in progress"
+        self.file.write("@%s\n" % header)
+        self._qualities = tempfile.TemporaryFile()
+
+    def extend(self, sequence, quality):
+        assert len(sequence) == len(quality)
+        self.file.write(sequence)
+        self._qualities.write((np.asarray(quality, dtype=np.uint8) + 33).tostring())
+
+    def endRecord(self):
+        self.file.write("\n+\n")
+        self._qualities.seek(0)
+        shutil.copyfileobj(self._qualities, self.file)
+        self.file.write("\n")
+        self._qualities.close()
+        self._qualities = None
+
+    def writeRecord(self, header, sequence, quality):
+        self.beginRecord(header)
+        self.extend(sequence, quality)
+        self.endRecord()
+
+    def close(self):
+        self.file.close()
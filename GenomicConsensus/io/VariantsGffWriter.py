@@ -92,5 +92,9 @@ class VariantsGffWriter(object):
         for var in variants:
             self._gffWriter.writeRecord(toGffRecord(var))
 
+    def writeRecords(self, records):
+        for record in records:
+            self._gffWriter.writeRecord(record)
+
     def close(self):
         self._gffWriter.close()
@@ -32,4 +32,5 @@
 
 from __future__ import absolute_import
 from .VariantsGffWriter import VariantsGffWriter
+from .StreamingFastxWriters import *
 from .utils import *
@@ -34,7 +34,8 @@
 from __future__ import absolute_import
 
 import argparse, atexit, cProfile, gc, glob, h5py, logging, multiprocessing
-import os, pstats, random, shutil, tempfile, time, threading, Queue, traceback
+import os, random, shutil, socket, tempfile, time, threading, Queue, traceback
+import cPickle
 import functools
 import re
 import sys
@@ -46,6 +47,25 @@ from pbcommand.cli import pbparser_runner
 from pbcore.io import AlignmentSet, ContigSet
 
 from GenomicConsensus import reference
+from GenomicConsensus.cluster import (Coordinator, WorkChannel,
+                                      authkeyFromEnvironment,
+                                      connectToCoordinator,
+                                      parseAddress, serveCoordinator,
+                                      AUTHKEY_ENVIRONMENT_VARIABLE,
+                                      HEARTBEAT_INTERVAL)
+from GenomicConsensus import scatter
+from GenomicConsensus.checkpoint import CheckpointJournal, runFingerprint
+from GenomicConsensus.readIndex import setSidecarInput
+from GenomicConsensus.Worker import Worker
+from GenomicConsensus.faults import ChunkFailure, SynchronousQueue
+from GenomicConsensus.progress import WorkerActivity
+from GenomicConsensus.profiling import (mergeProfiles, writeProfileReport,
+                                        mergeSamples, sampledStacks)
+from GenomicConsensus.tracing import (startTracing, stopTracing, traceSpan,
+                                      mergeTraces)
+from GenomicConsensus.batching import (ChunkLatencyEstimate,
+                                       adaptiveBatchSize,
+                                       batched)
 from GenomicConsensus.options import (options, Constants,
                                       get_parser,
                                       processOptions,
@@ -69,6 +89,9 @@ class ToolRunner(object):
         self._slaves = None
         self._algorithm = None
         self._algorithmConfiguration = None
+        self._chunkLatency = None
+        self._activity = None
+        self._completedWindows = set()
         self._aborting = False
 
     def _makeTemporaryDirectory(self):
@@ -78,6 +101,13 @@ class ToolRunner(object):
         options.temporaryDirectory = tempfile.mkdtemp(prefix="GenomicConsensus-", dir="/tmp")
         logging.info("Created temporary directory %s" % (options.temporaryDirectory,) )
 
+    def _makeResultShardDirectory(self):
+        options.resultShardDirectory = tempfile.mkdtemp(prefix="GenomicConsensus-shards-")
+        logging.info("Worker results will be written to %s" % options.resultShardDirectory)
+
+    def _makeTraceDirectory(self):
+        options.traceDirectory = tempfile.mkdtemp(prefix="GenomicConsensus-trace-")
+
     def _algorithmByName(self, name, peekFile):
         if name == "plurality":
             from GenomicConsensus.plurality import plurality
@@ -125,24 +155,75 @@ class ToolRunner(object):
 
         WorkerType, ResultCollectorType = self._algorithm.slaveFactories(options.threaded)
         self._slaves = []
-        for i in xrange(options.numWorkers):
-            p = WorkerType(self._workQueue, self._resultsQueue, self._algorithmConfiguration)
-            self._slaves.append(p)
-            p.start()
-        logging.info("Launched compute slaves.")
-
-        rcp = ResultCollectorType(self._resultsQueue, self._algorithm.name, self._algorithmConfiguration)
+        if options.coordinatorAddress:
+            self._launchCoordinator()
+        else:
+            self._makeWorker = functools.partial(WorkerType, self._workQueue, self._resultsQueue,
+                                                 self._algorithmConfiguration,
+                                                 self._chunkLatency, self._activity)
+            for i in xrange(options.numWorkers):
+                p = self._makeWorker()
+                self._slaves.append(p)
+                p.start()
+            logging.info("Launched compute slaves.")
+
+        rcp = ResultCollectorType(self._resultsQueue, self._algorithm.name, self._algorithmConfiguration,
+                                  self._activity)
         rcp.start()
         self._slaves.append(rcp)
         logging.info("Launched collector slave.")
 
+    def _launchCoordinator(self):
+        """
+        Replace the work queue by a Coordinator, serving the work units
+        to remote worker agents (see cluster.py).
+        """
+        authkey = authkeyFromEnvironment()
+        if not authkey:
+            die("Failure: coordinator mode requires the %s environment variable" %
+                AUTHKEY_ENVIRONMENT_VARIABLE)
+        if options.threaded:
+            die("Failure: coordinator mode cannot be used with -T (threaded) mode")
+        self._workQueue = Coordinator(self._resultsQueue,
+                                      options.numWorkers,
+                                      self._agentOptions(),
+                                      maxPending=options.queueSize,
+                                      chunkLatency=self._chunkLatency)
+        address = serveCoordinator(self._workQueue,
+                                   parseAddress(options.coordinatorAddress),
+                                   authkey)
+        logging.info("Serving work to worker agents at %s:%d" % address)
+
+    def _agentOptions(self):
+        """
+        The options to be adopted by worker agents: everything in the
+        options namespace that can be sent over the wire.
+        """
+        agentOptions = {}
+        for name, value in vars(options).iteritems():
+            try:
+                cPickle.dumps(value)
+                agentOptions[name] = value
+            except Exception:
+                pass
+        agentOptions["algorithm"] = self._algorithm.name
+        return agentOptions
+
     def _initQueues(self):
         if options.threaded:
             self._workQueue = Queue.Queue(options.queueSize)
             self._resultsQueue = Queue.Queue(options.queueSize)
         else:
             self._workQueue = multiprocessing.Queue(options.queueSize)
-            self._resultsQueue = multiprocessing.Queue(options.queueSize)
+            if options.chunkTimeout:
+                # Workers may be killed (see killHungWorkers)
+                self._resultsQueue = SynchronousQueue(options.queueSize)
+            else:
+                self._resultsQueue = multiprocessing.Queue(options.queueSize)
+        if options.maxChunksPerBatch > 1:
+            self._chunkLatency = ChunkLatencyEstimate()
+        if (options.progressFile or options.prometheusFile) and not options.coordinatorAddress:
+            self._activity = WorkerActivity(options.numWorkers)
 
     def _readAlignmentInput(self):
         """
@@ -197,39 +278,107 @@ class ToolRunner(object):
         except IncompatibleDataException as e:
             die("Failure: %s" % e.message)
 
-    def _mainLoop(self):
-        # Split up reference genome into chunks and farm out the
-        # a chunk as a unit of work.
-        logging.debug("Starting main loop.")
+    def _enumerateChunks(self):
         ids = reference.enumerateIds(options.referenceWindows)
         for _id in ids:
-            if options.fancyChunking:
+            if options.pluralitySweep:
+                # Coverage cutouts are handled within the sweep
+                if options.sweepBlockSize > 0:
+                    chunks = reference.enumerateChunks(_id,
+                                                       options.sweepBlockSize,
+                                                       options.referenceWindows)
+                else:
+                    chunks = (reference.WorkChunk(span, True) for span in
+                              reference.enumerateSpans(_id, options.referenceWindows))
+            elif options.fancyChunking:
                 chunks = reference.fancyEnumerateChunks(self._inAlnFile,
                                                         _id,
                                                         options.referenceChunkSize,
                                                         options.minCoverage,
                                                         options.minMapQV,
-                                                        options.referenceWindows)
+                                                        options.referenceWindows,
+                                                        maxCoverage=options.coverage)
             else:
                 chunks = reference.enumerateChunks(_id,
                                                    options.referenceChunkSize,
                                                    options.referenceWindows)
             for chunk in chunks:
-                if self._aborting: return
-                self._workQueue.put(chunk)
+                if chunk.window not in self._completedWindows:
+                    yield chunk
+
+    def _batchSize(self):
+        if options.carryDraft:
+            # Drafts are carried between the chunks of a batch, so the
+            # batches must not depend on timing
+            return options.maxChunksPerBatch
+        return adaptiveBatchSize(self._chunkLatency,
+                                 options.targetBatchSeconds,
+                                 options.maxChunksPerBatch)
+
+    def _scheduledChunks(self):
+        if options.chunkOrdering == "cost":
+            if not options.fancyChunking:
+                logging.warn("Cost-ordered chunk scheduling requires adaptive chunking; " +
+                             "using genome order")
+                return self._enumerateChunks()
+            logging.info("Estimating chunk costs")
+            return reference.costOrderedChunks(self._enumerateChunks(),
+                                              options.costOrderingLookahead)
+        else:
+            return self._enumerateChunks()
+
+    def _mainLoop(self):
+        # Split up reference genome into chunks and farm out the
+        # a chunk (or a batch of contiguous chunks) as a unit of work.
+        logging.debug("Starting main loop.")
+        chunks = self._scheduledChunks()
+        if self._chunkLatency is not None:
+            workUnits = batched(chunks, self._batchSize)
+        else:
+            workUnits = chunks
+        for workUnit in workUnits:
+            if self._aborting: return
+            numChunks = len(workUnit) if isinstance(workUnit, list) else 1
+            startTime = time.time()
+            self._workQueue.put(workUnit)
+            traceSpan("putWork", "queue", startTime, time.time(), chunks=numChunks)
+            if self._activity is not None:
+                self._activity.recordDispatch(numChunks)
 
         # Write sentinels ("end-of-work-stream")
         for i in xrange(options.numWorkers):
             self._workQueue.put(None)
 
-    def _printProfiles(self):
-        for profile in glob.glob(os.path.join(options.temporaryDirectory, "*")):
-            pstats.Stats(profile).sort_stats("time").print_stats(20)
+    def _loadCheckpoint(self):
+        journal = CheckpointJournal(options.checkpointDir,
+                                    runFingerprint(options, self._algorithm.name))
+        err = journal.validate()
+        if err:
+            die("Failure: %s" % err)
+        self._completedWindows = journal.completedWindows()
+        if self._completedWindows:
+            logging.info("Resuming from checkpoint in %s: %d windows already completed" %
+                         (options.checkpointDir, len(self._completedWindows)))
+
+    def _reportProfiles(self):
+        stats = mergeProfiles(glob.glob(os.path.join(options.temporaryDirectory,
+                                                     "profile-*.out")))
+        if stats is None:
+            logging.warn("No profiles were written")
+        elif options.profileOutput:
+            writeProfileReport(stats, options.profileOutput)
+        else:
+            stats.sort_stats("time").print_stats(20)
 
     def _cleanup(self):
-        if options.doProfiling:
+        if options.doProfiling or options.sampleProfile:
             logging.info("Removing %s" % options.temporaryDirectory)
             shutil.rmtree(options.temporaryDirectory, ignore_errors=True)
+        if options.resultShards:
+            logging.info("Removing %s" % options.resultShardDirectory)
+            shutil.rmtree(options.resultShardDirectory, ignore_errors=True)
+        if options.traceFile:
+            shutil.rmtree(options.traceDirectory, ignore_errors=True)
 
     def _setupEvidenceDumpDirectory(self, directoryName):
         if os.path.exists(directoryName):
@@ -256,6 +405,59 @@ class ToolRunner(object):
     def slaves(self):
         return self._slaves
 
+    def killHungWorkers(self):
+        """
+        Kill each worker that has spent more than --chunkTimeout
+        seconds on a chunk, and start a replacement to redo its work
+        unit, with the hung chunk at its next attempt.
+
+        The results queue is a SynchronousQueue, so a worker has no
+        result waiting in a feeder thread, and the worker is killed
+        with the queue's writes held, so it is not part way through
+        writing one.  (Taking the write lock waits out any write
+        blocked on a full queue, hence the second look at the clock.)
+        """
+        for i, p in enumerate(self._slaves):
+            if not isinstance(p, Worker) or p.chunkWatch is None:
+                continue
+            if p.chunkWatch.busySeconds(time.time()) <= options.chunkTimeout:
+                continue
+            with self._resultsQueue.writesHeld():
+                if p.chunkWatch.busySeconds(time.time()) <= options.chunkTimeout:
+                    continue
+                current = p.chunkWatch.current()
+                p.terminate()
+                p.join()
+            p.releaseActivitySlot()
+            if current is None:
+                self.abortWork("%s timed out on a work unit too large to be retried" % p.name)
+                return
+            unit, attempts, index, attempt = current
+            chunk = unit[index] if isinstance(unit, list) else unit
+            failure = ChunkFailure(chunk.window, attempt,
+                                   "Timed out after %g seconds" % options.chunkTimeout, p.name)
+            logging.warn("%s timed out on %s (attempt %d; next: %s); replacing it" %
+                         (p.name, reference.windowToString(chunk.window), attempt,
+                          failure.outcome))
+            self._resultsQueue.put(failure)
+            attempts = dict(attempts)
+            attempts[index] = attempt + 1
+            replacement = self._makeWorker(retry=(unit, attempts))
+            replacement.start()
+            self._slaves[i] = replacement
+
+    def replaceRetiredWorkers(self):
+        """
+        Start a fresh worker in place of each one that has retired
+        (--maxChunksPerWorker, --maxWorkerRss) and exited.
+        """
+        for i, p in enumerate(self._slaves):
+            if isinstance(p, Worker) and p.retired and p.exitcode == 0:
+                replacement = self._makeWorker()
+                replacement.start()
+                self._slaves[i] = replacement
+                logging.info("Started %s in place of retired %s" % (replacement.name, p.name))
+
     def main(self):
 
         # This looks scary but it's not.  Python uses reference
@@ -290,9 +492,25 @@ class ToolRunner(object):
                      (consensusCore2Version() or "ConsensusCore2 unavailable"))
         logging.info("Starting.")
 
+        if options.resultShards and options.coordinatorAddress:
+            die("Failure: --resultShards cannot be used with --coordinatorAddress")
+
+        if options.readIndexSidecar:
+            setSidecarInput(options.inputFilename)
+
         atexit.register(self._cleanup)
-        if options.doProfiling:
+        if options.sampleProfile and options.threaded:
+            die("Failure: --sampleProfile cannot be used with -T (threaded) mode")
+        if (options.maxChunksPerWorker or options.maxWorkerRss) and options.threaded:
+            die("Failure: --maxChunksPerWorker and --maxWorkerRss cannot be used with -T (threaded) mode")
+        if options.chunkTimeout and options.threaded:
+            die("Failure: --chunkTimeout cannot be used with -T (threaded) mode")
+        if options.doProfiling or options.sampleProfile:
             self._makeTemporaryDirectory()
+        if options.resultShards:
+            self._makeResultShardDirectory()
+        if options.traceFile:
+            self._makeTraceDirectory()
 
         with AlignmentSet(options.inputFilename) as peekFile:
             if options.algorithm == "arrow" and peekFile.isCmpH5:
@@ -307,6 +525,12 @@ class ToolRunner(object):
             self._checkFileCompatibility(peekFile)
             self._algorithm = self._algorithmByName(options.algorithm, peekFile)
             self._configureAlgorithm(options, peekFile)
+            if options.pluralitySweep and self._algorithm.name != "plurality":
+                die("Failure: --pluralitySweep is only supported by the plurality algorithm")
+            if options.variantsOnly and self._algorithm.name not in ("arrow", "quiver"):
+                die("Failure: --variantsOnly is only supported by the arrow and quiver algorithms")
+            if options.checkpointDir:
+                self._loadCheckpoint()
             options.disableHdf5ChunkCache = True
             #options.disableHdf5ChunkCache = self._shouldDisableChunkCache(peekFile)
             #if options.disableHdf5ChunkCache:
@@ -322,25 +546,34 @@ class ToolRunner(object):
         monitoringThread = threading.Thread(target=monitorSlaves, args=(self,))
         monitoringThread.start()
 
+        if options.traceFile:
+            startTracing(options.traceDirectory, "driver")
+        samplesFilename = None
+        if options.sampleProfile:
+            samplesFilename = os.path.join(options.temporaryDirectory, "samples-main.folded")
         try:
-            if options.doProfiling:
-                cProfile.runctx("self._mainLoop()",
-                                globals=globals(),
-                                locals=locals(),
-                                filename=os.path.join(options.temporaryDirectory,
-                                                      "profile-main.out"))
-
-            elif options.pdb:
-                with ipdb.launch_ipdb_on_exception():
+            with sampledStacks(samplesFilename, options.sampleInterval / 1000.):
+                if options.doProfiling:
+                    cProfile.runctx("self._mainLoop()",
+                                    globals=globals(),
+                                    locals=locals(),
+                                    filename=os.path.join(options.temporaryDirectory,
+                                                          "profile-main.out"))
+
+                elif options.pdb:
+                    with ipdb.launch_ipdb_on_exception():
+                        self._mainLoop()
+
+                else:
                     self._mainLoop()
-
-            else:
-                self._mainLoop()
         except:
             why = traceback.format_exc()
             self.abortWork(why)
 
+        stopTracing()
         monitoringThread.join()
+        if options.traceFile:
+            mergeTraces(options.traceDirectory, options.traceFile)
 
         if self._aborting:
             logging.error("Aborting")
@@ -349,12 +582,103 @@ class ToolRunner(object):
             logging.info("Finished.")
 
         if options.doProfiling:
-            self._printProfiles()
+            self._reportProfiles()
+        if options.sampleProfile:
+            mergeSamples(glob.glob(os.path.join(options.temporaryDirectory, "samples-*.folded")),
+                         options.sampleProfile)
 
         # close h5 file.
         self._inAlnFile.close()
         return 0
 
+class WorkerAgentRunner(ToolRunner):
+    """
+    Driver for a worker agent (variantCaller --worker-agent): adopts
+    the options of the run being coordinated at `address`, then runs
+    local compute workers against the coordinator until the run is
+    over or the agent is interrupted.
+    """
+    def __init__(self, address, authkey, numWorkers):
+        super(WorkerAgentRunner, self).__init__()
+        self._address = address
+        self._authkey = authkey
+        self._numWorkers = numWorkers
+
+    def main(self):
+        gc.disable()
+        try:
+            coordinator = connectToCoordinator(self._address, self._authkey)
+            runOptions = coordinator.runOptions()
+        except (EOFError, IOError, socket.error) as e:
+            die("Failure: cannot connect to coordinator at %s:%d (%s)" %
+                (self._address + (e,)))
+        options.__dict__.update(runOptions)
+        options.numWorkers = self._numWorkers
+        # The driver's output paths for traces and profiles are not
+        # for agents; --profile reports the agent's profile locally
+        options.traceFile = None
+        options.profileOutput = None
+        options.sampleProfile = None
+        # Hung workers are only detected by the driver, for its own
+        # workers (the work unit of an agent's worker is not ours to
+        # redo)
+        options.chunkTimeout = 0
+        if options.doProfiling:
+            self._makeTemporaryDirectory()
+        atexit.register(self._cleanup)
+
+        with AlignmentSet(options.inputFilename) as peekFile:
+            self._loadReference(peekFile)
+            self._algorithm = self._algorithmByName(options.algorithm, peekFile)
+            self._configureAlgorithm(options, peekFile)
+
+        agentId = coordinator.register(socket.gethostname())
+        logging.info("Joined run as worker agent %s" % agentId)
+        WorkerType, _ = self._algorithm.slaveFactories(False)
+        channel = WorkChannel(self._address, self._authkey, agentId)
+        self._makeWorker = functools.partial(WorkerType, channel, channel,
+                                             self._algorithmConfiguration)
+        self._slaves = []
+        for i in xrange(options.numWorkers):
+            p = self._makeWorker()
+            self._slaves.append(p)
+            p.start()
+        logging.info("Launched compute slaves.")
+
+        exitcode = 0
+        lastHeartbeat = time.time()
+        try:
+            while True:
+                self.replaceRetiredWorkers()
+                nonzero_exits = [p.exitcode for p in self._slaves if p.exitcode]
+                if nonzero_exits:
+                    exitcode = nonzero_exits[0]
+                    logging.error("Child process exited with exitcode=%d.  Leaving run." % exitcode)
+                    break
+                if all(not p.is_alive() for p in self._slaves):
+                    break
+                if time.time() - lastHeartbeat > HEARTBEAT_INTERVAL:
+                    coordinator.heartbeat(agentId)
+                    lastHeartbeat = time.time()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logging.info("Interrupted.  Leaving run.")
+        except (EOFError, IOError, socket.error):
+            logging.info("Lost connection to coordinator.")
+        finally:
+            for p in self._slaves:
+                if p.is_alive():
+                    p.terminate()
+            try:
+                # Hand back any work units still leased to us
+                coordinator.unregister(agentId)
+            except (EOFError, IOError, socket.error):
+                pass
+        if options.doProfiling:
+            self._reportProfiles()
+        logging.info("Finished.")
+        return exitcode
+
 def monitorSlaves(driver):
     """
     Promptly aborts if a child is found to have exited with a nonzero
@@ -364,6 +688,11 @@ def monitorSlaves(driver):
     Windows.
     """
     while not driver.aborting:
+        # A worker that retired early or hung is not done: replace it
+        # before checking whether everything has exited
+        if options.chunkTimeout:
+            driver.killHungWorkers()
+        driver.replaceRetiredWorkers()
         all_exited = all(not p.is_alive() for p in driver.slaves)
         nonzero_exits = [p.exitcode for p in driver.slaves if p.exitcode]
         if nonzero_exits:
@@ -411,7 +740,116 @@ def resolved_tool_contract_runner(resolved_contract):
         ds.write(dataset_path)
     return rc
 
+def _setupStandaloneLogging(args):
+    level = (logging.DEBUG if args.debug else
+             logging.INFO if args.verbose else logging.WARN)
+    setup_log(logging.getLogger(), level=level, str_formatter=LogFormats.LOG_FMT_LVL)
+
+def worker_agent_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="variantCaller --worker-agent",
+        description="Run compute workers for a variantCaller run in coordinator " + \
+                    "mode (--coordinatorAddress).  The environment variable "     + \
+                    "%s must be set to the coordinator's key." % AUTHKEY_ENVIRONMENT_VARIABLE)
+    parser.add_argument("--worker-agent", "--workerAgent",
+                        dest="address", required=True, metavar="HOST:PORT",
+                        help="Address of the coordinating variantCaller")
+    parser.add_argument("-j", "--numWorkers", dest="numWorkers", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="The number of worker processes to run on this host")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+    _setupStandaloneLogging(args)
+    authkey = authkeyFromEnvironment()
+    if not authkey:
+        parser.error("the %s environment variable must be set" % AUTHKEY_ENVIRONMENT_VARIABLE)
+    try:
+        address = parseAddress(args.address)
+    except ValueError as e:
+        parser.error(str(e))
+    return WorkerAgentRunner(address, authkey, args.numWorkers).main()
+
+def scatter_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="variantCaller --scatter",
+        description="Write a plan dividing the reference contigs among N shards, " + \
+                    "balanced by aligned bases.  Run each shard with its "        + \
+                    "referenceWindows as the -w argument, then merge the outputs " + \
+                    "with variantCaller --gather.")
+    parser.add_argument("--scatter", dest="numShards", type=int, required=True, metavar="N")
+    parser.add_argument("inputFilename", help="The input alignments (with .pbi index)")
+    parser.add_argument("--referenceFilename", "--reference", "-r", required=True)
+    parser.add_argument("--outputFilename", "-o", required=True,
+                        help="The shard plan (JSON) to write")
+    parser.add_argument("--minMapQV", "-m", type=int, default=Constants.DEFAULT_MIN_MAPQV,
+                        help="Count only the aligned bases of reads with this MapQV or better")
+    parser.add_argument("--readIndexSidecar", action="store_true",
+                        help="Keep the partitioned alignment index in a sidecar file next " + \
+                             "to the input, for reuse by the shard runs")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+    _setupStandaloneLogging(args)
+    if args.readIndexSidecar:
+        setSidecarInput(args.inputFilename)
+    if args.numShards < 1:
+        parser.error("--scatter requires a positive number of shards")
+
+    with AlignmentSet(args.inputFilename) as alnFile:
+        if not alnFile.isCmpH5 and not alnFile.hasPbi:
+            die("Failure: scatter requires BAM files with accompanying .pbi files")
+        if reference.loadFromFile(args.referenceFilename, alnFile):
+            die("Error loading reference")
+        contigs = scatter.alignedBasesByContig(alnFile, reference.byName.values(),
+                                               args.minMapQV)
+    shards = scatter.planShards(contigs, args.numShards)
+    scatter.writePlan(args.outputFilename, shards, contigs,
+                      args.inputFilename, args.referenceFilename)
+    for i, shard in enumerate(shards):
+        logging.info("Shard %d: %d contigs, %d aligned bases" %
+                     (i, len(shard), sum(c.alignedBases for c in shard)))
+    return 0
+
+def gather_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="variantCaller --gather",
+        description="Merge the outputs of the shards of a --scatter plan, in "  + \
+                    "reference order.")
+    parser.add_argument("--gather", dest="planFilename", required=True, metavar="PLAN",
+                        help="The shard plan written by --scatter")
+    parser.add_argument("--outputFilename", "-o", dest="outputFilenames",
+                        action="append", required=True,
+                        help="A merged output (.fasta, .fastq or .gff) to write")
+    parser.add_argument("shardOutputs", nargs="+",
+                        help="The FASTA, FASTQ and GFF outputs of the shards")
+    parser.add_argument("--verbose", "-v", action="store_true")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args(argv)
+    _setupStandaloneLogging(args)
+
+    try:
+        plan = scatter.readPlan(args.planFilename)
+        optionsDict = { "shellCommand"      : " ".join(sys.argv),
+                        "inputFilename"     : plan["inputFilename"],
+                        "referenceFilename" : plan["referenceFilename"] }
+        scatter.gather(plan, args.outputFilenames, args.shardOutputs, optionsDict)
+    except (IOError, ValueError) as e:
+        die("Failure: %s" % e)
+    return 0
+
+def _hasFlag(argv, *flags):
+    return any(arg.split("=")[0] in flags for arg in argv)
+
 def main(argv=sys.argv):
+    # The scatter/gather and worker agent modes have their own
+    # (much smaller) command lines
+    if _hasFlag(argv[1:], "--scatter"):
+        return scatter_main(argv[1:])
+    if _hasFlag(argv[1:], "--gather"):
+        return gather_main(argv[1:])
+    if _hasFlag(argv[1:], "--worker-agent", "--workerAgent"):
+        return worker_agent_main(argv[1:])
     setup_log_ = functools.partial(setup_log,
         str_formatter=LogFormats.LOG_FMT_LVL)
     return pbparser_runner(
@@ -189,6 +189,65 @@ def add_options_to_argument_parser(parser):
         type=int,
         default=1,
         help="The number of worker processes to be used")
+    parallelism.add_argument(
+        "--maxChunksPerBatch",
+        dest="maxChunksPerBatch",
+        type=int,
+        default=1,
+        help="Send up to this many contiguous reference chunks to a worker in a single " + \
+             "message, reducing queue overhead when running many workers.  The batch " + \
+             "size adapts to the measured per-chunk processing time.  (Default: 1, " + \
+             "no batching)")
+    parallelism.add_argument(
+        "--targetBatchSeconds",
+        dest="targetBatchSeconds",
+        type=float,
+        default=1.0,
+        help="Approximate processing time to aim for when sizing chunk batches " + \
+             "(see --maxChunksPerBatch)")
+    parallelism.add_argument(
+        "--chunkOrdering",
+        dest="chunkOrdering",
+        choices=["genome", "cost"],
+        default="genome",
+        help="Order in which reference chunks are dispatched to workers.  'cost' "    + \
+             "dispatches the chunks with the most aligned bases first, improving "     + \
+             "load balance when coverage is very uneven.  Chunks are only reordered "  + \
+             "within blocks of --costOrderingLookahead chunks.")
+    parallelism.add_argument(
+        "--costOrderingLookahead",
+        dest="costOrderingLookahead",
+        type=int,
+        default=1000,
+        metavar="CHUNKS",
+        help="With --chunkOrdering=cost, reorder chunks only within successive "  + \
+             "blocks of this many chunks in genome order.  Output is written in "   + \
+             "genome order, so chunks finished ahead of their turn are held in "     + \
+             "memory until the chunks before them are done; this bounds how many " + \
+             "are held.  0 sorts the whole genome at once, which can hold most "    + \
+             "of the results in memory.  (Default: 1000)")
+
+    parallelism.add_argument(
+        "--readCacheSize",
+        dest="readCacheSize",
+        type=int,
+        default=0,
+        metavar="MB",
+        help="Size of each worker's cache of decoded reads, which saves decoding a "  + \
+             "read again for each reference chunk it overlaps.  Most effective "       + \
+             "with --maxChunksPerBatch (100 is a reasonable size).  0 (the default) " + \
+             "disables the cache.")
+    parallelism.add_argument(
+        "--coordinatorAddress",
+        dest="coordinatorAddress",
+        type=str,
+        default=None,
+        metavar="HOST:PORT",
+        help="Instead of launching local workers, serve the work over the network "   + \
+             "at this address to worker agents started on any number of hosts with "  + \
+             "'variantCaller --worker-agent HOST:PORT'.  Agents may join and leave "   + \
+             "during the run.  The environment variable GENOMICCONSENSUS_AUTHKEY "     + \
+             "must be set to the same secret for the driver and the agents.")
 
     filtering = parser.add_argument_group("Output filtering")
     filtering.add_argument(
@@ -340,6 +399,76 @@ def add_options_to_argument_parser(parser):
              "case the best available model is chosen.  Default is 'auto', " + \
              "which selects the best parameter set from the alignment data")
 
+    algorithm.add_argument(
+        "--pluralitySweep",
+        dest="pluralitySweep",
+        action="store_true",
+        default=False,
+        help="Plurality only: instead of fetching the reads for each reference chunk, "  + \
+             "sweep through each block of the reference (see --sweepBlockSize) in a "    + \
+             "single pass, decoding each read once.  Much faster for long reads.")
+    algorithm.add_argument(
+        "--sweepBlockSize",
+        dest="sweepBlockSize",
+        type=int,
+        default=1000000,
+        help="Size of the reference blocks swept by a worker under --pluralitySweep; " + \
+             "blocks are the unit of work distributed among the workers.  0 sweeps "    + \
+             "each contig (or requested window) whole.")
+    algorithm.add_argument(
+        "--referenceScreen",
+        dest="referenceScreen",
+        choices=["off", "seed", "qvOnly"],
+        default="off",
+        help="Arrow/Quiver only: screen each window with a pileup of its alignments, "   + \
+             "and where no column shows a non-reference allele in more than "            + \
+             "--referenceScreenAlleleFraction of the reads, 'seed' polishing with the "  + \
+             "reference instead of the POA consensus, or (faster) take the reference "   + \
+             "as the consensus and only compute its QVs ('qvOnly').  'qvOnly' cannot "   + \
+             "call variants in the windows passing the screen; see the FAQ.")
+    algorithm.add_argument(
+        "--referenceScreenAlleleFraction",
+        dest="referenceScreenAlleleFraction",
+        type=float,
+        default=0.3,
+        help="Largest fraction of the reads at a column that may show a mismatch or " + \
+             "indel for a window to pass --referenceScreen, or for the column not to " + \
+             "be a candidate locus under --variantsOnly.")
+    algorithm.add_argument(
+        "--carryDraft",
+        dest="carryDraft",
+        action="store_true",
+        default=False,
+        help="Arrow only: within a batch of adjacent chunks (see "                   + \
+             "--maxChunksPerBatch), take the consensus at the start of each "        + \
+             "enlarged window from the polished end of the previous one, followed " + \
+             "by the reference, instead of computing and polishing a POA draft, "   + \
+             "where the rest of the window agrees with the reference (see "        + \
+             "--referenceScreenAlleleFraction; it is polished again only with "      + \
+             "--referenceScreen=seed).  The consensus is then clipped to the chunk " + \
+             "using the alignments made for variant calling.  Batches are then "    + \
+             "of fixed size, so that the output does not depend on scheduling; "    + \
+             "a run resumed from a checkpoint may batch, and so call, differently.")
+    algorithm.add_argument(
+        "--windowTimeBudget",
+        dest="windowTimeBudget",
+        type=float,
+        default=0,
+        metavar="SECONDS",
+        help="Arrow and Quiver: wall-clock time allowed for the consensus of a "  + \
+             "window.  A window that runs over keeps its draft, or the template " + \
+             "polished so far, with QVs of 0.  0 (the default) is unlimited.")
+    algorithm.add_argument(
+        "--variantsOnly",
+        dest="variantsOnly",
+        action="store_true",
+        default=False,
+        help="Arrow/Quiver only: polish only the 50 bp on either side of candidate "  + \
+             "variant loci, found in a pileup of the reads (columns with a mismatch " + \
+             "or indel in more than --referenceScreenAlleleFraction of the reads).  " + \
+             "Elsewhere the consensus is the reference where covered, without QVs, " + \
+             "and a no-call where not.  For when only the variants are wanted.")
+
     debugging = parser.add_argument_group("Verbosity and debugging/profiling")
     add_debug_option(debugging)
     debugging.add_argument(
@@ -353,7 +482,50 @@ def add_options_to_argument_parser(parser):
         action="store_true",
         dest="doProfiling",
         default=False,
-        help="Enable Python-level profiling (using cProfile).")
+        help="Enable Python-level profiling (using cProfile).  The profiles " + \
+             "of all the processes are merged into one report.")
+    debugging.add_argument(
+        "--profileOutput",
+        dest="profileOutput",
+        type=str,
+        default=None,
+        metavar="PREFIX",
+        help="With --profile, write the merged profile to PREFIX.txt (sorted " + \
+             "report) and PREFIX.pstats (for gprof2dot, snakeviz, ...) rather " + \
+             "than printing its top entries.")
+    debugging.add_argument(
+        "--sampleProfile",
+        dest="sampleProfile",
+        type=str,
+        default=None,
+        help="Sample the stack of every process at intervals of CPU time and "  + \
+             "write the samples, merged, to this file in the collapsed-stack "   + \
+             "format of flamegraph.pl.  Low overhead; usable on full runs.")
+    debugging.add_argument(
+        "--sampleInterval",
+        dest="sampleInterval",
+        type=float,
+        default=10.0,
+        help="CPU time between stack samples for --sampleProfile, in milliseconds.")
+    debugging.add_argument(
+        "--runReport",
+        dest="runReport",
+        type=str,
+        default=None,
+        help="Write a JSON report of the time spent in each stage of the "   + \
+             "consensus computation (read fetch, POA, polishing, ...) and of " + \
+             "event counts (reads fetched and rejected, mutations tested, "   + \
+             "...), summed over the workers, to this file.")
+    debugging.add_argument(
+        "--traceFile",
+        dest="traceFile",
+        type=str,
+        default=None,
+        help="Write a timeline of the run to this file, in the Chrome "      + \
+             "trace-event format (open it in chrome://tracing or Perfetto): " + \
+             "the chunks processed by each worker and their stages, the "     + \
+             "time spent waiting on the work and result queues, and the "     + \
+             "result collector's activity.")
     debugging.add_argument(
         "--dumpEvidence", "-d",
         dest="dumpEvidence",
@@ -373,7 +545,68 @@ def add_options_to_argument_parser(parser):
         action="store_true",
         help="Additionally record the *post-filtering* coverage at variant sites")
 
+    debugging.add_argument(
+        "--progressFile",
+        dest="progressFile",
+        type=str,
+        default=None,
+        help="Keep a JSON status file of the run's progress, rewritten every " + \
+             "--progressInterval seconds: bases completed per contig, chunks " + \
+             "per second, worker busy fractions, queue depths and an ETA.")
+    debugging.add_argument(
+        "--prometheusFile",
+        dest="prometheusFile",
+        type=str,
+        default=None,
+        help="Keep the same progress metrics in this file, in the Prometheus " + \
+             "text format (for the node-exporter textfile collector).")
+    debugging.add_argument(
+        "--progressInterval",
+        dest="progressInterval",
+        type=float,
+        default=10.0,
+        help="Seconds between rewrites of --progressFile and --prometheusFile.")
+
     advanced = parser.add_argument_group("Advanced configuration options")
+    advanced.add_argument(
+        "--fallbackCoverage",
+        dest="fallbackCoverage",
+        type=int,
+        default=20,
+        help="When the computation for a chunk fails, it is retried once with " + \
+             "the coverage limited to this; if that fails too, the chunk gets "   + \
+             "a no-call.")
+    advanced.add_argument(
+        "--chunkTimeout",
+        dest="chunkTimeout",
+        type=float,
+        default=0,
+        help="Kill and replace a worker that has spent more than this many "  + \
+             "seconds on one chunk; the chunk is retried as for a failure.  0 " + \
+             "(the default) for no limit.")
+    advanced.add_argument(
+        "--failureSummary",
+        dest="failureSummary",
+        type=str,
+        default=None,
+        help="Write a JSON list of the chunks whose computation failed or "  + \
+             "timed out (window, attempt, outcome, error) to this file.")
+    advanced.add_argument(
+        "--maxChunksPerWorker",
+        dest="maxChunksPerWorker",
+        type=int,
+        default=0,
+        help="Replace each worker process by a fresh one after it has "    + \
+             "processed this many chunks, bounding the memory a long-lived " + \
+             "worker accumulates.  0 (the default) for no limit.")
+    advanced.add_argument(
+        "--maxWorkerRss",
+        dest="maxWorkerRss",
+        type=int,
+        default=0,
+        help="Replace a worker process by a fresh one once its resident " + \
+             "memory exceeds this many MB (checked after each work unit). " + \
+             "0 (the default) for no limit.")
     advanced.add_argument(
         "--diploid",
         action="store_true",
@@ -384,6 +617,21 @@ def add_options_to_argument_parser(parser):
         dest="queueSize",
         type=int,
         default=200)
+    advanced.add_argument(
+        "--resultShards",
+        action="store_true",
+        dest="resultShards",
+        default=False,
+        help="Have workers write their results to shard files in a temporary "    + \
+             "directory, passing only small descriptors to the result collector.  " + \
+             "Keeps the collector's memory use independent of contig size.")
+    advanced.add_argument(
+        "--checkpointDir",
+        dest="checkpointDir",
+        type=str,
+        default=None,
+        help="Journal finished windows to this directory.  If the run is interrupted, " + \
+             "rerunning the same command will skip the windows already in the journal.")
     advanced.add_argument(
         "--threaded", "-T",
         action="store_true",
@@ -412,6 +660,16 @@ def add_options_to_argument_parser(parser):
         dest="referenceChunkOverlap",
         type=int,
         default=5)
+    advanced.add_argument(
+        "--readIndexSidecar",
+        dest="readIndexSidecar",
+        action="store_true",
+        default=False,
+        help="Keep the alignment index, partitioned by contig, and the coverage "   + \
+             "index derived from it in sidecar files next to the input "            + \
+             "(INPUT.qMAPQV.gcindex.npz, INPUT.qMAPQV.gccov), to be loaded by the " + \
+             "workers and by later runs instead of being rebuilt.  Worthwhile for " + \
+             "large inputs and references with many contigs.")
     advanced.add_argument(
         "--autoDisableHdf5ChunkCache",
         action="store",
@@ -0,0 +1,352 @@
+#################################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# pileup.py: allele counts by reference column, computed with numpy
+#
+# The allele a read presents at a reference position is the string of
+# read bases aligned to that position, including any read bases
+# inserted just before it; "-" if the position is deleted in the read.
+# Each allele is encoded as a uint8:
+#
+#   0            : the read does not cover the position
+#   1-5          : A, C, G, T, N
+#   6            : deletion ("-")
+#   7 (COMPLEX)  : anything else---an insertion, or an unusual base.
+#                  The allele strings are kept in a side table of
+#                  (read, column, allele) triples.
+#
+# Complex alleles are uncommon, so the counts, coverage and top alleles
+# are computed as whole-array operations over the simple codes, with a
+# small per-column correction where complex alleles occur.
+#
+# Alongside the count of each allele in each column is the first read
+# (in the order the reads were added) presenting it.  Alleles of equal
+# frequency are ranked by it, as Counter.most_common ranks them by
+# first occurrence in the original column-at-a-time tabulation.
+#
+
+import numpy as np
+from collections import Counter, defaultdict
+
+__all__ = [ "encodeAlignment",
+            "encodeAlignments",
+            "Pileup",
+            "RollingPileup" ]
+
+NOT_COVERED = 0
+DELETION    = 6
+COMPLEX     = 7
+NUM_SIMPLE_ALLELES = 6
+
+# Longer alleles are truncated to this length, as in the string
+# matrix used by the original plurality implementation.
+MAX_ALLELE_LENGTH = 8
+
+SIMPLE_ALLELES = np.array(list("ACGTN-"), dtype="S1")
+
+# First read of an allele not (yet) seen in a column
+NEVER = np.iinfo(np.int64).max
+
+_GAP = ord("-")
+
+_codeOfByte = np.empty(256, dtype=np.uint8)
+_codeOfByte.fill(COMPLEX)
+for _code, _base in enumerate("ACGTN-"):
+    _codeOfByte[ord(_base)] = _code + 1
+
+def encodeAlignments(alignments, windowSize):
+    """
+    Encode alignments, given as (offset, alnRef, alnRead) where the
+    gapped reference and read strings are in genomic orientation and
+    `offset` is the window column of the first reference base.
+    Returns (codeMatrix, complexAlleles): a matrix of allele codes
+    with a row per alignment and a column per window column, and a
+    list of (row, column, allele) for the cells coded COMPLEX.
+
+    All the alignments are encoded at once, as operations on the
+    concatenation of their strings.  Read bases inserted after the
+    last reference base of an alignment are dropped.
+    """
+    numReads = len(alignments)
+    codes = np.zeros(numReads * windowSize, dtype=np.uint8)
+    if numReads == 0:
+        return codes.reshape(0, windowSize), []
+    offsets, alnRefs, alnReads = zip(*alignments)
+    lengths = np.array(map(len, alnRefs))
+    ref  = np.frombuffer("".join(alnRefs),  dtype=np.uint8)
+    read = np.frombuffer("".join(alnReads), dtype=np.uint8)
+    refIsBase  = ref  != _GAP
+    readIsBase = read != _GAP
+
+    # Column (within its alignment) of the next reference base at or
+    # after each alignment position; the read bases at a position
+    # belong to that column.
+    refBasesSoFar = np.cumsum(refIsBase)
+    alignmentStarts = np.cumsum(lengths) - lengths
+    refBasesBefore = np.where(alignmentStarts > 0, refBasesSoFar[alignmentStarts - 1], 0)
+    refBasesInAlignment = np.append(refBasesBefore[1:], refBasesSoFar[-1]) - refBasesBefore
+    column = refBasesSoFar - refIsBase - np.repeat(refBasesBefore, lengths)
+
+    # Index of the cell (alignment, window column) of each position
+    rowStart = np.arange(numReads) * windowSize + np.array(offsets)
+    cell = column + np.repeat(rowStart, lengths)
+    inAlignment = column < np.repeat(refBasesInAlignment, lengths)
+
+    codes[cell[refIsBase]] = DELETION
+    readPositions = np.flatnonzero(readIsBase & inAlignment)
+    readCells = cell[readPositions]
+    basesPerCell = np.bincount(readCells, minlength=len(codes))
+    single = basesPerCell[readCells] == 1
+    codes[readCells[single]] = _codeOfByte[read[readPositions[single]]]
+
+    complexAlleles = []
+    multiCells = np.flatnonzero(basesPerCell > 1)
+    if len(multiCells):
+        codes[multiCells] = COMPLEX
+        starts = np.searchsorted(readCells, multiCells)
+        ends = starts + basesPerCell[multiCells]
+        for c, s, e in zip(multiCells.tolist(), starts.tolist(), ends.tolist()):
+            complexAlleles.append(
+                (c // windowSize, c % windowSize,
+                 read[readPositions[s:e]].tostring()[:MAX_ALLELE_LENGTH]))
+    unusual = single & (codes[readCells] == COMPLEX)
+    if unusual.any():
+        complexAlleles.extend(zip((readCells[unusual] // windowSize).tolist(),
+                                  (readCells[unusual] % windowSize).tolist(),
+                                  map(chr, read[readPositions[unusual]])))
+    return codes.reshape(numReads, windowSize), complexAlleles
+
+def encodeAlignment(alnRef, alnRead):
+    """
+    Encode a single alignment; returns (codes, complexAlleles) with a
+    code for each reference base, and (column, allele) for the columns
+    coded COMPLEX.
+    """
+    numColumns = len(alnRef) - alnRef.count("-")
+    codeMatrix, complexAlleles = encodeAlignments([(0, alnRef, alnRead)], numColumns)
+    return codeMatrix[0], [ (col, allele) for (_, col, allele) in complexAlleles ]
+
+
+class Pileup(object):
+    """
+    Allele counts for each column of a reference window.  Reads are
+    added one at a time, as encoded by `encodeAlignment`.
+    """
+    def __init__(self, refWindow):
+        _, refStart, refEnd = refWindow
+        self.refWindow = refWindow
+        self.windowSize = refEnd - refStart
+        # counts[code, column]; row COMPLEX holds the total of the
+        # complex alleles, which are tallied by column in complexCounts
+        self.counts = np.zeros((COMPLEX + 1, self.windowSize), dtype=np.int32)
+        self.complexCounts = defaultdict(Counter)
+        # firstRead[code, column], and by column for the complex alleles
+        self.firstRead = np.empty((COMPLEX + 1, self.windowSize), dtype=np.int64)
+        self.firstRead.fill(NEVER)
+        self.complexFirstRead = defaultdict(dict)
+        self.numReads = 0
+
+    @classmethod
+    def fromAlignments(cls, refWindow, alns):
+        _, refStart, refEnd = refWindow
+        pileup = cls(refWindow)
+        alignments = []
+        for aln in alns:
+            aln = aln.clippedTo(refStart, refEnd)
+            alignments.append((aln.referenceStart - refStart,
+                               aln.reference(orientation="genomic"),
+                               aln.read(orientation="genomic")))
+        codeMatrix, complexAlleles = encodeAlignments(alignments, pileup.windowSize)
+        pileup.addCodeMatrix(codeMatrix, complexAlleles)
+        return pileup
+
+    def addCodeMatrix(self, codeMatrix, complexAlleles):
+        """
+        Add the reads encoded as the rows of a matrix of codes, one
+        column per column of the window, with the complex alleles of
+        the matrix, as returned by `encodeAlignments`.
+        """
+        W = self.windowSize
+        keys = codeMatrix.astype(np.intp) * W + np.arange(W)
+        self.counts += np.bincount(keys.ravel(),
+                                   minlength=(COMPLEX + 1) * W).reshape(COMPLEX + 1, W)
+        columns = np.arange(W)
+        for code in xrange(1, NUM_SIMPLE_ALLELES + 1):
+            presents = codeMatrix == code
+            row = presents.argmax(axis=0)
+            firstRead = np.where(presents[row, columns], self.numReads + row, NEVER)
+            np.minimum(self.firstRead[code], firstRead, out=self.firstRead[code])
+        for row, col, allele in complexAlleles:
+            self._addComplexAllele(self.numReads + row, col, allele)
+        self.numReads += len(codeMatrix)
+
+    def addEncodedAlignment(self, offset, codes, complexAlleles):
+        """
+        Add a read whose first reference base is in column `offset`,
+        as encoded by `encodeAlignment`.
+        """
+        columns = np.arange(offset, offset + len(codes))
+        self.counts[codes, columns] += 1
+        self.firstRead[codes, columns] = np.minimum(self.firstRead[codes, columns],
+                                                    self.numReads)
+        for col, allele in complexAlleles:
+            self._addComplexAllele(self.numReads, offset + col, allele)
+        self.numReads += 1
+
+    def _addComplexAllele(self, read, col, allele):
+        self.complexCounts[col][allele] += 1
+        self.complexFirstRead[col].setdefault(allele, read)
+
+    @property
+    def coverage(self):
+        return self.counts[1:].sum(axis=0)
+
+    def nonReferenceFraction(self, refSequence):
+        """
+        The fraction of the reads covering each column that present
+        an allele other than the reference base there---a substitution,
+        a deletion, or a base inserted before it.  0 where there is no
+        coverage.
+        """
+        refCodes = _codeOfByte[np.frombuffer(refSequence.upper(), dtype=np.uint8)]
+        columns = np.arange(self.windowSize)
+        agreeing = np.where(refCodes < DELETION, self.counts[refCodes, columns], 0)
+        coverage = self.coverage
+        return np.where(coverage > 0, 1.0 - agreeing / np.maximum(coverage, 1.0), 0.0)
+
+    def topAlleles(self):
+        """
+        The two most frequent alleles in each column, as
+        (coverage, allele1, frequency1, allele2, frequency2) where the
+        alleles are lists of strings, and the others integer arrays.
+        Columns without a second (or first) allele get "N" with
+        frequency 0.
+
+        Of alleles equally frequent, the one presented by an earlier
+        read comes first.
+        """
+        simpleCounts = self.counts[1:NUM_SIMPLE_ALLELES+1]
+        simpleFirstRead = self.firstRead[1:NUM_SIMPLE_ALLELES+1]
+        order = np.lexsort((simpleFirstRead, -simpleCounts), axis=0)
+        columns = np.arange(self.windowSize)
+        frequency1 = simpleCounts[order[0], columns]
+        frequency2 = simpleCounts[order[1], columns]
+        allele1 = SIMPLE_ALLELES[order[0]].tolist()
+        allele2 = SIMPLE_ALLELES[order[1]].tolist()
+
+        for col, complexCounter in self.complexCounts.iteritems():
+            complexFirstRead = self.complexFirstRead[col]
+            candidates = [ (-simpleCounts[i, col], simpleFirstRead[i, col], SIMPLE_ALLELES[i])
+                           for i in xrange(NUM_SIMPLE_ALLELES) ]
+            candidates += [ (-count, complexFirstRead[allele], allele)
+                            for (allele, count) in complexCounter.iteritems() ]
+            candidates.sort()
+            (f1, _, a1), (f2, _, a2) = candidates[:2]
+            allele1[col], frequency1[col] = a1, -f1
+            allele2[col], frequency2[col] = a2, -f2
+
+        for alleles, frequencies in ((allele1, frequency1), (allele2, frequency2)):
+            for col in np.flatnonzero(frequencies == 0).tolist():
+                alleles[col] = "N"
+        return (self.coverage, allele1, frequency1, allele2, frequency2)
+
+
+class RollingPileup(object):
+    """
+    Allele counts over a stretch of a contig that moves forward as
+    reads are added in order of reference start: once no further read
+    can start before `end`, the columns up to `end` are complete and
+    can be taken off the front with `popPileup`.  Memory is bounded by
+    the span of the reads overlapping the front, not by the length of
+    the contig.
+    """
+    def __init__(self, refId, start, capacity=1024):
+        self.refId = refId
+        self.start = start
+        self.counts = np.zeros((COMPLEX + 1, capacity), dtype=np.int32)
+        self.firstRead = np.empty((COMPLEX + 1, capacity), dtype=np.int64)
+        self.firstRead.fill(NEVER)
+        self.complexCounts = defaultdict(Counter)   # keyed by reference position
+        self.complexFirstRead = defaultdict(dict)   # "
+        self.numReads = 0
+
+    @staticmethod
+    def _shifted(array, numColumns, capacity, fill):
+        # The columns of `array` from numColumns on, at the front of
+        # an array of `capacity` columns
+        shifted = np.empty((array.shape[0], capacity), dtype=array.dtype)
+        shifted.fill(fill)
+        kept = array[:, numColumns:]
+        shifted[:, :kept.shape[1]] = kept
+        return shifted
+
+    def _reserve(self, numColumns):
+        capacity = self.counts.shape[1]
+        if numColumns > capacity:
+            newCapacity = max(numColumns, 2 * capacity)
+            self.counts    = self._shifted(self.counts, 0, newCapacity, 0)
+            self.firstRead = self._shifted(self.firstRead, 0, newCapacity, NEVER)
+
+    def addEncodedAlignment(self, refStart, codes, complexAlleles):
+        """
+        Add a read whose first reference base is at `refStart`, as
+        encoded by `encodeAlignment`.
+        """
+        assert refStart >= self.start
+        offset = refStart - self.start
+        self._reserve(offset + len(codes))
+        columns = np.arange(offset, offset + len(codes))
+        self.counts[codes, columns] += 1
+        self.firstRead[codes, columns] = np.minimum(self.firstRead[codes, columns],
+                                                    self.numReads)
+        for col, allele in complexAlleles:
+            self.complexCounts[refStart + col][allele] += 1
+            self.complexFirstRead[refStart + col].setdefault(allele, self.numReads)
+        self.numReads += 1
+
+    def popPileup(self, end):
+        """
+        Remove the columns [start, end) and return them as a Pileup.
+        """
+        numColumns = end - self.start
+        self._reserve(numColumns)
+        pileup = Pileup((self.refId, self.start, end))
+        pileup.counts[:] = self.counts[:, :numColumns]
+        pileup.firstRead[:] = self.firstRead[:, :numColumns]
+        pileup.numReads = self.numReads
+        capacity = self.counts.shape[1]
+        self.counts    = self._shifted(self.counts, numColumns, capacity, 0)
+        self.firstRead = self._shifted(self.firstRead, numColumns, capacity, NEVER)
+        for pos in [ pos for pos in self.complexCounts if pos < end ]:
+            pileup.complexCounts[pos - self.start] = self.complexCounts.pop(pos)
+            pileup.complexFirstRead[pos - self.start] = self.complexFirstRead.pop(pos)
+        self.start = end
+        return pileup
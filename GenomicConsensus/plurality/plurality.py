@@ -32,10 +32,10 @@
 
 from __future__ import absolute_import
 
-import math, logging, numpy as np, random
-from itertools import izip
-from collections import Counter
+import heapq, math, logging, numpy as np, random
 from ..utils import *
+from ..pileup import Pileup, RollingPileup, encodeAlignment
+from ..instrumentation import timed, count
 from .. import reference
 from ..options import options
 from ..Worker import WorkerProcess, WorkerThread
@@ -88,91 +88,141 @@ def pluralityConsensusAndVariants(refWindow, referenceSequenceInWindow, alns,
     windowSize = refEnd - refStart
     assert len(referenceSequenceInWindow) == windowSize
 
-    #
-    # Build up these arrays in reference coordinates.
-    #
-    consensusSequence_   = []
-    consensusFrequency_  = []
-    consensusConfidence_ = []
-    effectiveCoverage_   = []
-    alternateAllele_     = []        # DIPLOID ONLY
-    alternateFrequency_  = []        # "
-    heterozygousConfidence_ = []     # "
+    with timed("pileup"):
+        pileup = Pileup.fromAlignments(refWindow, alns)
+    with timed("call"):
+        return pluralityConsensusAndVariantsFromPileup(refWindow, referenceSequenceInWindow,
+                                                       pileup, pluralityConfig)
 
+def pluralityConsensusAndVariantsFromPileup(refWindow, referenceSequenceInWindow,
+                                            pileup, pluralityConfig):
+    """
+    The work of `pluralityConsensusAndVariants`, given the pileup.
+    All the arrays here are in reference coordinates.
+    """
     noCallCss = Consensus.noCallConsensus(pluralityConfig.noEvidenceConsensus,
                                           refWindow, referenceSequenceInWindow)
 
-    baseCallsMatrix = tabulateBaseCalls(refWindow, alns)
+    effectiveCoverage, consensusSequence_, consensusFrequency, \
+        alternateAllele_, alternateFrequency = pileup.topAlleles()
 
-    for j in xrange(0, windowSize):
-        counter = Counter(baseCallsMatrix[:, j])
-        if "" in counter: counter.pop("")
+    noCall = ((effectiveCoverage == 0) |
+              (effectiveCoverage < pluralityConfig.minCoverage))
+    noCallColumns = np.flatnonzero(noCall).tolist()
+    for j in noCallColumns:
+        consensusSequence_[j] = noCallCss.sequence[j]
+    consensusFrequency = np.where(noCall, effectiveCoverage, consensusFrequency)
 
-        siteEffectiveCoverage = sum(counter.itervalues())
-        if ((siteEffectiveCoverage == 0) or
-            (siteEffectiveCoverage < pluralityConfig.minCoverage)):
-            siteConsensusFrequency = siteEffectiveCoverage
-            siteConsensusSequence  = noCallCss.sequence[j]
-            top2                   = None
-        else:
-            # Not for production code:
-            top2 = counter.most_common(2)
-            siteConsensusSequence, siteConsensusFrequency = top2[0]
-
-        # Replace explicit gaps with empty string
-        if siteConsensusSequence == "-":
-            siteConsensusSequence = ""
-
-        consensusSequence_.append(siteConsensusSequence)
-        consensusFrequency_.append(siteConsensusFrequency)
-        effectiveCoverage_.append(siteEffectiveCoverage)
-
-        if pluralityConfig.diploid:
-            if top2 and len(top2) > 1:
-                siteAlternateAllele, siteAlternateFrequency = top2[1]
-            else:
-                siteAlternateAllele    = "N"
-                siteAlternateFrequency =  0
-            if siteAlternateAllele == "-":
-                siteAlternateAllele = ""
-            alternateAllele_.append(siteAlternateAllele)
-            alternateFrequency_.append(siteAlternateFrequency)
-        else:
-            siteAlternateAllele    = "N"
-            siteAlternateFrequency = 0
-
-        siteConsensusConfidence, siteHeterozygousConfidence = \
-            posteriorConfidences(siteEffectiveCoverage,
-                                 siteConsensusFrequency,
-                                 siteAlternateFrequency,
-                                 diploid=pluralityConfig.diploid)
-        consensusConfidence_.append(siteConsensusConfidence)
-        if pluralityConfig.diploid:
-            heterozygousConfidence_.append(siteHeterozygousConfidence)
+    if pluralityConfig.diploid:
+        for j in noCallColumns:
+            alternateAllele_[j] = "N"
+        alternateFrequency = np.where(noCall, 0, alternateFrequency)
+    else:
+        alternateFrequency = np.zeros_like(alternateFrequency)
+
+    # Replace explicit gaps with empty string
+    consensusSequence_ = [ "" if a == "-" else a for a in consensusSequence_ ]
+    alternateAllele_   = [ "" if a == "-" else a for a in alternateAllele_ ]
+
+    consensusConfidence, heterozygousConfidence = \
+        posteriorConfidenceArrays(effectiveCoverage,
+                                  consensusFrequency,
+                                  alternateFrequency,
+                                  diploid=pluralityConfig.diploid)
 
     #
-    # Derive variants from reference-coordinates consensus
+    # Derive variants from reference-coordinates consensus.  Only the
+    # columns where a variant could be called need to be examined.
     #
+    confidence = (np.maximum(consensusConfidence, heterozygousConfidence)
+                  if pluralityConfig.diploid else consensusConfidence)
+    candidateColumns = np.flatnonzero(
+        (effectiveCoverage >= pluralityConfig.minCoverage) &
+        (confidence >= pluralityConfig.minConfidence)).tolist()
     variants = _computeVariants(pluralityConfig,
                                 refWindow,
                                 referenceSequenceInWindow,
-                                effectiveCoverage_,
+                                effectiveCoverage.tolist(),
                                 consensusSequence_,
-                                consensusFrequency_,
-                                consensusConfidence_,
-                                alternateAllele_,
-                                alternateFrequency_,
-                                heterozygousConfidence_)
+                                consensusFrequency.tolist(),
+                                consensusConfidence.tolist(),
+                                alternateAllele_ if pluralityConfig.diploid else None,
+                                alternateFrequency.tolist() if pluralityConfig.diploid else None,
+                                heterozygousConfidence.tolist() if pluralityConfig.diploid else None,
+                                candidateColumns=candidateColumns)
     #
     # Now we need to put everything in consensus coordinates
     #
     consensusLens = map(len, consensusSequence_)
     consensusSequence = "".join(consensusSequence_)
-    consensusConfidence = np.repeat(consensusConfidence_, consensusLens)
+    consensusConfidence = np.repeat(consensusConfidence.tolist(), consensusLens)
     css = Consensus(refWindow, consensusSequence, consensusConfidence)
     return (css, variants)
 
 
+# Columns called at a time by the sweep
+SWEEP_SEGMENT_SIZE = 10000
+
+def pluralitySweep(refWindow, referenceSequenceInWindow, alns,
+                   pluralityConfig, depthLimit=None,
+                   segmentSize=SWEEP_SEGMENT_SIZE):
+    """
+    Compute (Consensus, [Variant]) for a large window---a whole
+    contig, or a large block of one---in a single pass over `alns`,
+    which must be ordered by reference start.  Each read is clipped
+    and decoded once and added to a rolling pileup; the consensus and
+    variants for each segment of `segmentSize` columns are called as
+    soon as the sweep has passed it.  The cost is linear in the
+    aligned bases, rather than in the number of windows each read
+    spans.
+
+    If `depthLimit` is given, a read is skipped if `depthLimit` of the
+    reads already taken overlap its start.  (The windowed algorithm
+    instead keeps the reads longest in each window, so the two modes
+    can differ where coverage exceeds the limit.)
+    """
+    refId, refStart, refEnd = refWindow
+    rollingPileup = RollingPileup(refId, refStart)
+    consensi, variants = [], []
+
+    def callSegments(segmentStart, upTo):
+        # Call the segments ending at or before `upTo`; returns the
+        # start of the first segment left uncalled
+        while segmentStart < refEnd:
+            segmentEnd = min(segmentStart + segmentSize, refEnd)
+            if segmentEnd > upTo:
+                break
+            segmentWindow = (refId, segmentStart, segmentEnd)
+            pileup = rollingPileup.popPileup(segmentEnd)
+            css, segmentVariants = pluralityConsensusAndVariantsFromPileup(
+                segmentWindow,
+                referenceSequenceInWindow[segmentStart-refStart:segmentEnd-refStart],
+                pileup, pluralityConfig)
+            consensi.append(css)
+            variants.extend(segmentVariants)
+            segmentStart = segmentEnd
+        return segmentStart
+
+    segmentStart = refStart
+    activeReadEnds = []   # heap
+    for aln in alns:
+        readStart = max(aln.referenceStart, refStart)
+        segmentStart = callSegments(segmentStart, readStart)
+        if depthLimit is not None:
+            while activeReadEnds and activeReadEnds[0] <= readStart:
+                heapq.heappop(activeReadEnds)
+            if len(activeReadEnds) >= depthLimit:
+                continue
+            heapq.heappush(activeReadEnds, aln.referenceEnd)
+        if aln.referenceStart < refStart or aln.referenceEnd > refEnd:
+            aln = aln.clippedTo(refStart, refEnd)
+        codes, complexAlleles = encodeAlignment(aln.reference(orientation="genomic"),
+                                                aln.read(orientation="genomic"))
+        rollingPileup.addEncodedAlignment(aln.referenceStart, codes, complexAlleles)
+    callSegments(segmentStart, refEnd)
+    return (join(consensi), variants)
+
+
 def varsFromRefAndRead(refId, refPos, refBase, readSeq, **kwargs):
     """
     Compute the haploid/heterozygous Variant[s] corresponding to a
@@ -230,7 +280,13 @@ def _computeVariants(config,
                      consensusConfidenceArray,
                      alternateAlleleArray=None,
                      alternateAlleleFrequency=None,
-                     heterozygousConfidence=None):
+                     heterozygousConfidence=None,
+                     candidateColumns=None):
+    """
+    Call the variants in the window from the consensus arrays (in
+    reference coordinates).  If `candidateColumns` is given, only
+    those columns are examined.
+    """
 
     refId, refStart, refEnd = refWindow
     windowSize = refEnd - refStart
@@ -241,7 +297,9 @@ def _computeVariants(config,
         assert len(alternateAlleleFrequency) == windowSize
 
     vars = []
-    for j in xrange(windowSize):
+    if candidateColumns is None:
+        candidateColumns = xrange(windowSize)
+    for j in candidateColumns:
         refPos = j + refStart
         refBase = refSequenceInWindow[j]
         cov  = coverageArray[j]
@@ -267,7 +325,7 @@ def _computeVariants(config,
                                          cssBases, altBases,
                                          confidence=hetConf, coverage=cov,
                                          frequency1=cssFreq, frequency2=altFreq)
-                vars = vars + vs
+                vars.extend(vs)
 
         else:
             #
@@ -282,47 +340,12 @@ def _computeVariants(config,
                 vs = varsFromRefAndRead(refId, refPos, refBase, cssBases,
                                         confidence=conf, coverage=cov,
                                         frequency1=cssFreq)
-                vars = vars + vs
+                vars.extend(vs)
 
     if config.diploid:
         vars = filter(_isSameLengthVariant, vars)
     return sorted(vars)
 
-def tabulateBaseCalls(refWindow, alns, realignHomopolymers=False):
-    """
-    Go through the reads and build up the structured baseCallsMatrix
-    table, which tabulates the read bases occurring at each reference
-    coordinate in each read.  This code is somewhat tricky, read carefully.
-    """
-    _, refStart, refEnd = refWindow
-    windowSize = refEnd - refStart
-
-    baseCallsMatrix = np.zeros(shape=(len(alns), windowSize), dtype="S8")
-
-    for i, aln in enumerate(alns):
-        aln = aln.clippedTo(refStart, refEnd)
-        alnRef    = aln.reference(orientation="genomic")
-        alnRead   = aln.read(orientation="genomic")
-        if realignHomopolymers:
-            alnRef, alnRead =  normalizeHomopolymerGaps(alnRef, alnRead)
-
-        # Idea: scan through the ref, read; for each non-gap character
-        # in ref, record all non-gap characters seen in read since
-        # last ref gap.
-        readBases = []
-        accum = []
-        for (refBase, readBase) in izip(alnRef, alnRead):
-            if readBase != "-":
-                readBases.append(readBase)
-            if refBase != "-":
-                basesForRefPos = "".join(readBases) if readBases else "-"
-                accum.append(basesForRefPos)
-                readBases = []
-        s, e = (aln.referenceStart - refStart,
-                aln.referenceEnd   - refStart)
-        baseCallsMatrix[i, s:e] = accum
-    return baseCallsMatrix
-
 #
 # ------ HACKISH POSTERIOR PROBABILITY CALCULATION ----------
 #
@@ -361,6 +384,36 @@ def posteriorConfidences(depth, cssFreq, altFreq, diploid=False, cap=40):
     cssConf = -10*np.log10(1.-cssProb) if (cssProb < 1) else cap
     return int(min(cap, cssConf)), int(min(cap, hetConf))
 
+def posteriorConfidenceArrays(depth, cssFreq, altFreq, diploid=False, cap=40):
+    """
+    `posteriorConfidences`, computed over arrays of sites.  Returns
+    integer arrays (cssConf, hetConf).
+    """
+    cssFreq = cssFreq+1
+    altFreq = altFreq+1
+    depth = depth + 2
+    cssLL_ = cssFreq*LOG_O_M_EPS + (depth-cssFreq)*LOGEPS
+    altLL_ = altFreq*LOG_O_M_EPS + (depth-altFreq)*LOGEPS
+    cssL_ = np.exp(cssLL_)
+    altL_ = np.exp(altLL_)
+    # At deep sites with no clear plurality the likelihoods all
+    # underflow, and the probabilities are 0/0; such sites get the
+    # cap, as in `posteriorConfidences`
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if diploid:
+            hetLL_ = (cssFreq+altFreq)*LOG_O_M_EPS_2 + (depth-cssFreq-altFreq)*LOGEPS
+            hetL_ = np.exp(hetLL_)
+            total =  cssL_ + altL_ + hetL_
+            hetProb = hetL_/total
+            hetConf = np.where(hetProb < 1, -10*np.log10(1.-hetProb), cap)
+        else:
+            total =  cssL_ + altL_
+            hetConf = np.zeros(len(depth))
+        cssProb = cssL_/total
+        cssConf = np.where(cssProb < 1, -10*np.log10(1.-cssProb), cap)
+    return (np.minimum(cap, cssConf).astype(int),
+            np.minimum(cap, hetConf).astype(int))
+
 #
 # --------------  Plurality Worker class --------------------
 #
@@ -374,8 +427,10 @@ class PluralityWorker(object):
     def onStart(self):
         random.seed(42)
 
-    def onChunk(self, workChunk):
+    def onChunk(self, workChunk, depthLimit=None):
         referenceWindow = workChunk.window
+        if depthLimit is None:
+            depthLimit = options.coverage
         refSeqInWindow = reference.sequenceInWindow(referenceWindow)
         logging.info("Plurality operating on %s" %
                      reference.windowToString(referenceWindow))
@@ -385,16 +440,40 @@ class PluralityWorker(object):
                                                   referenceWindow, refSeqInWindow)
             return (referenceWindow, (noCallCss, []))
 
-        alnHits = readsInWindow(self._inAlnFile, referenceWindow,
-                                   depthLimit=options.coverage,
-                                   minMapQV=options.minMapQV,
-                                   strategy="long-and-strand-balanced",
-                                   stratum=options.readStratum,
-                                   barcode=options.barcode)
+        count("windows")
+        if options.pluralitySweep:
+            with timed("sweep"):
+                return (referenceWindow,
+                        pluralitySweep(referenceWindow, refSeqInWindow,
+                                       self._sweepAlignments(referenceWindow),
+                                       self.pluralityConfig,
+                                       depthLimit=depthLimit))
+
+        with timed("fetch"):
+            alnHits = readsInWindow(self._inAlnFile, referenceWindow,
+                                       depthLimit=depthLimit,
+                                       minMapQV=options.minMapQV,
+                                       strategy="long-and-strand-balanced",
+                                       stratum=options.readStratum,
+                                       barcode=options.barcode)
+        count("readsFetched", len(alnHits))
         return (referenceWindow,
                 pluralityConsensusAndVariants(referenceWindow, refSeqInWindow,
                                               alnHits, self.pluralityConfig))
 
+    def _sweepAlignments(self, referenceWindow):
+        """
+        The reads overlapping the window, in order of reference start,
+        fetched as the sweep reaches them.
+        """
+        rows = readRowsInWindow(self._inAlnFile, referenceWindow,
+                                minMapQV=options.minMapQV,
+                                barcode=options.barcode)
+        index = self._inAlnFile.index
+        rows = rows[np.lexsort((index.tEnd[rows], index.tStart[rows]))]
+        for row in rows:
+            yield self._inAlnFile[int(row)]
+
 # define both process and thread-based plurality callers
 class PluralityWorkerProcess(PluralityWorker, WorkerProcess): pass
 class PluralityWorkerThread(PluralityWorker, WorkerThread): pass
@@ -37,11 +37,13 @@ from collections import Counter
 
 import ConsensusCore as cc, numpy as np
 
-from ..utils import readsInWindow, snd, third
+from ..utils import readsInWindow, readRowsInWindow, selectReadRows, snd, third
 from .. import reference
 from ..options import options
 from ..consensus import Consensus, join
 from ..windows import kSpannedIntervals, holes, subWindow
+from ..coverageIndex import coverageIndexFor
+from ..instrumentation import timed, count
 from ..variants import Variant, filterVariants, annotateVariants
 from ..Worker import WorkerProcess, WorkerThread
 from ..ResultCollector import ResultCollectorProcess, ResultCollectorThread
@@ -192,16 +194,19 @@ def consensusAndVariantsForAlignments(refWindow, refSequence, alns, poaConfig):
 
     try:
         assert len(fwdSequences) >= poaConfig.minPoaCoverage
-        p = cc.PoaConsensus.FindConsensus(fwdSequences[:poaConfig.maxPoaCoverage])
+        with timed("poa"):
+            p = cc.PoaConsensus.FindConsensus(fwdSequences[:poaConfig.maxPoaCoverage])
     except:
         logging.info("%s: POA could not be generated" % (refWindow,))
+        count("poa.failed")
         css = Consensus.noCallConsensus(poaConfig.noEvidenceConsensus,
                                         refWindow, refSequence)
         return (css, [])
 
     poaCss = p.Sequence
-    confidence, variants = \
-        variantsAndConfidence(refWindow, refSequence, poaCss, poaConfig.aligner)
+    with timed("variants"):
+        confidence, variants = \
+            variantsAndConfidence(refWindow, refSequence, poaCss, poaConfig.aligner)
     css = Consensus(refWindow, poaCss, confidence)
 
     return (css, variants)
@@ -221,20 +226,30 @@ def poaConsensusAndVariants(alnFile, refWindow, referenceContig,
     winId, winStart, winEnd = refWindow
     logging.info("POA operating on %s" %
                  reference.windowToString(refWindow))
+    count("windows")
+
+    # The reads intersecting the window, as rows of the alignment
+    # index; records are loaded only for the reads used in each interval
+    candidateRows = readRowsInWindow(alnFile, refWindow,
+                                     minMapQV=poaConfig.minMapQV,
+                                     barcode=options.barcode)
 
     if options.fancyChunking:
         # 1) identify the intervals with adequate coverage for poa
         #    consensus; restrict to intervals of length > 10
-        alnHits = readsInWindow(alnFile, refWindow,
-                                depthLimit=20000,
-                                minMapQV=poaConfig.minMapQV,
-                                strategy="longest",
-                                stratum=options.readStratum,
-                                barcode=options.barcode)
-        starts = np.fromiter((hit.tStart for hit in alnHits), np.int)
-        ends   = np.fromiter((hit.tEnd   for hit in alnHits), np.int)
-        intervals = kSpannedIntervals(refWindow, poaConfig.minPoaCoverage,
-                                      starts, ends, minLength=10)
+        #    (the coverage index bounds the depth from above, so a
+        #    window it shows to be too shallow is skipped outright)
+        coverage = coverageIndexFor(alnFile, poaConfig.minMapQV, options.barcode)
+        if coverage.maxDepth(refWindow) < poaConfig.minPoaCoverage:
+            intervals = []
+        else:
+            rows = selectReadRows(alnFile, candidateRows, refWindow,
+                                  depthLimit=20000,
+                                  strategy="longest")
+            starts = alnFile.index.tStart[rows].astype(np.int)
+            ends   = alnFile.index.tEnd[rows].astype(np.int)
+            intervals = kSpannedIntervals(refWindow, poaConfig.minPoaCoverage,
+                                          starts, ends, minLength=10)
         coverageGaps = holes(refWindow, intervals)
         allIntervals = sorted(intervals + coverageGaps)
         if len(allIntervals) > 1:
@@ -255,14 +270,20 @@ def poaConsensusAndVariants(alnFile, refWindow, referenceContig,
         subWin = subWindow(refWindow, interval)
 
         windowRefSeq = referenceContig[intStart:intEnd]
-        alns = readsInWindow(alnFile, subWin,
-                             depthLimit=depthLimit,
-                             minMapQV=poaConfig.minMapQV,
-                             strategy="longest",
-                             stratum=options.readStratum,
-                             barcode=options.barcode)
-        clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
-        clippedAlns = filterAlns(clippedAlns_, poaConfig)
+        with timed("fetch"):
+            alns = readsInWindow(alnFile, subWin,
+                                 depthLimit=depthLimit,
+                                 minMapQV=poaConfig.minMapQV,
+                                 strategy="longest",
+                                 stratum=options.readStratum,
+                                 barcode=options.barcode,
+                                 candidateRows=candidateRows)
+        with timed("clip"):
+            clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
+        with timed("filterAlns"):
+            clippedAlns = filterAlns(clippedAlns_, poaConfig)
+        count("readsFetched", len(alns))
+        count("readsRejected.filterAlns", len(clippedAlns_) - len(clippedAlns))
 
         if len([ a for a in clippedAlns
                  if a.spansReferenceRange(*interval) ]) >= poaConfig.minPoaCoverage:
@@ -296,6 +317,7 @@ def poaConsensusAndVariants(alnFile, refWindow, referenceContig,
         else:
             css = Consensus.noCallConsensus(poaConfig.noEvidenceConsensus,
                                             subWin, intRefSeq)
+            count("intervals.inadequateCoverage")
         subConsensi.append(css)
 
     # 4) glue the subwindow consensus objects together to form the
@@ -319,9 +341,11 @@ class PoaWorker(object):
     def onStart(self):
         random.seed(42)
 
-    def onChunk(self, workChunk):
+    def onChunk(self, workChunk, depthLimit=None):
         referenceWindow  = workChunk.window
         refId, refStart, refEnd = referenceWindow
+        if depthLimit is None:
+            depthLimit = options.coverage
 
         refSeqInWindow = reference.sequenceInWindow(referenceWindow)
 
@@ -348,7 +372,7 @@ class PoaWorker(object):
         #
         css_, variants_ = \
             poaConsensusAndVariants(self._inAlnFile, eWindow, refContig,
-                                    options.coverage, self.poaConfig)
+                                    depthLimit, self.poaConfig)
 
         #
         # Restrict the consensus and variants to the reference window.
@@ -0,0 +1,101 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# polishing.py: helpers shared by the polishing algorithms (Arrow and
+# Quiver)
+#
+# The reference screen, which lets a window showing no evidence of a
+# difference from the reference skip the POA, and the per-window time
+# budget (--windowTimeBudget), which stops a window's consensus early,
+# with QVs of 0, when its time runs out.
+#
+
+import logging, numpy as np, time
+
+from .instrumentation import timed, count
+from .pileup import Pileup
+
+def agreesWithReference(refWindow, refSequence, alns, maxAlleleFraction):
+    """
+    Pre-screen for windows showing no evidence of a difference from
+    the reference: True if, in the pileup of the (clipped) alignments,
+    no column has a non-reference allele in more than
+    `maxAlleleFraction` of the reads covering it.
+    """
+    pileup = Pileup.fromAlignments(refWindow, alns)
+    return pileup.nonReferenceFraction(refSequence).max() <= maxAlleleFraction
+
+class WindowBudget(object):
+    """
+    Wall-clock budget for computing the consensus of `refWindow`,
+    started on construction.  A budget of 0 seconds is unlimited.
+    """
+    def __init__(self, seconds, refWindow, clock=time.time):
+        self.refWindow = refWindow
+        self._clock = clock
+        self.deadline = clock() + seconds if seconds else None
+
+    @property
+    def limited(self):
+        return self.deadline is not None
+
+    @property
+    def exceeded(self):
+        return self.deadline is not None and self._clock() > self.deadline
+
+    def exceededAt(self, stage):
+        """
+        Has the budget run out by `stage` of the consensus?  If so, the
+        event is logged and counted in the run stats.
+        """
+        if not self.exceeded:
+            return False
+        logging.info("%s: time budget exceeded (at %s)" % (self.refWindow, stage))
+        count("windowBudget.exceeded")
+        count("windowBudget.exceeded.%s" % stage)
+        return True
+
+    def confidence(self, consensusConfidence, scorer, length, computeConfidence):
+        """
+        The QVs of the consensus in `scorer`, from consensusConfidence:
+        all 0 if they are not to be computed, or if the budget has run
+        out (so that no variants are called from the window)
+        """
+        if computeConfidence and not self.exceededAt("confidence"):
+            with timed("confidence"):
+                return consensusConfidence(scorer)
+        return noConfidence(length)
+
+def noConfidence(length):
+    """
+    QVs of 0 for a consensus of `length` bases
+    """
+    return np.zeros(length, dtype=np.uint8)
@@ -0,0 +1,183 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+#
+# profiling.py: run-wide profiles, merged across processes
+#
+# With --profile, every process (the driver, the workers and the
+# result collector) runs under cProfile and dumps its profile to the
+# temporary directory.  At the end of the run the dumps are merged
+# into a single pstats.Stats: with --profileOutput PREFIX the merged
+# profile is written as a sorted text report (PREFIX.txt) and as a
+# pstats dump (PREFIX.pstats) for gprof2dot, snakeviz and the like;
+# otherwise the top of the report is printed.
+#
+# With --sampleProfile FILE, every process instead samples its own
+# stack on a CPU-time interval timer (SIGPROF), and the samples are
+# merged into FILE in the "collapsed stack" format read by
+# flamegraph.pl and speedscope.  Only the thread that is running when
+# the timer fires is sampled, so the overhead is a stack walk every
+# --sampleInterval of CPU time, cheap enough for full runs.
+#
+# Python runs signal handlers only between bytecodes, and timer signals
+# that arrive meanwhile are merged, so a long call into C (a
+# ConsensusCore polish, say) gets a single handler call at its end.
+# Each sample is therefore weighted by the CPU time used since the
+# previous one, in units of the interval.
+#
+
+import logging, os.path, pstats, resource, signal, sys
+from collections import Counter
+from contextlib import contextmanager
+
+__all__ = [ "DEFAULT_SAMPLE_INTERVAL",
+            "StackSampler",
+            "sampledStacks",
+            "mergeProfiles",
+            "writeProfileReport",
+            "mergeSamples" ]
+
+DEFAULT_SAMPLE_INTERVAL = 0.01   # seconds of CPU time
+
+def mergeProfiles(filenames):
+    """
+    A single pstats.Stats for the cProfile dumps `filenames`, or None
+    if there are none
+    """
+    stats = None
+    for filename in sorted(filenames):
+        if stats is None:
+            stats = pstats.Stats(filename)
+        else:
+            stats.add(filename)
+    return stats
+
+def writeProfileReport(stats, prefix, numEntries=100):
+    """
+    Write the merged profile as PREFIX.txt (the top functions by
+    internal time, then by cumulative time, with their callers) and
+    PREFIX.pstats
+    """
+    stats.dump_stats(prefix + ".pstats")
+    with open(prefix + ".txt", "w") as f:
+        stats.stream = f
+        stats.sort_stats("time").print_stats(numEntries)
+        stats.sort_stats("cumulative").print_stats(numEntries)
+        stats.sort_stats("time").print_callers(numEntries)
+        stats.stream = sys.stdout
+    logging.info("Wrote profile report to %s.txt and %s.pstats" % (prefix, prefix))
+
+
+def _frameName(frame):
+    code = frame.f_code
+    return "%s:%s:%d" % (os.path.basename(code.co_filename), code.co_name,
+                         code.co_firstlineno)
+
+def _cpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+class StackSampler(object):
+    """
+    Counts the stacks of this process's running thread, sampled every
+    `interval` seconds of CPU time, each sample weighted by the
+    intervals of CPU time it stands for.  Must be started from the
+    main thread.
+    """
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._lastCpuSeconds = None
+        self._owed = 0.0
+
+    def _sample(self, signum, frame):
+        names = []
+        while frame is not None:
+            names.append(_frameName(frame))
+            frame = frame.f_back
+        # The fraction of an interval left over is carried to the
+        # next sample, so that the weights add up to the CPU time
+        cpuSeconds = _cpuSeconds()
+        owed = self._owed + (cpuSeconds - self._lastCpuSeconds) / self.interval
+        self._lastCpuSeconds = cpuSeconds
+        weight = max(1, int(round(owed)))
+        self._owed = owed - weight
+        self.stacks[";".join(reversed(names))] += weight
+
+    def start(self):
+        self._lastCpuSeconds = _cpuSeconds()
+        signal.signal(signal.SIGPROF, self._sample)
+        # Restart system calls interrupted by the timer, rather than
+        # failing them with EINTR
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            for stack, n in self.stacks.iteritems():
+                f.write("%s %d\n" % (stack, n))
+
+@contextmanager
+def sampledStacks(filename, interval=DEFAULT_SAMPLE_INTERVAL):
+    """
+    Sample the stacks of the enclosed code into the collapsed-stack
+    file `filename`; does nothing if filename is None
+    """
+    if filename is None:
+        yield
+        return
+    sampler = StackSampler(interval)
+    sampler.start()
+    try:
+        yield
+    finally:
+        sampler.stop()
+        sampler.write(filename)
+
+
+def mergeSamples(filenames, outputFilename):
+    """
+    Sum the collapsed-stack files `filenames` into `outputFilename`
+    """
+    stacks = Counter()
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                stack, _, n = line.rstrip("\n").rpartition(" ")
+                stacks[stack] += int(n)
+    with open(outputFilename, "w") as f:
+        for stack in sorted(stacks):
+            f.write("%s %d\n" % (stack, stacks[stack]))
+    logging.info("Wrote %d stack samples to %s" % (sum(stacks.itervalues()), outputFilename))
@@ -0,0 +1,253 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+#
+# progress.py: live progress of a run, for monitoring (--progressFile,
+# --prometheusFile)
+#
+# The result collector tracks the reference bases completed on each
+# contig, against the totals it is to write.  The workers record the
+# time they spend busy on chunks, and the driver the chunks it hands
+# out, in a WorkerActivity, which lives in shared memory.  A thread of
+# the collector periodically rewrites a JSON status file and,
+# optionally, a Prometheus text-format file for the node-exporter
+# textfile collector; both are replaced atomically (write, then
+# rename), so that readers never see a partial file.
+#
+
+import json, logging, multiprocessing, os, threading, time
+from collections import OrderedDict
+
+__all__ = [ "WorkerActivity",
+            "ProgressTracker",
+            "ProgressReporter",
+            "prometheusText" ]
+
+class WorkerActivity(object):
+    """
+    Busy time and chunk count of each worker, and the number of chunks
+    dispatched by the driver, in shared memory.  Must be constructed
+    before the workers are forked.  Each worker claims a slot when it
+    starts and releases it when it ends.
+    """
+    def __init__(self, numWorkers):
+        self.numWorkers       = numWorkers
+        self._inUse           = multiprocessing.Array("b", numWorkers)
+        self.busySeconds      = multiprocessing.RawArray("d", numWorkers)
+        self.chunksProcessed  = multiprocessing.RawArray("l", numWorkers)
+        self.chunksDispatched = multiprocessing.RawValue("l", 0)
+
+    def claimSlot(self):
+        """
+        A free slot for the calling worker, or None if all are taken
+        """
+        with self._inUse.get_lock():
+            for slot in xrange(self.numWorkers):
+                if not self._inUse[slot]:
+                    self._inUse[slot] = 1
+                    return slot
+        return None
+
+    def releaseSlot(self, slot):
+        with self._inUse.get_lock():
+            self._inUse[slot] = 0
+
+    def recordChunk(self, slot, seconds):
+        # A slot has a single writer, so there is no need for a lock
+        self.busySeconds[slot] += seconds
+        self.chunksProcessed[slot] += 1
+
+    def recordDispatch(self, numChunks):
+        # Only the driver writes this
+        self.chunksDispatched.value += numChunks
+
+    @property
+    def chunksQueued(self):
+        return self.chunksDispatched.value - sum(self.chunksProcessed)
+
+
+class ProgressTracker(object):
+    """
+    Reference bases and chunks completed so far, and the resulting
+    rates and status
+    """
+    def __init__(self, basesById, activity=None, resultsQueue=None):
+        self.basesTotal    = OrderedDict(basesById)
+        self.basesDone     = OrderedDict((refId, 0) for refId in self.basesTotal)
+        self.basesReplayed = 0
+        self.chunksDone    = 0
+        self.activity      = activity
+        self.resultsQueue  = resultsQueue
+        self.startTime     = time.time()
+        self.finished      = False
+
+    def recordChunk(self, window, replayed=False):
+        refId, refStart, refEnd = window
+        self.basesDone[refId] += refEnd - refStart
+        if replayed:
+            # Windows replayed from a checkpoint do not count towards
+            # the rate
+            self.basesReplayed += refEnd - refStart
+        else:
+            self.chunksDone += 1
+
+    def _resultsQueueDepth(self):
+        try:
+            return self.resultsQueue.qsize()
+        except (AttributeError, NotImplementedError):
+            return None
+
+    def status(self, contigName=str):
+        elapsed = max(time.time() - self.startTime, 1e-6)
+        basesTotal = sum(self.basesTotal.itervalues())
+        basesDone = sum(self.basesDone.itervalues())
+        basesPerSecond = (basesDone - self.basesReplayed) / elapsed
+        if self.finished:
+            eta = 0.0
+        elif basesPerSecond > 0:
+            eta = round((basesTotal - basesDone) / basesPerSecond, 1)
+        else:
+            eta = None
+        workers = []
+        workQueueDepth = None
+        if self.activity is not None:
+            workQueueDepth = self.activity.chunksQueued
+            for slot in xrange(self.activity.numWorkers):
+                busySeconds = self.activity.busySeconds[slot]
+                workers.append({ "busyFraction" : round(min(busySeconds / elapsed, 1.0), 3),
+                                 "chunks"       : self.activity.chunksProcessed[slot] })
+        return { "state"             : "finished" if self.finished else "running",
+                 "updated"           : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "elapsedSeconds"    : round(elapsed, 1),
+                 "basesCompleted"    : basesDone,
+                 "basesTotal"        : basesTotal,
+                 "fractionCompleted" : round(float(basesDone) / basesTotal, 4) if basesTotal else 1.0,
+                 "basesPerSecond"    : round(basesPerSecond, 1),
+                 "chunksCompleted"   : self.chunksDone,
+                 "chunksPerSecond"   : round(self.chunksDone / elapsed, 2),
+                 "etaSeconds"        : eta,
+                 "queues"            : { "work"    : workQueueDepth,
+                                         "results" : self._resultsQueueDepth() },
+                 "workers"           : workers,
+                 "contigs"           : [ { "name"           : contigName(refId),
+                                           "basesCompleted" : self.basesDone[refId],
+                                           "basesTotal"     : self.basesTotal[refId] }
+                                         for refId in self.basesTotal ] }
+
+
+def _label(value):
+    return '"%s"' % str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def prometheusText(status, prefix="genomicconsensus"):
+    """
+    The status (from ProgressTracker.status) in the Prometheus text
+    exposition format
+    """
+    lines = []
+    def gauge(name, help, samples):
+        lines.append("# HELP %s_%s %s" % (prefix, name, help))
+        lines.append("# TYPE %s_%s gauge" % (prefix, name))
+        for labels, value in samples:
+            if value is None:
+                continue
+            labelText = ",".join("%s=%s" % (k, _label(v)) for (k, v) in labels)
+            lines.append("%s_%s%s %s" % (prefix, name,
+                                         "{%s}" % labelText if labelText else "",
+                                         repr(float(value))))
+    gauge("running", "1 while the run is in progress, 0 once it has finished",
+          [ ((), status["state"] == "running") ])
+    gauge("elapsed_seconds", "Seconds since the run started",
+          [ ((), status["elapsedSeconds"]) ])
+    gauge("bases_completed", "Reference bases completed",
+          [ ((("contig", c["name"]),), c["basesCompleted"]) for c in status["contigs"] ])
+    gauge("bases_total", "Reference bases to be processed",
+          [ ((("contig", c["name"]),), c["basesTotal"]) for c in status["contigs"] ])
+    gauge("chunks_completed", "Chunks completed",
+          [ ((), status["chunksCompleted"]) ])
+    gauge("chunks_per_second", "Chunks completed per second, over the run",
+          [ ((), status["chunksPerSecond"]) ])
+    gauge("eta_seconds", "Estimated seconds until the run completes",
+          [ ((), status["etaSeconds"]) ])
+    gauge("queue_depth", "Work units waiting in a queue",
+          [ ((("queue", name),), depth) for (name, depth) in sorted(status["queues"].items()) ])
+    gauge("worker_busy_fraction", "Fraction of the run a worker has spent processing chunks",
+          [ ((("worker", str(i)),), w["busyFraction"]) for (i, w) in enumerate(status["workers"]) ])
+    return "\n".join(lines) + "\n"
+
+def _writeAtomically(filename, text):
+    temporaryFilename = "%s.tmp.%d" % (filename, os.getpid())
+    with open(temporaryFilename, "w") as f:
+        f.write(text)
+    os.rename(temporaryFilename, filename)
+
+
+class ProgressReporter(object):
+    """
+    Rewrites the status file (JSON) and/or Prometheus file of a
+    ProgressTracker every `interval` seconds, from a background
+    thread, and once more when stopped.
+    """
+    def __init__(self, tracker, progressFilename=None, prometheusFilename=None,
+                 interval=10.0, contigName=str):
+        self.tracker            = tracker
+        self.progressFilename   = progressFilename
+        self.prometheusFilename = prometheusFilename
+        self.interval           = interval
+        self.contigName         = contigName
+        self._stopped           = threading.Event()
+        self._thread            = None
+
+    def write(self):
+        status = self.tracker.status(self.contigName)
+        try:
+            if self.progressFilename:
+                _writeAtomically(self.progressFilename,
+                                 json.dumps(status, indent=2, sort_keys=True) + "\n")
+            if self.prometheusFilename:
+                _writeAtomically(self.prometheusFilename, prometheusText(status))
+        except (IOError, OSError) as e:
+            logging.warn("Could not write progress file: %s" % e)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.tracker.finished = True
+        self.write()
@@ -322,7 +322,10 @@ class QuiverConfig(object):
                  refineDinucleotideRepeats=True,
                  noEvidenceConsensus="nocall",
                  computeConfidence=True,
-                 readStumpinessThreshold=0.1):
+                 readStumpinessThreshold=0.1,
+                 referenceScreen="off",
+                 referenceScreenAlleleFraction=0.3,
+                 windowTimeBudget=0):
 
         self.minMapQV                   = minMapQV
         self.minPoaCoverage             = minPoaCoverage
@@ -334,6 +337,9 @@ class QuiverConfig(object):
         self.noEvidenceConsensus        = noEvidenceConsensus
         self.computeConfidence          = computeConfidence
         self.readStumpinessThreshold    = readStumpinessThreshold
+        self.referenceScreen            = referenceScreen
+        self.referenceScreenAlleleFraction = referenceScreenAlleleFraction
+        self.windowTimeBudget           = windowTimeBudget
         self.parameterSets              = parameterSets
         qct = cc.QuiverConfigTable()
         for (chem, pset) in self.parameterSets.items():
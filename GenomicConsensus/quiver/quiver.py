@@ -43,12 +43,16 @@ from GenomicConsensus.windows import kSpannedIntervals, holes, subWindow
 from GenomicConsensus.variants import filterVariants, annotateVariants
 from GenomicConsensus.quiver.evidence import dumpEvidence
 from GenomicConsensus.quiver import diploid
+from GenomicConsensus.coverageIndex import coverageIndexFor
+from GenomicConsensus.targeted import targetedConsensusAndVariants
+from GenomicConsensus.instrumentation import timed, count
 
 import GenomicConsensus.quiver.model as M
 import GenomicConsensus.quiver.utils as U
 
 def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
-                                  depthLimit, quiverConfig):
+                                  depthLimit, quiverConfig,
+                                  candidateRows=None, loadedReads=None):
     """
     High-level routine for calling the consensus for a
     window of the genome given an alignment file.
@@ -57,24 +61,40 @@ def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
     identify subintervals where a good consensus can be called.
     Creates the desired "no evidence consensus" where there is
     inadequate coverage.
+
+    `candidateRows` and `loadedReads`, if given, are the rows of the
+    reads intersecting an enclosing window and the records already
+    loaded for it (see `readsInWindow`), so that they are not looked
+    up or read again.
     """
     winId, winStart, winEnd = refWindow
     logging.info("Quiver operating on %s" %
                  reference.windowToString(refWindow))
+    count("windows")
+
+    # The reads intersecting the window, as rows of the alignment
+    # index; records are loaded only for the reads used in each interval
+    candidateRows = U.readRowsInWindow(cmpH5, refWindow,
+                                       minMapQV=quiverConfig.minMapQV,
+                                       barcode=options.barcode,
+                                       candidateRows=candidateRows)
 
     if options.fancyChunking:
         # 1) identify the intervals with adequate coverage for quiver
         #    consensus; restrict to intervals of length > 10
-        alnHits = U.readsInWindow(cmpH5, refWindow,
-                                  depthLimit=20000,
-                                  minMapQV=quiverConfig.minMapQV,
-                                  strategy="long-and-strand-balanced",
-                                  stratum=options.readStratum,
-                                  barcode=options.barcode)
-        starts = np.fromiter((hit.tStart for hit in alnHits), np.int)
-        ends   = np.fromiter((hit.tEnd   for hit in alnHits), np.int)
-        intervals = kSpannedIntervals(refWindow, quiverConfig.minPoaCoverage,
-                                      starts, ends, minLength=10)
+        #    (the coverage index bounds the depth from above, so a
+        #    window it shows to be too shallow is skipped outright)
+        coverage = coverageIndexFor(cmpH5, quiverConfig.minMapQV, options.barcode)
+        if coverage.maxDepth(refWindow) < quiverConfig.minPoaCoverage:
+            intervals = []
+        else:
+            rows = U.selectReadRows(cmpH5, candidateRows, refWindow,
+                                    depthLimit=20000,
+                                    strategy="long-and-strand-balanced")
+            starts = cmpH5.index.tStart[rows].astype(np.int)
+            ends   = cmpH5.index.tEnd[rows].astype(np.int)
+            intervals = kSpannedIntervals(refWindow, quiverConfig.minPoaCoverage,
+                                          starts, ends, minLength=10)
         coverageGaps = holes(refWindow, intervals)
         allIntervals = sorted(intervals + coverageGaps)
         if len(allIntervals) > 1:
@@ -95,14 +115,21 @@ def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
         subWin = subWindow(refWindow, interval)
 
         windowRefSeq = referenceContig[intStart:intEnd]
-        alns = U.readsInWindow(cmpH5, subWin,
-                               depthLimit=depthLimit,
-                               minMapQV=quiverConfig.minMapQV,
-                               strategy="long-and-strand-balanced",
-                               stratum=options.readStratum,
-                               barcode=options.barcode)
-        clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
-        clippedAlns = U.filterAlns(subWin, clippedAlns_, quiverConfig)
+        with timed("fetch"):
+            alns = U.readsInWindow(cmpH5, subWin,
+                                   depthLimit=depthLimit,
+                                   minMapQV=quiverConfig.minMapQV,
+                                   strategy="long-and-strand-balanced",
+                                   stratum=options.readStratum,
+                                   barcode=options.barcode,
+                                   candidateRows=candidateRows,
+                                   loadedReads=loadedReads)
+        with timed("clip"):
+            clippedAlns_ = [ aln.clippedTo(*interval) for aln in alns ]
+        with timed("filterAlns"):
+            clippedAlns = U.filterAlns(subWin, clippedAlns_, quiverConfig)
+        count("readsFetched", len(alns))
+        count("readsRejected.filterAlns", len(clippedAlns_) - len(clippedAlns))
 
         if len([ a for a in clippedAlns
                  if a.spansReferenceRange(*interval) ]) >= quiverConfig.minPoaCoverage:
@@ -111,23 +138,39 @@ def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
                           (reference.windowToString(subWin),
                            " ".join([str(hit.readName) for hit in alns])))
 
+            # Windows showing no evidence of a difference from the
+            # reference are polished from the reference, or not at all
+            draft, polish = None, True
+            with timed("referenceScreen"):
+                if (quiverConfig.referenceScreen != "off" and
+                    U.agreesWithReference(subWin, intRefSeq, clippedAlns,
+                                          quiverConfig.referenceScreenAlleleFraction)):
+                    logging.debug("%s: Passed reference screen" %
+                                  reference.windowToString(subWin))
+                    draft, polish = intRefSeq, (quiverConfig.referenceScreen == "seed")
+                    count("intervals.passedReferenceScreen")
+
             css = U.consensusForAlignments(subWin,
                                            intRefSeq,
                                            clippedAlns,
-                                           quiverConfig)
+                                           quiverConfig,
+                                           draft=draft,
+                                           polish=polish)
 
             siteCoverage = U.coverageInWindow(subWin, alns)
 
-            if options.diploid:
-                variants_ = diploid.variantsFromConsensus(subWin, windowRefSeq,
-                                                          css.sequence, css.confidence, siteCoverage,
-                                                          options.aligner,
-                                                          css.mms)
-            else:
-                variants_ = U.variantsFromConsensus(subWin, windowRefSeq,
-                                                    css.sequence, css.confidence, siteCoverage,
-                                                    options.aligner,
-                                                    mms=None)
+            with timed("variants"):
+                if options.diploid:
+                    variants_ = diploid.variantsFromConsensus(subWin, windowRefSeq,
+                                                              css.sequence, css.confidence, siteCoverage,
+                                                              options.aligner,
+                                                              css.mms)
+                else:
+                    variants_ = U.variantsFromConsensus(subWin, windowRefSeq,
+                                                        css.sequence, css.confidence, siteCoverage,
+                                                        options.aligner,
+                                                        mms=None)
+            count("intervals.polished" if css.mms is not None else "intervals.noCall")
 
             filteredVars =  filterVariants(options.minCoverage,
                                            options.minConfidence,
@@ -149,6 +192,7 @@ def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
         else:
             css = QuiverConsensus.noCallConsensus(quiverConfig.noEvidenceConsensus,
                                                   subWin, intRefSeq)
+            count("intervals.inadequateCoverage")
         subConsensi.append(css)
 
     # 4) glue the subwindow consensus objects together to form the
@@ -159,15 +203,53 @@ def consensusAndVariantsForWindow(cmpH5, refWindow, referenceContig,
     return css, variants
 
 
+def variantsOnlyForWindow(cmpH5, refWindow, referenceContig,
+                          depthLimit, quiverConfig):
+    """
+    Consensus and variants for a window under --variantsOnly: only the
+    neighborhoods of candidate variant loci are polished, by
+    consensusAndVariantsForWindow.
+    """
+    _, winStart, winEnd = refWindow
+    # The reads are looked up and loaded once for the window; each
+    # neighborhood picks its reads out of these, loading only those
+    # the window's depth limit left out
+    candidateRows = U.readRowsInWindow(cmpH5, refWindow,
+                                       minMapQV=quiverConfig.minMapQV,
+                                       barcode=options.barcode)
+    with timed("fetch"):
+        rows = U.selectReadRows(cmpH5, candidateRows, refWindow,
+                                depthLimit=depthLimit,
+                                strategy="long-and-strand-balanced").tolist()
+        alns = cmpH5[rows] if rows else []
+    loadedReads = dict(zip(rows, alns))
+
+    def callWindow(subWin):
+        return consensusAndVariantsForWindow(cmpH5, subWin, referenceContig,
+                                             depthLimit, quiverConfig,
+                                             candidateRows=candidateRows,
+                                             loadedReads=loadedReads)
+
+    return targetedConsensusAndVariants(refWindow,
+                                        referenceContig[winStart:winEnd],
+                                        alns,
+                                        callWindow,
+                                        quiverConfig.minPoaCoverage,
+                                        quiverConfig.referenceScreenAlleleFraction,
+                                        quiverConfig.noEvidenceConsensus)
+
+
 class QuiverWorker(object):
 
     @property
     def quiverConfig(self):
         return self._algorithmConfig
 
-    def onChunk(self, workChunk):
+    def onChunk(self, workChunk, depthLimit=None):
         referenceWindow  = workChunk.window
         refId, refStart, refEnd = referenceWindow
+        if depthLimit is None:
+            depthLimit = options.coverage
 
         refSeqInWindow = reference.sequenceInWindow(referenceWindow)
 
@@ -192,9 +274,12 @@ class QuiverWorker(object):
         #
         # Get the consensus for the enlarged window.
         #
-        css_, variants_ = \
-            consensusAndVariantsForWindow(self._inAlnFile, eWindow,
-                                          refContig, options.coverage, self.quiverConfig)
+        if options.variantsOnly:
+            forWindow = variantsOnlyForWindow
+        else:
+            forWindow = consensusAndVariantsForWindow
+        css_, variants_ = forWindow(self._inAlnFile, eWindow,
+                                    refContig, depthLimit, self.quiverConfig)
 
         #
         # Restrict the consensus and variants to the reference window.
@@ -282,6 +367,9 @@ def configure(options, cmpH5):
                           noEvidenceConsensus=options.noEvidenceConsensusCall,
                           refineDinucleotideRepeats=(not options.fastMode) and options.refineDinucleotideRepeats,
                           computeConfidence=(not options.fastMode),
+                          referenceScreen=options.referenceScreen,
+                          referenceScreenAlleleFraction=options.referenceScreenAlleleFraction,
+                          windowTimeBudget=options.windowTimeBudget,
                           parameterSets=params)
 
 def slaveFactories(threaded):
@@ -35,7 +35,9 @@ from collections import Counter
 
 from GenomicConsensus.variants import *
 from GenomicConsensus.utils import *
+from GenomicConsensus.polishing import agreesWithReference, WindowBudget, noConfidence
 from GenomicConsensus.consensus import QuiverConsensus
+from GenomicConsensus.instrumentation import timed, count
 from pbcore.io.rangeQueries import projectIntoRange
 import ConsensusCore as cc
 
@@ -335,7 +337,8 @@ def filterAlns(refWindow, alns, quiverConfig):
              if a.readLength >= (quiverConfig.readStumpinessThreshold * a.referenceSpan) ]
 
 
-def consensusForAlignments(refWindow, refSequence, alns, quiverConfig):
+def consensusForAlignments(refWindow, refSequence, alns, quiverConfig,
+                           draft=None, polish=True):
     """
     Call consensus on this interval---without subdividing the interval
     further.
@@ -343,55 +346,96 @@ def consensusForAlignments(refWindow, refSequence, alns, quiverConfig):
     Testable!
 
     Clipping has already been done!
-    """
-    _, refStart, refEnd = refWindow
 
-    # Compute the POA consensus, which is our initial guess, and
-    # should typically be > 99.5% accurate
-    fwdSequences = [ a.read(orientation="genomic", aligned=False)
-                     for a in alns
-                     if a.spansReferenceRange(refStart, refEnd) ]
-    assert len(fwdSequences) >= quiverConfig.minPoaCoverage
-
-    try:
-        p = cc.PoaConsensus.FindConsensus(fwdSequences[:quiverConfig.maxPoaCoverage])
-    except:
-        logging.info("%s: POA could not be generated" % (refWindow,))
-        return QuiverConsensus.noCallConsensus(quiverConfig.noEvidenceConsensus,
-                                               refWindow, refSequence)
-    ga = cc.Align(refSequence, p.Sequence)
-    numPoaVariants = ga.Errors()
-    poaCss = p.Sequence
+    If `draft` is provided, it will serve as the starting point for
+    polishing.  If not, the POA will be used to generate a draft
+    starting point.
+
+    If `polish` is False, the quiver polishing procedure will not be
+    used, and the draft consensus will be returned, with confidence
+    values computed against the draft.
 
-    # Extract reads into ConsensusCore-compatible objects, and map them into the
-    # coordinates relative to the POA consensus
-    mappedReads = [ quiverConfig.extractMappedRead(aln, refStart) for aln in alns ]
-    queryPositions = cc.TargetToQueryPositions(ga)
-    mappedReads = [ lifted(queryPositions, mr) for mr in mappedReads ]
+    With `quiverConfig.windowTimeBudget` set, a window whose budget
+    runs out returns early, with QVs of 0: the draft, if it runs out
+    before polishing, or the polished template, if it runs out
+    during polishing (which cannot be interrupted) or after.
+    """
+    _, refStart, refEnd = refWindow
+    budget = WindowBudget(quiverConfig.windowTimeBudget, refWindow)
+
+    if draft is None:
+        # Compute the POA consensus, which is our initial guess, and
+        # should typically be > 99.5% accurate
+        fwdSequences = [ a.read(orientation="genomic", aligned=False)
+                         for a in alns
+                         if a.spansReferenceRange(refStart, refEnd) ]
+        assert len(fwdSequences) >= quiverConfig.minPoaCoverage
+
+        try:
+            with timed("poa"):
+                p = cc.PoaConsensus.FindConsensus(fwdSequences[:quiverConfig.maxPoaCoverage])
+        except:
+            logging.info("%s: POA could not be generated" % (refWindow,))
+            count("poa.failed")
+            return QuiverConsensus.noCallConsensus(quiverConfig.noEvidenceConsensus,
+                                                   refWindow, refSequence)
+        draft = p.Sequence
+    with timed("extractReads"):
+        ga = cc.Align(refSequence, draft)
+        poaCss = draft
+
+        # Extract reads into ConsensusCore-compatible objects, and map them into the
+        # coordinates relative to the POA consensus
+        mappedReads = [ quiverConfig.extractMappedRead(aln, refStart) for aln in alns ]
+        queryPositions = cc.TargetToQueryPositions(ga)
+        mappedReads = [ lifted(queryPositions, mr) for mr in mappedReads ]
 
     # Load the mapped reads into the mutation scorer, and iterate
     # until convergence.
     configTbl = quiverConfig.ccQuiverConfigTbl
     mms = cc.SparseSseQvMultiReadMutationScorer(configTbl, poaCss)
-    for mr in mappedReads:
-        mms.AddRead(mr)
+    with timed("addRead"):
+        for mr in mappedReads:
+            mms.AddRead(mr)
+
+    return consensusFromScorer(refWindow, refSequence, mms, poaCss,
+                               quiverConfig, budget, polish)
+
+def consensusFromScorer(refWindow, refSequence, mms, draft,
+                        quiverConfig, budget, polish=True):
+    """
+    The QuiverConsensus for the window, from the mutation scorer `mms`
+    holding its reads and the `draft`: polished unless `polish` is
+    False, within the WindowBudget `budget`.
+    """
+    if not polish:
+        confidence = budget.confidence(consensusConfidence, mms, len(draft),
+                                       quiverConfig.computeConfidence)
+        return QuiverConsensus(refWindow, draft, confidence, mms)
+
+    if budget.exceededAt("draft"):
+        return QuiverConsensus(refWindow, draft, noConfidence(len(draft)), mms)
 
     # Iterate until covergence
-    _, quiverConverged = refineConsensus(mms, quiverConfig)
+    with timed("polish"):
+        quiverCss, quiverConverged = refineConsensus(mms, quiverConfig)
+    if budget.exceededAt("polish"):
+        # The best template so far, converged or not
+        return QuiverConsensus(refWindow, quiverCss, noConfidence(len(quiverCss)), mms)
     if quiverConverged:
         if quiverConfig.refineDinucleotideRepeats:
-            refineDinucleotideRepeats(mms)
+            with timed("dinucleotideRepeats"):
+                refineDinucleotideRepeats(mms)
         quiverCss = mms.Template()
-        if quiverConfig.computeConfidence:
-            confidence = consensusConfidence(mms)
-        else:
-            confidence = np.zeros(shape=len(quiverCss), dtype=int)
+        confidence = budget.confidence(consensusConfidence, mms, len(quiverCss),
+                                       quiverConfig.computeConfidence)
         return QuiverConsensus(refWindow,
                                quiverCss,
                                confidence,
                                mms)
     else:
         logging.info("%s: Quiver did not converge to MLE" % (refWindow,))
+        count("polish.notConverged")
         return QuiverConsensus.noCallConsensus(quiverConfig.noEvidenceConsensus,
                                                refWindow, refSequence)
 
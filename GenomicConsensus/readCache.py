@@ -0,0 +1,191 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# readCache.py: per-worker cache of decoded reads
+#
+# With the default chunk size a long read overlaps dozens of work
+# chunks, and without a cache it is fetched and decoded again for each
+# of them.  A worker with a cache wraps its alignment file in a
+# CachingAlignmentFile, which keeps the alignment records it hands out,
+# keyed by row number; the arrow model also keeps the decoded native
+# read and its base features with the record, and slices them for each
+# clipped alignment.
+#
+# The cache is an LRU bounded by an estimate of the bytes held.  It is
+# most effective when each worker gets runs of contiguous chunks
+# (--maxChunksPerBatch), so that the reads it decodes are reused.
+#
+
+import logging, threading
+from collections import OrderedDict
+
+__all__ = [ "DecodedReadCache",
+            "CachingAlignmentFile",
+            "setWorkerCache",
+            "workerCache" ]
+
+# Rough size of a decoded alignment record (sequence, qualities, kinetics
+# and alignment) per aligned reference base, plus a fixed overhead
+RECORD_BYTES_PER_BASE = 8
+RECORD_OVERHEAD_BYTES = 1024
+
+class _Entry(object):
+    __slots__ = ("alignment", "features", "size")
+
+    def __init__(self, alignment, size):
+        self.alignment = alignment
+        self.features  = None
+        self.size      = size
+
+class DecodedReadCache(object):
+    """
+    LRU cache of alignment records and their decoded features, keyed
+    by row number, holding at most about `maxBytes`.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes    = maxBytes
+        self.currentBytes = 0
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self._entries    = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, rowNumber):
+        entry = self._entries.pop(rowNumber, None)
+        if entry is not None:
+            # Move to the most-recently-used end
+            self._entries[rowNumber] = entry
+        return entry
+
+    def _grow(self, entry, numBytes):
+        entry.size += numBytes
+        self.currentBytes += numBytes
+        while self.currentBytes > self.maxBytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.currentBytes -= evicted.size
+            self.evictions += 1
+
+    def alignment(self, alnFile, rowNumber):
+        """
+        The alignment record for the row, fetched from `alnFile` on a
+        miss.
+        """
+        entry = self._lookup(rowNumber)
+        if entry is not None:
+            self.hits += 1
+            return entry.alignment
+        self.misses += 1
+        alignment = alnFile[rowNumber]
+        entry = _Entry(alignment, 0)
+        self._entries[rowNumber] = entry
+        span = alnFile.index.tEnd[rowNumber] - alnFile.index.tStart[rowNumber]
+        self._grow(entry, RECORD_OVERHEAD_BYTES + RECORD_BYTES_PER_BASE * int(span))
+        return alignment
+
+    def nativeReadAndFeatures(self, aln, decode):
+        """
+        The native read bases and base features of the clipped
+        alignment `aln`, as (read, features), sliced from those of the
+        whole alignment.  `decode(wholeAlignment)` computes
+        (read, features) for the whole alignment on a miss, where
+        `features` is a tuple of byte vectors (numpy arrays, or vectors
+        of the consensus library, ready to use) indexed like the read.
+        Returns None if the row is not in the cache.
+        """
+        entry = self._lookup(getattr(aln, "rowNumber", None))
+        if entry is None:
+            return None
+        whole = entry.alignment
+        if entry.features is None:
+            self.misses += 1
+            read, features = decode(whole)
+            entry.features = (read, features)
+            self._grow(entry, len(read) + sum(len(f) for f in features))
+        else:
+            self.hits += 1
+            read, features = entry.features
+        start = aln.readStart - whole.readStart
+        end   = aln.readEnd   - whole.readStart
+        return read[start:end], tuple(f[start:end] for f in features)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { "hits"      : self.hits,
+                 "misses"    : self.misses,
+                 "evictions" : self.evictions,
+                 "entries"   : len(self._entries),
+                 "bytes"     : self.currentBytes,
+                 "hitRate"   : float(self.hits) / lookups if lookups else 0.0 }
+
+    def logStats(self, workerName):
+        stats = self.stats()
+        logging.info("%s read cache: %d hits, %d misses (hit rate %.1f%%), "
+                     "%d evictions, %d entries (%.1f MB) at finish" %
+                     (workerName, stats["hits"], stats["misses"], 100 * stats["hitRate"],
+                      stats["evictions"], stats["entries"], stats["bytes"] / 2.0**20))
+
+
+class CachingAlignmentFile(object):
+    """
+    Stands in for an alignment file, serving the alignments it is
+    indexed for by row number from a DecodedReadCache.  Everything
+    else is passed through to the file.
+    """
+    def __init__(self, alnFile, cache):
+        self._alnFile = alnFile
+        self._cache   = cache
+
+    def __getitem__(self, rowNumbers):
+        if isinstance(rowNumbers, (int, long)):
+            return self._cache.alignment(self._alnFile, rowNumbers)
+        if isinstance(rowNumbers, slice):
+            return self._alnFile[rowNumbers]
+        return [ self._cache.alignment(self._alnFile, int(r)) for r in rowNumbers ]
+
+    def __len__(self):
+        return len(self._alnFile)
+
+    def __getattr__(self, name):
+        return getattr(self._alnFile, name)
+
+
+# The cache of the worker running in this process (or thread, in
+# threaded mode), used by the algorithm models
+_worker = threading.local()
+
+def setWorkerCache(cache):
+    _worker.cache = cache
+
+def workerCache():
+    return getattr(_worker, "cache", None)
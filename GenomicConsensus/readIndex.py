@@ -0,0 +1,248 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# readIndex.py: fast lookup of the reads overlapping a window, from
+# the alignment index arrays
+#
+# The index is partitioned once: the reads passing the run's mapQV and
+# barcode filters are sorted by (tId, tStart, tEnd), so that each
+# contig's reads form a contiguous slice, sorted by position.  Chunk
+# enumeration, shard planning and window lookups all work from these
+# slices, rather than scanning the whole index for each contig.
+#
+# The reads overlapping a window [s, e) are found by two binary
+# searches: the reads starting before e, less those at the head of the
+# slice whose running maximum tEnd is at or before s (none of them can
+# reach the window).  Only the few reads in between need to be checked
+# individually.
+#
+# The partition can be kept in a sidecar file next to the input
+# (--readIndexSidecar), so that the workers, and later runs on the same
+# input, load it rather than rebuilding it.  The coverage index
+# (coverageIndex.py) is derived from the partition, and kept alongside.
+#
+
+import ast, logging, numpy as np, os, os.path, tempfile, weakref
+
+__all__ = [ "ReadIndex",
+            "readIndexFor",
+            "setSidecarInput",
+            "sidecarInput",
+            "sidecarFilename",
+            "sidecarFingerprint" ]
+
+SIDECAR_VERSION = 1
+
+class ContigReads(object):
+    """
+    The (filtered) reads aligned to one contig, as arrays sorted by
+    (tStart, tEnd).
+    """
+    def __init__(self, rows, tStart, tEnd):
+        self.rows   = rows
+        self.tStart = tStart
+        self.tEnd   = tEnd
+        self.maxEndSoFar = np.maximum.accumulate(tEnd) if len(tEnd) else tEnd
+
+    def __len__(self):
+        return len(self.rows)
+
+    def overlapping(self, start, end):
+        """
+        Positions (in this contig) of the reads overlapping [start, end)
+        """
+        lo = np.searchsorted(self.maxEndSoFar, start, side="right")
+        hi = np.searchsorted(self.tStart, end, side="left")
+        if lo >= hi:
+            return np.arange(0)
+        return lo + np.flatnonzero(self.tEnd[lo:hi] > start)
+
+
+class ReadIndex(object):
+    """
+    The reads of an alignment file meeting the mapQV and barcode
+    criteria, partitioned by contig.
+    """
+    def __init__(self, alnFile, minMapQV=0, barcode=None, partition=None):
+        self._alnFile = weakref.ref(alnFile)
+        if partition is None:
+            partition = self._partition(alnFile, minMapQV, barcode)
+        # (int64 throughout, as searchsorted would otherwise convert
+        # the whole array on each call)
+        self.rows, self.tStart, self.tEnd, self.contigTIds, self.contigOffsets = partition
+        self._sliceByTId = dict(zip(self.contigTIds.tolist(),
+                                    zip(self.contigOffsets[:-1].tolist(),
+                                        self.contigOffsets[1:].tolist())))
+        self._contigs = {}
+
+    @staticmethod
+    def _partition(alnFile, minMapQV, barcode):
+        good = np.asarray(alnFile.mapQV) >= minMapQV
+        if barcode is not None:
+            # this wont work with CmpH5 (no bc in index):
+            bcLeft, bcRight = ast.literal_eval(barcode)
+            good &= ((alnFile.index.bcLeft == bcLeft) &
+                     (alnFile.index.bcRight == bcRight))
+        rows   = np.flatnonzero(good)
+        tId    = np.asarray(alnFile.tId)[rows]
+        tStart = np.asarray(alnFile.index.tStart)[rows].astype(np.int64)
+        tEnd   = np.asarray(alnFile.index.tEnd)[rows].astype(np.int64)
+        order = np.lexsort((tEnd, tStart, tId))
+        rows, tId, tStart, tEnd = rows[order], tId[order], tStart[order], tEnd[order]
+        contigTIds, firstRead = np.unique(tId, return_index=True)
+        contigOffsets = np.append(firstRead, len(rows))
+        return rows, tStart, tEnd, contigTIds, contigOffsets
+
+    def tIdOf(self, refId):
+        return self._alnFile().referenceInfo(refId).ID
+
+    def contigSlices(self):
+        """
+        Generate (tId, start, end) for the contigs with reads, where
+        [start, end) is the contig's slice of the partition.
+        """
+        for tId, (lo, hi) in sorted(self._sliceByTId.iteritems()):
+            yield tId, lo, hi
+
+    def contig(self, refId):
+        contigReads = self._contigs.get(refId)
+        if contigReads is None:
+            lo, hi = self._sliceByTId.get(self.tIdOf(refId), (0, 0))
+            contigReads = ContigReads(self.rows[lo:hi], self.tStart[lo:hi], self.tEnd[lo:hi])
+            self._contigs[refId] = contigReads
+        return contigReads
+
+    def rowsInWindow(self, window):
+        """
+        Row numbers of the reads overlapping the window, in file order.
+        """
+        refId, start, end = window
+        contigReads = self.contig(refId)
+        return np.sort(contigReads.rows[contigReads.overlapping(start, end)])
+
+    #
+    # Sidecar files
+    #
+
+    def save(self, filename, fingerprint):
+        """
+        Write the partition to `filename`, atomically.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmpFilename = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f,
+                         fingerprint=np.array(repr(sorted(fingerprint.items()))),
+                         rows=self.rows, tStart=self.tStart, tEnd=self.tEnd,
+                         contigTIds=self.contigTIds, contigOffsets=self.contigOffsets)
+            os.rename(tmpFilename, filename)
+        except:
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+            raise
+
+    @classmethod
+    def load(cls, filename, alnFile, fingerprint):
+        """
+        The ReadIndex saved in `filename`, or None if there is no such
+        file or it was written for a different input or filters.
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            saved = np.load(filename)
+            if str(saved["fingerprint"]) != repr(sorted(fingerprint.items())):
+                return None
+            partition = tuple(saved[name] for name in
+                              ("rows", "tStart", "tEnd", "contigTIds", "contigOffsets"))
+        except Exception as e:
+            logging.warn("Ignoring unreadable read index sidecar %s (%s)" % (filename, e))
+            return None
+        return cls(alnFile, partition=partition)
+
+
+_readIndices = weakref.WeakKeyDictionary()   # alnFile -> {(minMapQV, barcode): ReadIndex}
+_sidecarInput = None
+
+def setSidecarInput(inputFilename):
+    """
+    Keep the read indices in sidecar files next to `inputFilename`
+    (None to stop).
+    """
+    global _sidecarInput
+    _sidecarInput = inputFilename
+
+def sidecarInput():
+    return _sidecarInput
+
+def sidecarFilename(inputFilename, minMapQV, barcode, extension="gcindex.npz"):
+    filters = "q%d" % minMapQV
+    if barcode is not None:
+        filters += "-bc" + "-".join(str(bc) for bc in ast.literal_eval(barcode))
+    return "%s.%s.%s" % (inputFilename, filters, extension)
+
+def sidecarFingerprint(inputFilename, alnFile, minMapQV, barcode):
+    st = os.stat(inputFilename)
+    return { "version"  : SIDECAR_VERSION,
+             "size"     : st.st_size,
+             "mtime"    : int(st.st_mtime),
+             "numReads" : len(alnFile.index.tStart),
+             "minMapQV" : minMapQV,
+             "barcode"  : barcode }
+
+def _loadOrBuild(alnFile, minMapQV, barcode):
+    if _sidecarInput is None:
+        return ReadIndex(alnFile, minMapQV, barcode)
+    filename = sidecarFilename(_sidecarInput, minMapQV, barcode)
+    fingerprint = sidecarFingerprint(_sidecarInput, alnFile, minMapQV, barcode)
+    readIndex = ReadIndex.load(filename, alnFile, fingerprint)
+    if readIndex is not None:
+        logging.debug("Loaded read index from %s" % filename)
+        return readIndex
+    readIndex = ReadIndex(alnFile, minMapQV, barcode)
+    try:
+        readIndex.save(filename, fingerprint)
+        logging.info("Saved read index to %s" % filename)
+    except (IOError, OSError) as e:
+        logging.warn("Could not save read index to %s (%s)" % (filename, e))
+    return readIndex
+
+def readIndexFor(alnFile, minMapQV=0, barcode=None):
+    """
+    The ReadIndex for the file and filters, created (or loaded from
+    the sidecar file) on first use.
+    """
+    byFilter = _readIndices.setdefault(alnFile, {})
+    key = (minMapQV, barcode)
+    if key not in byFilter:
+        byFilter[key] = _loadOrBuild(alnFile, minMapQV, barcode)
+    return byFilter[key]
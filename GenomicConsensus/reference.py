@@ -32,20 +32,24 @@
 
 from __future__ import absolute_import
 
-import logging, re, numpy as np
+import itertools, logging, re
 from collections import OrderedDict
 from pbcore.io import ReferenceSet
 
-from .windows import holes, kCoveredIntervals, enumerateIntervals
+from .windows import holes, enumerateIntervals
 from .utils import die, nub
+from .coverageIndex import coverageIndexFor
 
 class WorkChunk(object):
     """
-    A chunk of the reference
+    A chunk of the reference.  `cost`, if known, is an estimate of
+    the work involved in processing the chunk (see
+    `fancyEnumerateChunks`).
     """
-    def __init__(self, window, hasCoverage):
+    def __init__(self, window, hasCoverage, cost=None):
         self.window      = window
         self.hasCoverage = hasCoverage
+        self.cost        = cost
 
 class UppercasingMmappedFastaSequence(object):
     def __init__(self, mmappedFastaSequence):
@@ -208,36 +212,72 @@ def enumerateChunks(refId, referenceStride, referenceWindows=()):
             yield WorkChunk((refId, s, e), True)
 
 def fancyEnumerateChunks(alnFile, refId, referenceStride,
-                         minCoverage, minMapQV, referenceWindows=()):
+                         minCoverage, minMapQV, referenceWindows=(),
+                         maxCoverage=None):
     """
     Enumerate chunks, creating chunks with hasCoverage=False for
     coverage cutouts.
-    """
-    # Pull out rows with this refId and good enough MapQV
-    rows = alnFile.index[
-        ((alnFile.tId == alnFile.referenceInfo(refId).ID) &
-         (alnFile.mapQV >= minMapQV))]
-
-    unsorted_tStart = rows.tStart
-    unsorted_tEnd = rows.tEnd
 
-    # Sort (expected by CoveredIntervals)
-    sort_order = np.lexsort((unsorted_tEnd, unsorted_tStart))
-    tStart = unsorted_tStart[sort_order].tolist()
-    tEnd = unsorted_tEnd[sort_order].tolist()
+    Each chunk is annotated with an estimate of its cost: the number
+    of aligned read bases falling in the chunk, capped at
+    `maxCoverage` times the chunk length (since no more than
+    `maxCoverage` reads will be used).
+    """
+    # Depth along the contig, counting the reads with good enough MapQV
+    coverage = coverageIndexFor(alnFile, minMapQV).contig(refId)
 
     for span in enumerateSpans(refId, referenceWindows):
         _, spanStart, spanEnd = span
-        coveredIntervals = kCoveredIntervals(minCoverage, tStart, tEnd, spanStart, spanEnd)
+        coveredIntervals = coverage.coveredIntervals(minCoverage, spanStart, spanEnd)
         unCoveredIntervals = holes(span, coveredIntervals)
 
+        chunks = []
         for (s, e) in sorted(list(coveredIntervals) + unCoveredIntervals):
             win = (refId, s, e)
             if (s, e) in coveredIntervals:
-                for chunk in enumerateChunks(refId, referenceStride, [(refId, s, e)]):
-                    yield chunk
+                chunks.extend(enumerateChunks(refId, referenceStride, [(refId, s, e)]))
             else:
-                yield WorkChunk(win, False)
+                chunks.append(WorkChunk(win, False))
+
+        # Annotate with cost estimates
+        intervals = [ chunk.window[1:] for chunk in chunks ]
+        costs = coverage.alignedBases(intervals)
+        for chunk, cost in zip(chunks, costs):
+            _, s, e = chunk.window
+            if not chunk.hasCoverage:
+                cost = 0
+            elif maxCoverage is not None:
+                cost = min(cost, maxCoverage * (e - s))
+            chunk.cost = int(cost)
+            yield chunk
+
+
+def costOrderedChunks(chunks, lookahead=None):
+    """
+    Order chunks for dispatch, most expensive first, so that a deep
+    window (amplicon, rDNA, ...) does not end up at the tail of the
+    queue, leaving the other workers idle while it is processed.
+    Cheap chunks, including the coverage cutouts, fill in at the end.
+    The sort is stable, so chunks of equal cost stay in genome order.
+
+    With a `lookahead`, chunks are only reordered within successive
+    blocks of that many chunks in genome order.  The result collector
+    writes output in genome order, holding any chunk that finishes
+    ahead of its turn; the lookahead bounds how many it can be made to
+    hold, where a global sort could make it hold most of the genome.
+    """
+    byCost = lambda chunk: -(chunk.cost or 0)
+    if not lookahead:
+        return sorted(chunks, key=byCost)
+    return _costOrderedBlocks(iter(chunks), lookahead, byCost)
+
+def _costOrderedBlocks(chunks, lookahead, byCost):
+    while True:
+        block = list(itertools.islice(chunks, lookahead))
+        if not block:
+            return
+        for chunk in sorted(block, key=byCost):
+            yield chunk
 
 
 def numReferenceBases(refId, referenceWindows=()):
@@ -0,0 +1,236 @@
+#################################################################################
+# Copyright (c) 2011-2013, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# resultShards.py: worker results written to disk rather than sent
+# through the results queue (--resultShards)
+#
+# Each worker appends its results to its own shard file: for every
+# chunk, the consensus sequence, its QVs (one byte per base) and a
+# compact table of the variants.  Only a ShardedResult descriptor,
+# giving the location of the record, is put on the results queue.
+# The collector reads the records back through memory maps of the
+# shard files (and plain reads of what was written since the last
+# map), a chunk at a time, as it writes its output, so its memory use
+# does not grow with the contig length.
+#
+
+import cPickle, mmap, numpy as np, os, os.path, struct
+
+from .variants import Variant
+
+__all__ = [ "ResultShardWriter",
+            "ShardedResult",
+            "closeShards" ]
+
+# refStart, refEnd, confidence, coverage, frequency1, frequency2, and
+# the lengths of refSeq, readSeq1, readSeq2 and the pickled annotations
+_VARIANT_HEADER = struct.Struct("<10i")
+_NONE = -1
+
+def _encodeInt(value):
+    return _NONE if value is None else int(value)
+
+def _decodeInt(value):
+    return None if value == _NONE else value
+
+def encodeVariants(variants):
+    parts = []
+    for v in variants:
+        annotations = cPickle.dumps(v.annotations, 2) if v.annotations is not None else None
+        strings = (v.refSeq, v.readSeq1, v.readSeq2, annotations)
+        parts.append(_VARIANT_HEADER.pack(
+            v.refStart, v.refEnd,
+            _encodeInt(v.confidence), _encodeInt(v.coverage),
+            _encodeInt(v.frequency1), _encodeInt(v.frequency2),
+            *[ _NONE if s is None else len(s) for s in strings ]))
+        parts.extend(s for s in strings if s)
+    return "".join(parts)
+
+def decodeVariants(refId, buf):
+    variants = []
+    pos = 0
+    while pos < len(buf):
+        fields = _VARIANT_HEADER.unpack_from(buf, pos)
+        pos += _VARIANT_HEADER.size
+        strings = []
+        for length in fields[6:]:
+            if length == _NONE:
+                strings.append(None)
+            else:
+                strings.append(buf[pos:pos+length])
+                pos += length
+        refSeq, readSeq1, readSeq2, annotations = strings
+        refStart, refEnd, confidence, coverage, frequency1, frequency2 = fields[:6]
+        variants.append(Variant(refId, refStart, refEnd, refSeq, readSeq1, readSeq2,
+                                confidence=_decodeInt(confidence),
+                                coverage=_decodeInt(coverage),
+                                frequency1=_decodeInt(frequency1),
+                                frequency2=_decodeInt(frequency2),
+                                annotations=(cPickle.loads(annotations)
+                                             if annotations is not None else None)))
+    return variants
+
+
+class ResultShardWriter(object):
+    """
+    Appends results to the shard file of one worker.  The file is
+    opened on first use, so that the writer can be constructed before
+    the worker process is forked.
+    """
+    def __init__(self, directory, name):
+        self.filename = os.path.join(directory, "shard-%s.bin" % name)
+        self._file = None
+
+    def write(self, result):
+        """
+        (window, (css, variants)) -> ShardedResult
+        """
+        window, (css, variants) = result
+        if self._file is None:
+            self._file = open(self.filename, "ab")
+        sequence = css.sequence
+        confidence = np.asarray(css.confidence, dtype=np.uint8)
+        variantTable = encodeVariants(variants)
+        offset = self._file.tell()
+        self._file.write(sequence)
+        self._file.write(confidence.tostring())
+        self._file.write(variantTable)
+        # The collector must see the record before the descriptor
+        self._file.flush()
+        return ShardedResult(window, self.filename, offset,
+                             len(sequence), len(variantTable))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class _MappedShard(object):
+    """
+    A shard file, in the collector process.  Shard files grow as the
+    run proceeds, and records are read back soon after they are
+    written, mostly beyond the end of any map made earlier.  Those are
+    read from the file; the map is only replaced once the file has at
+    least doubled in size since it was made, so a shard is mapped a
+    number of times logarithmic in its size.
+    """
+    def __init__(self, filename):
+        self._file   = open(filename, "rb")
+        self._mapped = None
+        self.numMaps = 0
+
+    @property
+    def mappedLength(self):
+        return len(self._mapped) if self._mapped is not None else 0
+
+    def read(self, start, end):
+        if end > self.mappedLength:
+            size = os.fstat(self._file.fileno()).st_size
+            if size >= 2 * self.mappedLength:
+                if self._mapped is not None:
+                    self._mapped.close()
+                self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.numMaps += 1
+        if end <= self.mappedLength:
+            return self._mapped[start:end]
+        self._file.seek(start)
+        return self._file.read(end - start)
+
+    def close(self):
+        if self._mapped is not None:
+            self._mapped.close()
+        self._file.close()
+
+_mappedShards = {}
+
+def _shardBytes(filename, start, end):
+    if start == end:
+        return ""
+    shard = _mappedShards.get(filename)
+    if shard is None:
+        shard = _mappedShards[filename] = _MappedShard(filename)
+    return shard.read(start, end)
+
+def closeShards():
+    for shard in _mappedShards.itervalues():
+        shard.close()
+    _mappedShards.clear()
+
+
+class ShardedResult(object):
+    """
+    Descriptor of a result record in a shard file.  It stands in for
+    the Consensus object of the chunk: the `sequence` and `confidence`
+    are read from the shard on access.
+    """
+    def __init__(self, window, filename, offset, length, variantTableLength):
+        self.refWindow          = window
+        self.filename           = filename
+        self.offset             = offset
+        self.length             = length
+        self.variantTableLength = variantTableLength
+
+    def __cmp__(self, other):
+        return cmp(self.refWindow, other.refWindow)
+
+    @property
+    def window(self):
+        return self.refWindow
+
+    @property
+    def sequence(self):
+        return _shardBytes(self.filename, self.offset, self.offset + self.length)
+
+    @property
+    def confidence(self):
+        start = self.offset + self.length
+        return np.frombuffer(_shardBytes(self.filename, start, start + self.length),
+                             dtype=np.uint8)
+
+    @property
+    def variants(self):
+        return _ShardedVariants(self)
+
+
+class _ShardedVariants(object):
+    """
+    The variants of a ShardedResult, decoded when iterated.
+    """
+    def __init__(self, result):
+        self._result = result
+
+    def __iter__(self):
+        r = self._result
+        start = r.offset + 2 * r.length
+        return iter(decodeVariants(r.refWindow[0],
+                                   _shardBytes(r.filename, start,
+                                               start + r.variantTableLength)))
@@ -0,0 +1,248 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+# scatter.py: contig-level scatter/gather of a variantCaller run
+#
+#   variantCaller --scatter N INPUT -r REFERENCE -o plan.json
+#
+# assigns the reference contigs to N shards, balancing the aligned
+# bases (from the alignment index) rather than the number of contigs.
+# Each shard is then run as an ordinary job, with the shard's
+# "referenceWindows" as the -w argument; the windows cover whole
+# contigs, so the shard outputs are named as in an unsharded run.
+#
+#   variantCaller --gather plan.json -o out.gff -o out.fasta SHARD_OUTPUTS...
+#
+# merges the shard outputs into files in reference order, with the GFF
+# header of an unsharded run.  The merge streams: each shard file is
+# scanned once to find the byte ranges of its contigs, and those
+# ranges are then copied to the output in reference order.
+#
+
+import heapq, json, logging, numpy as np
+from collections import defaultdict, namedtuple
+
+from .utils import fileFormat
+from .readIndex import readIndexFor
+
+__all__ = [ "alignedBasesByContig",
+            "planShards",
+            "writePlan",
+            "readPlan",
+            "gather" ]
+
+PLAN_VERSION = 1
+
+PlannedContig = namedtuple("PlannedContig", ("name", "fullName", "length", "alignedBases"))
+
+def alignedBasesByContig(alnFile, referenceContigs, minMapQV):
+    """
+    Aligned bases per contig, from the alignment index, as a list of
+    PlannedContig in reference order.
+    """
+    readIndex = readIndexFor(alnFile, minMapQV)
+    contigs = []
+    for contig in referenceContigs:
+        contigReads = readIndex.contig(contig.name)
+        contigs.append(PlannedContig(contig.name, contig.fullName, contig.length,
+                                     int(np.sum(contigReads.tEnd - contigReads.tStart))))
+    return contigs
+
+def planShards(contigs, numShards):
+    """
+    Assign whole contigs to shards, greedily placing the contigs in
+    decreasing order of aligned bases on the least-loaded shard (the
+    LPT heuristic).  Returns a list of shards, each a list of contigs
+    in reference order; shards that would be empty are dropped.
+    """
+    order = dict((contig.name, i) for (i, contig) in enumerate(contigs))
+    loads = [ (0, shardId) for shardId in xrange(numShards) ]
+    assignment = defaultdict(list)
+    for contig in sorted(contigs, key=lambda c: (-c.alignedBases, order[c.name])):
+        load, i = heapq.heappop(loads)
+        assignment[i].append(contig)
+        heapq.heappush(loads, (load + contig.alignedBases, i))
+    shards = [ sorted(assignment[shardId], key=lambda c: order[c.name])
+               for shardId in xrange(numShards) if assignment[shardId] ]
+    total = sum(c.alignedBases for c in contigs)
+    if shards and total:
+        largest = max(contigs, key=lambda c: c.alignedBases)
+        if largest.alignedBases > 1.5 * total / len(shards):
+            logging.warn("Contig %s holds %.0f%% of the aligned bases; "
+                         "shards cannot be balanced at the contig level" %
+                         (largest.name, 100.0 * largest.alignedBases / total))
+    return shards
+
+def writePlan(filename, shards, contigs, inputFilename, referenceFilename):
+    plan = { "version"           : PLAN_VERSION,
+             "inputFilename"     : inputFilename,
+             "referenceFilename" : referenceFilename,
+             "contigs"           : [ c._asdict() for c in contigs ],
+             "shards"            : [] }
+    for i, shard in enumerate(shards):
+        plan["shards"].append(
+            { "id"               : i,
+              "contigs"          : [ c.name for c in shard ],
+              "alignedBases"     : sum(c.alignedBases for c in shard),
+              "referenceWindows" : ",".join("%s:0-%d" % (c.name, c.length)
+                                            for c in shard) })
+    with open(filename, "w") as f:
+        json.dump(plan, f, indent=2)
+
+def readPlan(filename):
+    with open(filename) as f:
+        plan = json.load(f)
+    if plan.get("version") != PLAN_VERSION:
+        raise ValueError("Unrecognized shard plan format in %s" % filename)
+    plan["contigs"] = [ PlannedContig(**c) for c in plan["contigs"] ]
+    return plan
+
+
+#
+# Gather
+#
+
+def _fastaRecordKey(line):
+    # ">chr1|arrow" -> "chr1"
+    return line[1:].rstrip("\n").rpartition("|")[0]
+
+def _indexFasta(f):
+    """
+    Generate (key, startOffset, endOffset) for the records in a FASTA
+    file.
+    """
+    key, start = None, 0
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        if not line or line.startswith(">"):
+            if key is not None:
+                yield key, start, offset
+            if not line:
+                return
+            key, start = _fastaRecordKey(line), offset
+
+def _indexFastq(f):
+    while True:
+        start = f.tell()
+        header = f.readline()
+        if not header:
+            return
+        for i in xrange(3):
+            f.readline()
+        yield _fastaRecordKey(header), start, f.tell()
+
+def _indexGff(f):
+    """
+    Generate (seqid, startOffset, endOffset) for each run of records
+    on the same sequence in a GFF file, skipping the header.
+    """
+    key, start = None, None
+    while True:
+        offset = f.tell()
+        line = f.readline()
+        newKey = line.split("\t", 1)[0] if (line and not line.startswith("#")) else None
+        if newKey != key:
+            if key is not None:
+                yield key, start, offset
+            key, start = newKey, offset
+        if not line:
+            return
+
+def _copyRange(f, start, end, out, bufferSize=1<<20):
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        buf = f.read(min(bufferSize, remaining))
+        if not buf:
+            break
+        out.write(buf)
+        remaining -= len(buf)
+
+def _gatherRanges(inputFilenames, indexer, contigKeys, sink):
+    """
+    Pass the byte ranges of the records in the input files to
+    `sink(f, start, end)`, in the order given by contigKeys.
+    """
+    inputs = [ open(fn, "rb") for fn in inputFilenames ]
+    try:
+        rangesByKey = defaultdict(list)
+        for f in inputs:
+            for key, start, end in indexer(f):
+                rangesByKey[key].append((f, start, end))
+        unknown = set(rangesByKey) - set(contigKeys)
+        if unknown:
+            raise ValueError("Records for contigs not in the shard plan: %s" %
+                             ", ".join(sorted(unknown)))
+        for key in contigKeys:
+            for f, start, end in rangesByKey.get(key, ()):
+                sink(f, start, end)
+    finally:
+        for f in inputs:
+            f.close()
+
+def gather(plan, outputFilenames, inputFilenames, optionsDict):
+    """
+    Merge the shard outputs, grouping the input files by format and
+    writing one output of each format requested.
+    """
+    inputsByFormat = defaultdict(list)
+    for fn in inputFilenames:
+        inputsByFormat[fileFormat(fn)].append(fn)
+    for fn in outputFilenames + inputFilenames:
+        if fn.endswith(".gz"):
+            raise ValueError("Cannot gather compressed file %s" % fn)
+
+    contigs = plan["contigs"]
+    contigKeys = [ c.fullName for c in contigs ]
+    for outputFilename in outputFilenames:
+        fmt = fileFormat(outputFilename)
+        if not inputsByFormat[fmt]:
+            raise ValueError("No %s shard outputs to gather into %s" % (fmt, outputFilename))
+        logging.info("Gathering %d %s files into %s" %
+                     (len(inputsByFormat[fmt]), fmt, outputFilename))
+        if fmt == "GFF":
+            from pbcore.io import Gff3Record
+            from .io.VariantsGffWriter import VariantsGffWriter
+            writer = VariantsGffWriter(outputFilename, optionsDict, contigs)
+            def writeGffRecords(f, start, end):
+                f.seek(start)
+                while f.tell() < end:
+                    writer.writeRecords([Gff3Record.fromString(f.readline().rstrip("\n"))])
+            _gatherRanges(inputsByFormat[fmt], _indexGff, contigKeys, writeGffRecords)
+            writer.close()
+        elif fmt in ("FASTA", "FASTQ"):
+            indexer = _indexFasta if fmt == "FASTA" else _indexFastq
+            with open(outputFilename, "wb") as out:
+                _gatherRanges(inputsByFormat[fmt], indexer, contigKeys,
+                              lambda f, start, end: _copyRange(f, start, end, out))
+        else:
+            raise ValueError("Cannot gather %s files" % fmt)
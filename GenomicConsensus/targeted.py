@@ -0,0 +1,120 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+
+#
+# targeted.py: variant-only polishing (--variantsOnly)
+#
+# When only the variants are wanted, most of the genome need never be
+# polished.  Candidate loci are the columns of a pileup of the reads
+# (as for plurality) where a non-reference allele is seen in more than
+# a given fraction of the reads; only a small neighborhood of each
+# candidate is handed to the consensus algorithm.  Elsewhere the
+# consensus is the reference where the reads cover it, and a no-call
+# where they do not, with no confidence computed.
+#
+
+import logging, numpy as np
+
+from .consensus import Consensus, join
+from .pileup import Pileup
+from .windows import holes, subWindow
+
+__all__ = [ "CANDIDATE_FLANK",
+            "candidateIntervals",
+            "targetedConsensusAndVariants" ]
+
+# Bases polished on either side of a candidate locus
+CANDIDATE_FLANK = 50
+
+def candidateIntervals(refWindow, candidates, flank=CANDIDATE_FLANK):
+    """
+    The neighborhoods of the candidate positions, extended by `flank`
+    on either side, clipped to the window and merged where they
+    overlap or abut; a sorted list of (start, end).
+    """
+    _, winStart, winEnd = refWindow
+    intervals = []
+    for pos in sorted(candidates):
+        s, e = max(pos - flank, winStart), min(pos + flank + 1, winEnd)
+        if intervals and s <= intervals[-1][1]:
+            intervals[-1] = (intervals[-1][0], max(e, intervals[-1][1]))
+        else:
+            intervals.append((s, e))
+    return intervals
+
+def _unpolishedConsensus(refWindow, refSequence, covered, noEvidenceConsensus):
+    # The reference over the runs of `covered` columns, the no-call
+    # consensus elsewhere
+    _, winStart, _ = refWindow
+    edges = np.flatnonzero(np.diff(np.concatenate(([-1], covered.astype(int), [-1]))))
+    consensi = []
+    for s, e in zip(edges[:-1], edges[1:]):
+        window = subWindow(refWindow, (winStart + s, winStart + e))
+        if covered[s]:
+            consensi.append(Consensus.referenceAsConsensus(window, refSequence[s:e]))
+        else:
+            consensi.append(Consensus.noCallConsensus(noEvidenceConsensus,
+                                                      window, refSequence[s:e]))
+    return consensi
+
+def targetedConsensusAndVariants(refWindow, refSequence, alns, callWindow,
+                                 minCoverage, maxAlleleFraction, noEvidenceConsensus):
+    """
+    Consensus and variants for the window, polishing only around
+    candidate variant loci.
+
+    `alns` are the reads used for the window.  Columns covered by
+    fewer than `minCoverage` of them are not candidates.
+    `callWindow(subWindow)` returns the (consensus, variants) of the
+    consensus algorithm for a part of the window.
+    """
+    _, winStart, _ = refWindow
+    pileup = Pileup.fromAlignments(refWindow, alns)
+    coverage = pileup.coverage
+    candidates = np.flatnonzero((pileup.nonReferenceFraction(refSequence) > maxAlleleFraction) &
+                                (coverage >= minCoverage)) + winStart
+    targets = candidateIntervals(refWindow, candidates.tolist())
+    logging.debug("%s: %d candidate loci, polishing %d bases" %
+                  (refWindow, len(candidates),
+                   sum(e - s for (s, e) in targets)))
+
+    consensi, variants = [], []
+    for interval in targets:
+        css, variants_ = callWindow(subWindow(refWindow, interval))
+        consensi.append(css)
+        variants += variants_
+    for (s, e) in holes(refWindow, targets):
+        consensi += _unpolishedConsensus(subWindow(refWindow, (s, e)),
+                                         refSequence[s - winStart:e - winStart],
+                                         coverage[s - winStart:e - winStart] >= minCoverage,
+                                         noEvidenceConsensus)
+    return join(consensi), variants
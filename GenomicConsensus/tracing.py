@@ -0,0 +1,140 @@
+#################################################################################
+# Copyright (c) 2011-2016, Pacific Biosciences of California, Inc.
+#
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright
+#   notice, this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright
+#   notice, this list of conditions and the following disclaimer in the
+#   documentation and/or other materials provided with the distribution.
+# * Neither the name of Pacific Biosciences nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# NO EXPRESS OR IMPLIED LICENSES TO ANY PARTY'S PATENT RIGHTS ARE GRANTED BY
+# THIS LICENSE.  THIS SOFTWARE IS PROVIDED BY PACIFIC BIOSCIENCES AND ITS
+# CONTRIBUTORS "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A
+# PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL PACIFIC BIOSCIENCES OR
+# ITS CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR
+# BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER
+# IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#################################################################################
+
+#
+#
+# tracing.py: timeline of the run, in the Chrome trace-event format
+# (--traceFile)
+#
+# Each process (the driver, every worker, the result collector)
+# appends its events to its own file in a temporary directory, one
+# JSON object per line: a span for each chunk processed, for the
+# stages within it (those lasting at least MIN_STAGE_SECONDS), for
+# the time spent waiting on and feeding the queues, and a counter
+# for the depth of the collector's reorder buffer.  When the run is
+# over the driver concatenates the files into a single trace, which
+# opens in chrome://tracing or Perfetto.
+#
+# When tracing is off, recording an event is a single attribute
+# lookup.
+#
+
+import json, logging, os, os.path, threading, time
+from glob import glob
+
+__all__ = [ "MIN_STAGE_SECONDS",
+            "startTracing",
+            "stopTracing",
+            "tracing",
+            "traceSpan",
+            "traceCounter",
+            "mergeTraces" ]
+
+MIN_STAGE_SECONDS = 0.001
+
+_local = threading.local()
+
+class _TraceWriter(object):
+    def __init__(self, directory, name):
+        self.filename = os.path.join(directory, "trace-%s.json" % name)
+        self.pid      = os.getpid()
+        self.tid      = threading.current_thread().ident
+        self._file    = open(self.filename, "w")
+        self.write({ "ph" : "M", "name" : "thread_name", "args" : { "name" : name } })
+
+    def write(self, event):
+        event["pid"] = self.pid
+        event["tid"] = self.tid
+        self._file.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def close(self):
+        self._file.close()
+
+def startTracing(directory, name):
+    """
+    Record the events of this process (or thread) under `name`
+    """
+    _local.writer = _TraceWriter(directory, name)
+
+def stopTracing():
+    writer = getattr(_local, "writer", None)
+    if writer is not None:
+        writer.close()
+        _local.writer = None
+
+def tracing():
+    return getattr(_local, "writer", None) is not None
+
+def _microseconds(t):
+    return int(t * 1e6)
+
+def traceSpan(name, category, startTime, endTime, **args):
+    """
+    Record a span from startTime to endTime (as given by time.time())
+    """
+    writer = getattr(_local, "writer", None)
+    if writer is None:
+        return
+    writer.write({ "ph"   : "X",
+                   "name" : name,
+                   "cat"  : category,
+                   "ts"   : _microseconds(startTime),
+                   "dur"  : _microseconds(endTime - startTime),
+                   "args" : args })
+
+def traceCounter(name, **values):
+    writer = getattr(_local, "writer", None)
+    if writer is None:
+        return
+    writer.write({ "ph"   : "C",
+                   "name" : name,
+                   "ts"   : _microseconds(time.time()),
+                   "args" : values })
+
+def mergeTraces(directory, filename):
+    """
+    Concatenate the per-process trace files in `directory` into the
+    trace file `filename`.  A partial last line (from a process that
+    was killed mid-write) is dropped.
+    """
+    numEvents = 0
+    with open(filename, "w") as out:
+        out.write('{"displayTimeUnit":"ms","traceEvents":[\n')
+        for processFilename in sorted(glob(os.path.join(directory, "trace-*.json"))):
+            with open(processFilename) as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break
+                    if numEvents:
+                        out.write(",\n")
+                    out.write(line[:-1])
+                    numEvents += 1
+        out.write("\n]}\n")
+    logging.info("Wrote %d trace events to %s" % (numEvents, filename))
@@ -31,8 +31,9 @@
 # Author: David Alexander
 
 from __future__ import absolute_import
-import ast
-import math, numpy as np, os.path, sys, itertools
+import math, numpy as np, os.path, sys
+from .readIndex import readIndexFor
+from .instrumentation import count
 
 def die(msg):
     print >>sys.stderr, msg
@@ -90,91 +91,95 @@ def fileFormat(filename):
     elif ext in [".fq", ".fastq"]: return "FASTQ"
     elif ext in [".gff" ]:         return "GFF"
     elif ext in [".csv" ]:         return "CSV"
-    else: raise Exception, "Unrecognized file format"
+    else: raise ValueError, "Unrecognized file format: %s" % filename
 
 def rowNumberIsInReadStratum(readStratum, rowNumber):
     n, N = readStratum
     return (rowNumber % N) == n
 
-def readsInWindow(alnFile, window, depthLimit=None,
-                  minMapQV=0, strategy="fileorder",
-                  stratum=None, barcode=None):
+def readRowsInWindow(alnFile, window, minMapQV=0, barcode=None,
+                     candidateRows=None):
     """
-    Return up to `depthLimit` reads (as row numbers integers) where
-    the mapped reference intersects the window.  If depthLimit is None,
-    return all the reads meeting the criteria.
+    Row numbers (as a numpy array, in file order) of the reads where
+    the mapped reference intersects the window, and that meet the
+    mapQV and barcode criteria.
 
-    `strategy` can be:
-      - "longest" --- get the reads with the longest length in the window
-      - "spanning" --- get only the reads spanning the window
-      - "fileorder" --- get the reads in file order
+    If `candidateRows` (the result of this function for an enclosing
+    window) is given, the reads are picked out of those.
+    """
+    winId, winStart, winEnd = window
+    if candidateRows is not None:
+        overlaps = ((alnFile.index.tStart[candidateRows] < winEnd) &
+                    (alnFile.index.tEnd[candidateRows] > winStart))
+        return candidateRows[overlaps]
+    return readIndexFor(alnFile, minMapQV, barcode).rowsInWindow(window)
+
+def selectReadRows(alnFile, alnHits, window, depthLimit=None,
+                   strategy="fileorder"):
+    """
+    Choose up to `depthLimit` of the rows `alnHits` (reads
+    intersecting the window) according to `strategy` (see
+    `readsInWindow`).  Returns a numpy array of row numbers; no
+    alignment records are loaded.
     """
     assert strategy in {"longest", "spanning", "fileorder",
                         "long-and-strand-balanced"}
 
-    if stratum is not None:
-        raise ValueError, "stratum needs to be reimplemented"
-
-    def depthCap(iter):
-        if depthLimit is not None:
-            return alnFile[list(itertools.islice(iter, 0, depthLimit))]
-        else:
-            return alnFile[list(iter)]
-
-    def lengthInWindow(hit):
-        return (min(alnFile.index.tEnd[hit], winEnd) -
-                max(alnFile.index.tStart[hit], winStart))
-
     winId, winStart, winEnd = window
-    alnHits = np.array(list(alnFile.readsInRange(winId, winStart, winEnd,
-                                                 justIndices=True)))
-    if len(alnHits) == 0:
-        return []
-
-    if barcode == None:
-        alnHits = alnHits[alnFile.mapQV[alnHits] >= minMapQV]
-    else:
-        # this wont work with CmpH5 (no bc in index):
-        barcode = ast.literal_eval(barcode)
-        alnHits = alnHits[(alnFile.mapQV[alnHits] >= minMapQV) &
-                          (alnFile.index.bcLeft[alnHits] == barcode[0]) &
-                          (alnFile.index.bcRight[alnHits] == barcode[1])]
+    starts = alnFile.index.tStart[alnHits].astype(np.int64)
+    ends   = alnFile.index.tEnd[alnHits].astype(np.int64)
 
     if strategy == "fileorder":
-        return depthCap(alnHits)
+        selected = alnHits
     elif strategy == "spanning":
-        winLen = winEnd - winStart
-        return depthCap( hit for hit in alnHits
-                         if lengthInWindow(hit) == winLen )
+        selected = alnHits[(starts <= winStart) & (ends >= winEnd)]
     elif strategy == "longest":
-        return depthCap(sorted(alnHits, key=lengthInWindow, reverse=True))
+        lengthInWindow = np.minimum(ends, winEnd) - np.maximum(starts, winStart)
+        selected = alnHits[np.argsort(-lengthInWindow, kind="mergesort")]
     elif strategy == "long-and-strand-balanced":
         # Longest (in window) is great, but bam sorts by tStart then strand.
         # With high coverage, this bias resulted in variants. Here we lexsort
         # by tStart and tEnd. Longest in window is the final criteria in
         # either case.
+        lengthInWindow = np.minimum(ends, winEnd) - np.maximum(starts, winStart)
+        selected = alnHits[np.lexsort((ends, starts, -lengthInWindow))]
 
-        # lexical sort:
-        ends = alnFile.index.tEnd[alnHits]
-        starts = alnFile.index.tStart[alnHits]
-        lex_sort = np.lexsort((ends, starts))
+    return selected[:depthLimit]
 
-        # reorder based on sort:
-        sorted_ends = ends[lex_sort]
-        sorted_starts = starts[lex_sort]
-        sorted_alnHits = alnHits[lex_sort]
+def readsInWindow(alnFile, window, depthLimit=None,
+                  minMapQV=0, strategy="fileorder",
+                  stratum=None, barcode=None, candidateRows=None,
+                  loadedReads=None):
+    """
+    Return up to `depthLimit` reads (as alignment records) where
+    the mapped reference intersects the window.  If depthLimit is None,
+    return all the reads meeting the criteria.
 
-        # get lengths in window:
-        post = sorted_ends > winEnd
-        sorted_ends[post] = winEnd
-        pre = sorted_starts < winStart
-        sorted_starts[pre] = winStart
-        lens = sorted_ends - sorted_starts
+    `strategy` can be:
+      - "longest" --- get the reads with the longest length in the window
+      - "spanning" --- get only the reads spanning the window
+      - "fileorder" --- get the reads in file order
+      - "long-and-strand-balanced" --- get the reads with the longest
+        length in the window, ties broken by position
 
-        # coerce a descending sort:
-        win_sort = ((winEnd - winStart) - lens).argsort(kind="mergesort")
-        return depthCap(sorted_alnHits[win_sort])
+    `candidateRows` is as for `readRowsInWindow`.  `loadedReads`, if
+    given, maps row numbers to records already loaded (for an
+    enclosing window, say); only the other rows are read.
+    """
+    if stratum is not None:
+        raise ValueError, "stratum needs to be reimplemented"
 
+    alnHits = readRowsInWindow(alnFile, window, minMapQV, barcode, candidateRows)
+    rows = selectReadRows(alnFile, alnHits, window, depthLimit, strategy).tolist()
+    if len(rows) == 0:
+        return []
+    if not loadedReads:
+        return alnFile[rows]
+    missing = [ row for row in rows if row not in loadedReads ]
+    fetched = dict(zip(missing, alnFile[missing])) if missing else {}
+    count("readsReused", len(rows) - len(missing))
+    return [ loadedReads[row] if row in loadedReads else fetched[row]
+             for row in rows ]
 
 def datasetCountExceedsThreshold(alnFile, threshold):
     """
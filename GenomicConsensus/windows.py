@@ -39,17 +39,7 @@
 # Author: David Alexander
 
 import numpy as np, math
-from pbcore.io.rangeQueries import projectIntoRange
-from ConsensusCore import CoveredIntervals
-
-# TODO(lhepler): replace the above with the following:
-# from ConsensusCore2 import CoveredIntervals
-
-def intervalToPair(v):
-    return (v.Begin, v.End)
-
-def kCoveredIntervals(k, tStart, tEnd, winStart, winEnd):
-    return map(intervalToPair, CoveredIntervals(k, tStart, tEnd, int(winStart), int(winEnd-winStart)))
+from .coverageIndex import ContigCoverage
 
 def kSpannedIntervals(refWindow, k, start, end, minLength=0):
     """
@@ -59,8 +49,7 @@ def kSpannedIntervals(refWindow, k, start, end, minLength=0):
      `refWindow`: the window under consideration
      `k`: the number of reads that must span intervals to be returned
      `start`, `end`: numpy arrays of start and end coordinates for reads,
-       where the extent of each read is [start, end).  Must be ordered
-       so that `start` is sorted in ascending order.
+       where the extent of each read is [start, end).
 
     Find a maximal set of maximal disjoint intervals within
     refWindow such that each interval is spanned by at least k reads.
@@ -70,52 +59,53 @@ def kSpannedIntervals(refWindow, k, start, end, minLength=0):
     Note that this is a greedy search procedure and may not always
     return the optimal solution, in some sense.  However it will
     always return the optimal solutions in the most common cases.
+
+    The search is a single sweep over the reads sorted by start, so
+    the cost is O(n log n) in the number of reads, independent of the
+    length of the window.
     """
     assert k >= 1
-    winId, winStart_, winEnd_ = refWindow
+    winId, winStart, winEnd = refWindow
 
     # Truncate to bounds implied by refWindow
-    start = np.clip(start, winStart_, winEnd_)
-    end = np.clip(end, winStart_, winEnd_)
-
-    # Translate the start, end to coordinate system where
-    # refWindow.start is 0.
-    start = start - winStart_
-    end   = end - winStart_
-    winStart = 0
-    winEnd   = winEnd_ - winStart_
-
-    positions = np.arange(winEnd - winStart, dtype=int)
-    coverage = projectIntoRange(start, end,
-                                winStart, winEnd)
-    x = -1
-    y = 0
+    start = np.clip(start, winStart, winEnd).astype(np.int64)
+    end   = np.clip(end,   winStart, winEnd).astype(np.int64)
+    order = np.argsort(start, kind="mergesort")
+    start, end = start[order], end[order]
+
+    # The maximal runs of the window with depth >= k
+    covered = ContigCoverage.fromReads(start, end).coveredIntervals(k, winStart, winEnd)
+    runStarts = np.array([ s for (s, e) in covered ], dtype=np.int64)
+    runEnds   = np.array([ e for (s, e) in covered ], dtype=np.int64)
+
+    topEnds = np.zeros(0, dtype=np.int64)  # k largest ends of reads started so far
+    numStarted = 0
+    y = winStart
     intervalsFound = []
 
-    while y < winEnd:
+    while True:
         # Step 1: let x be the first pos >= y that is k-covered
-        eligible = np.flatnonzero((positions >= y) & (coverage >= k))
-        if len(eligible) > 0:
-            x = eligible[0]
-        else:
+        run = np.searchsorted(runEnds, y, side="right")
+        if run == len(runEnds):
             break
+        x = max(y, runStarts[run])
 
         # Step 2: extend the window [x, y) until [x, y) is no longer
         # k-spanned.  Do this by setting y to the k-th largest `end`
-        # among reads covering x
-        eligible = end[(start <= x)]
-        eligible.sort()
-        if len(eligible) >= k:
-            y = eligible[-k]
-        else:
-            break
-
-        intervalsFound.append((x, y))
-
-    # Translate intervals back
-    return [ (s + winStart_,
-              e + winStart_)
-             for (s, e) in intervalsFound
+        # among reads starting at or before x (there are at least k,
+        # all ending after x, since x is k-covered).  x only moves
+        # right, so each read is added to the running top k once.
+        n = np.searchsorted(start, x, side="right")
+        newEnds = end[numStarted:n]
+        if len(newEnds) > k:
+            newEnds = np.partition(newEnds, len(newEnds) - k)[-k:]
+        topEnds = np.sort(np.concatenate((topEnds, newEnds)))[-k:]
+        numStarted = n
+        y = topEnds[0]
+
+        intervalsFound.append((int(x), int(y)))
+
+    return [ (s, e) for (s, e) in intervalsFound
              if e - s >= minLength ]
 
 def abut(intervals):
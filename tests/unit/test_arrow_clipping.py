@@ -0,0 +1,77 @@
+import numpy as np
+from nose.tools import assert_equal, assert_raises
+
+from GenomicConsensus.arrow.arrow import ArrowWorker, consensusPosition
+from test_worker_recycling import withOptions
+
+# Window (0, 100, 130): a polished interval with an insertion after
+# reference position 103, a no-call interval, and a polished interval
+# with reference position 125 deleted
+INTERVAL_MAPS = [ ((100, 110),  0, np.array([0, 1, 2, 3, 5, 6, 7, 8, 9, 10, 11]), True),
+                  ((110, 120), 11, np.arange(11),                                 False),
+                  ((120, 130), 21, np.array([0, 1, 2, 3, 4, 5, 5, 6, 7, 8, 9]),   True) ]
+WINDOW_CSS = "ACGTTACGTAC" + "NNNNNNNNNN" + "GATCAGATC"
+
+class FakeCss(object):
+    def __init__(self, sequence):
+        self.sequence = sequence
+
+def test_consensusPosition():
+    assert_equal(0,  consensusPosition(INTERVAL_MAPS, 100))
+    assert_equal(3,  consensusPosition(INTERVAL_MAPS, 103))
+    assert_equal(5,  consensusPosition(INTERVAL_MAPS, 104))
+    # Interval boundaries map to the same position from either side
+    assert_equal(11, consensusPosition(INTERVAL_MAPS, 110))
+    assert_equal(16, consensusPosition(INTERVAL_MAPS, 115))
+    assert_equal(21, consensusPosition(INTERVAL_MAPS, 120))
+    assert_equal(26, consensusPosition(INTERVAL_MAPS, 125))
+    assert_equal(26, consensusPosition(INTERVAL_MAPS, 126))
+    assert_equal(len(WINDOW_CSS), consensusPosition(INTERVAL_MAPS, 130))
+    assert_raises(ValueError, consensusPosition, INTERVAL_MAPS, 99)
+    assert_raises(ValueError, consensusPosition, INTERVAL_MAPS, 131)
+
+def carriedFlankWorker():
+    worker = ArrowWorker()
+    worker.onStart()
+    worker._carryFlank((0, 100, 130), FakeCss(WINDOW_CSS), INTERVAL_MAPS)
+    return worker
+
+def test_carryFlank():
+    worker = carriedFlankWorker()
+    refId, start, end, sequence, targetPositions = worker._carriedFlank
+    assert_equal((0, 120, 130, "GATCAGATC"), (refId, start, end, sequence))
+    assert_equal(INTERVAL_MAPS[-1][2].tolist(), targetPositions.tolist())
+
+    # Nothing is carried from a no-call last interval, or from one
+    # that does not reach the end of the window
+    worker._carryFlank((0, 100, 120), FakeCss(WINDOW_CSS[:21]), INTERVAL_MAPS[:2])
+    assert_equal(None, worker._carriedFlank)
+    worker = carriedFlankWorker()
+    worker._carryFlank((0, 100, 140), FakeCss(WINDOW_CSS), INTERVAL_MAPS)
+    assert_equal(None, worker._carriedFlank)
+
+@withOptions(carryDraft=True)
+def test_draftFlankFor():
+    worker = carriedFlankWorker()
+    assert_equal((130, "GATCAGATC"), worker._draftFlankFor((0, 120, 200)))
+    assert_equal((130, "CAGATC"),    worker._draftFlankFor((0, 123, 200)))
+    # Reference position 125 is deleted in the flank
+    assert_equal((130, "GATC"),      worker._draftFlankFor((0, 125, 200)))
+    assert_equal((130, "GATC"),      worker._draftFlankFor((0, 126, 200)))
+    assert_equal((130, "C"),         worker._draftFlankFor((0, 129, 200)))
+    # Windows that do not start inside the flank
+    assert_equal(None, worker._draftFlankFor((0, 130, 200)))
+    assert_equal(None, worker._draftFlankFor((0, 119, 200)))
+    assert_equal(None, worker._draftFlankFor((1, 125, 200)))
+
+@withOptions(carryDraft=False)
+def test_draftFlankFor_off():
+    worker = carriedFlankWorker()
+    assert_equal(None, worker._draftFlankFor((0, 125, 200)))
+
+@withOptions(carryDraft=True)
+def test_draftFlankFor_newWorkUnit():
+    # Nothing is carried into the next batch
+    worker = carriedFlankWorker()
+    worker.onWorkUnit([])
+    assert_equal(None, worker._draftFlankFor((0, 125, 200)))
@@ -0,0 +1,43 @@
+from nose.tools import assert_equal
+
+from GenomicConsensus.batching import (ChunkLatencyEstimate,
+                                       adaptiveBatchSize,
+                                       batched)
+
+class FakeChunk(object):
+    def __init__(self, window):
+        self.window = window
+        self.hasCoverage = True
+
+def windowsOf(batches):
+    return [ [ chunk.window for chunk in batch ] for batch in batches ]
+
+def test_batched_contiguous():
+    chunks = [ FakeChunk(("ref1", s, s + 10)) for s in xrange(0, 50, 10) ]
+    batches = list(batched(chunks, lambda: 2))
+    assert_equal([ [("ref1", 0, 10),  ("ref1", 10, 20)],
+                   [("ref1", 20, 30), ("ref1", 30, 40)],
+                   [("ref1", 40, 50)] ],
+                 windowsOf(batches))
+
+def test_batched_breaks_at_discontinuities():
+    chunks = [ FakeChunk(("ref1", 0, 10)),
+               FakeChunk(("ref1", 10, 20)),
+               FakeChunk(("ref2", 20, 30)),
+               FakeChunk(("ref2", 40, 50)) ]
+    batches = list(batched(chunks, lambda: 10))
+    assert_equal([ [("ref1", 0, 10), ("ref1", 10, 20)],
+                   [("ref2", 20, 30)],
+                   [("ref2", 40, 50)] ],
+                 windowsOf(batches))
+
+def test_adaptiveBatchSize():
+    latency = ChunkLatencyEstimate(smoothing=0.5)
+    # No measurement yet
+    assert_equal(1, adaptiveBatchSize(latency, 1.0, 50))
+    latency.record(0.1)
+    assert_equal(10, adaptiveBatchSize(latency, 1.0, 50))
+    assert_equal(5, adaptiveBatchSize(latency, 1.0, 5))
+    latency.record(2.1)
+    assert_equal(1.1, round(latency.seconds, 6))
+    assert_equal(1, adaptiveBatchSize(latency, 1.0, 50))
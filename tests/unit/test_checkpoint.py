@@ -0,0 +1,114 @@
+import os, shutil, tempfile
+from nose.tools import assert_equal, assert_true
+
+from GenomicConsensus.checkpoint import CheckpointJournal
+from GenomicConsensus.options import options
+
+from test_result_collector import ResultCollectorFixture
+
+class CountedLoads(object):
+    """
+    A result that counts the times it is unpickled
+    """
+    loads = 0
+
+    def __setstate__(self, state):
+        CountedLoads.loads += 1
+        self.__dict__.update(state)
+
+class TestCheckpointJournal(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def journal(self, fingerprint=None):
+        return CheckpointJournal(os.path.join(self.directory, "ckpt"),
+                                 fingerprint or { "algorithm" : "plurality" })
+
+    def test_roundtrip(self):
+        journal = self.journal()
+        assert_equal(None, journal.validate())
+        journal.openForAppend()
+        journal.append((0, 0, 10), "css0", [])
+        journal.append((0, 10, 20), "css1", ["variant"])
+        journal.close()
+
+        journal = self.journal()
+        assert_equal(None, journal.validate())
+        assert_equal([ ((0, 0, 10), "css0", []),
+                       ((0, 10, 20), "css1", ["variant"]) ],
+                     list(journal.records()))
+        assert_equal(set([(0, 0, 10), (0, 10, 20)]), journal.completedWindows())
+
+    def test_truncated_record_discarded(self):
+        journal = self.journal()
+        journal.openForAppend()
+        journal.append((0, 0, 10), "css0", [])
+        journal.append((0, 10, 20), "css1", [])
+        journal.close()
+        size = os.path.getsize(journal.filename)
+        with open(journal.filename, "r+b") as f:
+            f.truncate(size - 3)
+
+        journal = self.journal()
+        assert_equal(set([(0, 0, 10)]), journal.completedWindows())
+        # Appending resumes after the last intact record
+        journal.openForAppend()
+        journal.append((0, 10, 20), "css1", [])
+        journal.close()
+        assert_equal(set([(0, 0, 10), (0, 10, 20)]),
+                     self.journal().completedWindows())
+
+    def test_completedWindows_skips_results(self):
+        journal = self.journal()
+        journal.openForAppend()
+        journal.append((0, 0, 10), CountedLoads(), [])
+        journal.append((0, 10, 20), CountedLoads(), [])
+        journal.close()
+        CountedLoads.loads = 0
+        journal = self.journal()
+        assert_equal(None, journal.validate())
+        assert_equal(set([(0, 0, 10), (0, 10, 20)]), journal.completedWindows())
+        assert_equal(0, CountedLoads.loads)
+        assert_equal(2, len(list(journal.records())))
+        assert_equal(2, CountedLoads.loads)
+
+    def test_fingerprint_mismatch(self):
+        journal = self.journal()
+        journal.openForAppend()
+        journal.close()
+        err = self.journal({ "algorithm" : "arrow" }).validate()
+        assert_true(err is not None and "algorithm" in err)
+
+
+class TestCheckpointReplay(ResultCollectorFixture):
+
+    def test_checkpointReplay(self):
+        expected = self.expectedOutputs()
+        results = self.results()
+        options.checkpointDir = self.path("checkpoint")
+
+        # The first run dies with three chunks done, only one of which
+        # had been written out
+        collector = self.collector()
+        collector.onStart()
+        for i in (0, 2, 5):
+            collector.onResult(results[i])
+        assert_equal(2, collector.numPendingChunks)
+        collector.journal.close()
+        for writer in (collector.fastaWriter, collector.fastqWriter, collector.gffWriter):
+            writer.close()
+
+        # The second replays them, leaving the same two pending, and
+        # finishes the job
+        collector = self.collector()
+        collector.onStart()
+        assert_equal(2, collector.numPendingChunks)
+        for i in (6, 4, 1, 3):
+            collector.onResult(results[i])
+        self.assertDrained(collector)
+        collector.onFinish()
+        assert_equal(expected, (self.outputs(), self.variantsWritten()))
@@ -0,0 +1,142 @@
+import Queue, threading
+from nose.tools import assert_equal, assert_true, assert_false
+
+from GenomicConsensus.cluster import (Coordinator, WorkChannel,
+                                      parseAddress, serveCoordinator,
+                                      WORK, WAIT, DONE)
+from GenomicConsensus.faults import ChunkFailure
+from GenomicConsensus.instrumentation import RunStats, count, workerStats
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get())
+    return items
+
+def test_parseAddress():
+    assert_equal(("node1", 5000), parseAddress("node1:5000"))
+    assert_equal(("", 5000), parseAddress(":5000"))
+
+class TestCoordinator(object):
+
+    def setup(self):
+        self.results = Queue.Queue()
+        self.clock = FakeClock()
+        self.coordinator = Coordinator(self.results, 2, {},
+                                       leaseTimeout=60, clock=self.clock)
+
+    def test_complete_run(self):
+        agent = self.coordinator.register("host")
+        self.coordinator.put("unit0")
+        self.coordinator.put("unit1")
+        self.coordinator.put(None)
+        status, seq0, unit = self.coordinator.getWork(agent, 0)
+        assert_equal((WORK, "unit0"), (status, unit))
+        status, seq1, unit = self.coordinator.getWork(agent, 0)
+        assert_equal((WORK, "unit1"), (status, unit))
+        assert_equal((WAIT, None, None), self.coordinator.getWork(agent, 0))
+        assert_true(self.coordinator.complete(agent, seq1, "result1"))
+        assert_true(self.coordinator.complete(agent, seq0, "result0"))
+        # One sentinel per expected worker, after the last result
+        assert_equal(["result1", "result0", None, None], drain(self.results))
+        assert_equal((DONE, None, None), self.coordinator.getWork(agent, 0))
+
+    def test_agent_leaving_requeues_work(self):
+        agent1 = self.coordinator.register("host1")
+        agent2 = self.coordinator.register("host2")
+        for unit in ("unit0", "unit1", "unit2"):
+            self.coordinator.put(unit)
+        _, seq0, _ = self.coordinator.getWork(agent1, 0)
+        _, seq1, _ = self.coordinator.getWork(agent1, 0)
+        self.coordinator.unregister(agent1)
+        # agent1's units go back to the head of the queue, in order
+        assert_equal([(WORK, seq0, "unit0"), (WORK, seq1, "unit1")],
+                     [ self.coordinator.getWork(agent2, 0) for i in xrange(2) ])
+
+    def test_expired_lease_and_duplicate_result(self):
+        agent1 = self.coordinator.register("host1")
+        agent2 = self.coordinator.register("host2")
+        self.coordinator.put("unit0")
+        self.coordinator.put(None)
+        _, seq, _ = self.coordinator.getWork(agent1, 0)
+        self.clock.now = 30
+        self.coordinator.heartbeat(agent2)
+        self.clock.now = 70
+        # agent1 has been silent for 70s; its lease passes to agent2
+        assert_equal((WORK, seq, "unit0"), self.coordinator.getWork(agent2, 0))
+        assert_true(self.coordinator.complete(agent2, seq, "result0"))
+        assert_false(self.coordinator.complete(agent1, seq, "result0"))
+        assert_equal(["result0", None, None], drain(self.results))
+
+    def test_stats_and_failures(self):
+        agent = self.coordinator.register("host")
+        self.coordinator.put("unit0")
+        self.coordinator.put(None)
+        _, seq, _ = self.coordinator.getWork(agent, 0)
+        failure = ChunkFailure(("ctg1", 0, 500), 1, "ValueError", "Worker-1")
+        self.coordinator.reportFailure(agent, failure)
+        stats = RunStats()
+        stats.count("windows")
+        assert_true(self.coordinator.complete(agent, seq, "result0", stats))
+        received = drain(self.results)
+        # The stats go ahead of the result, and so of the sentinels
+        assert_equal([failure, stats, "result0", None, None], received)
+        assert_equal("host/0:Worker-1", received[0].workerName)
+
+    def test_late_result_for_requeued_unit(self):
+        agent1 = self.coordinator.register("host1")
+        self.coordinator.put("unit0")
+        self.coordinator.put(None)
+        _, seq, _ = self.coordinator.getWork(agent1, 0)
+        self.coordinator.unregister(agent1)
+        # The result arrives before anyone else has picked the unit up
+        assert_true(self.coordinator.complete(agent1, seq, "result0"))
+        assert_equal(["result0", None, None], drain(self.results))
+
+def test_agents_on_localhost():
+    results = Queue.Queue()
+    coordinator = Coordinator(results, 1, { "algorithm" : "plurality" })
+    address = serveCoordinator(coordinator, ("127.0.0.1", 0), "secret")
+
+    def agent():
+        channel = WorkChannel(address, "secret", coordinator.register("localhost"),
+                              pollInterval=0.1)
+        while True:
+            unit = channel.get()
+            if unit is None:
+                channel.put(workerStats())
+                channel.put(None)
+                break
+            count("units")
+            if unit % 5 == 0:
+                channel.put(ChunkFailure(("ctg1", unit, unit + 1), 1, "ValueError", "Worker"))
+            channel.put(unit * 2)
+
+    agents = [ threading.Thread(target=agent) for i in xrange(3) ]
+    for t in agents:
+        t.start()
+    for i in xrange(20):
+        coordinator.put(i)
+    coordinator.put(None)
+    for t in agents:
+        t.join(10)
+        assert_false(t.is_alive())
+    received = drain(results)
+    assert_equal(None, received[-1])
+    stats = RunStats()
+    for item in received:
+        if isinstance(item, RunStats):
+            stats.merge(item)
+    failures = [ item for item in received if isinstance(item, ChunkFailure) ]
+    received = [ item for item in received[:-1]
+                 if not isinstance(item, (RunStats, ChunkFailure)) ]
+    assert_equal(range(0, 40, 2), sorted(received))
+    # Every unit's stats and failures reach the results queue
+    assert_equal(20, stats.counters["units"])
+    assert_equal([0, 5, 10, 15], sorted(f.window[1] for f in failures))
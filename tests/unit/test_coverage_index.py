@@ -0,0 +1,111 @@
+import numpy as np, os, shutil, tempfile
+from nose.tools import assert_equal
+
+from GenomicConsensus import readIndex as RI
+from GenomicConsensus.coverageIndex import ContigCoverage, CoverageIndex, coverageIndexFor
+from GenomicConsensus.windows import enumerateIntervals
+from test_reads_in_window import FakeAlignmentFile, ReferenceInfo, randomAlignmentFile
+
+def multiContigAlignmentFile(rng, numReads=500):
+    alnFile = randomAlignmentFile(rng, numReads=numReads)
+    alnFile.tId = rng.randint(0, 3, size=numReads)
+    alnFile.referenceInfo = lambda refId: ReferenceInfo(refId)
+    return alnFile
+
+def bruteForceDepth(alnFile, refId, minMapQV, start, end):
+    tStart, tEnd = alnFile.index
+    depth = np.zeros(end - start, dtype=int)
+    for row in np.flatnonzero((alnFile.tId == refId) & (alnFile.mapQV >= minMapQV)):
+        s, e = max(int(tStart[row]), start), min(int(tEnd[row]), end)
+        if s < e:
+            depth[s-start:e-start] += 1
+    return depth
+
+def bruteForceCoveredIntervals(depth, k, start):
+    intervals, runStart = [], None
+    for i, d in enumerate(list(depth) + [0]):
+        if d >= k and runStart is None:
+            runStart = i
+        elif d < k and runStart is not None:
+            intervals.append((start + runStart, start + i))
+            runStart = None
+    return intervals
+
+def test_coverageIndex():
+    rng = np.random.RandomState(42)
+    alnFile = multiContigAlignmentFile(rng)
+    coverageIndex = CoverageIndex(RI.ReadIndex(alnFile, minMapQV=20))
+    for trial in xrange(200):
+        refId = rng.randint(0, 4)
+        start = rng.randint(0, 2100)
+        end = start + rng.randint(1, 400)
+        window = (refId, start, end)
+        depth = bruteForceDepth(alnFile, refId, 20, start, end)
+        assert_equal(depth.tolist(), coverageIndex.depthInWindow(window).tolist())
+        assert_equal(depth.max(), coverageIndex.maxDepth(window))
+        for k in (1, 5, 12):
+            assert_equal(bruteForceCoveredIntervals(depth, k, start),
+                         coverageIndex.coveredIntervals(window, k))
+
+def bruteForceAlignedBases(tStart, tEnd, intervals):
+    return [ sum(max(0, min(e, ie) - max(s, is_))
+                 for (s, e) in zip(tStart, tEnd))
+             for (is_, ie) in intervals ]
+
+def test_alignedBases():
+    start = np.array([10, 0, 5, 30], dtype=int)
+    end   = np.array([20, 15, 6, 40], dtype=int)
+    intervals = [(0, 10), (10, 20), (12, 13), (20, 30), (0, 50)]
+    assert_equal([11, 15, 2, 0, 36],
+                 ContigCoverage.fromReads(start, end).alignedBases(intervals).tolist())
+    assert_equal([], ContigCoverage.fromReads(start, end).alignedBases([]).tolist())
+
+    np.random.seed(42)
+    start = np.random.randint(0, 1000, size=200)
+    end   = start + np.random.randint(1, 300, size=200)
+    intervals = list(enumerateIntervals((0, 1300), 97))
+    assert_equal(bruteForceAlignedBases(start, end, intervals),
+                 ContigCoverage.fromReads(start, end).alignedBases(intervals).tolist())
+
+def test_alignedBases_index():
+    rng = np.random.RandomState(42)
+    alnFile = multiContigAlignmentFile(rng)
+    readIndex = RI.ReadIndex(alnFile, minMapQV=20)
+    coverageIndex = CoverageIndex(readIndex)
+    for refId in xrange(3):
+        contigReads = readIndex.contig(refId)
+        intervals = [ (s, s + rng.randint(0, 300)) for s in rng.randint(0, 2100, size=50) ]
+        assert_equal(bruteForceAlignedBases(contigReads.tStart, contigReads.tEnd, intervals),
+                     coverageIndex.contig(refId).alignedBases(intervals).tolist())
+
+def test_coverageIndex_sidecar():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        inputFilename = os.path.join(tmpDir, "aligned.bam")
+        with open(inputFilename, "w") as f:
+            f.write("BAM")
+        rng = np.random.RandomState(42)
+        alnFile = multiContigAlignmentFile(rng)
+        RI.setSidecarInput(inputFilename)
+        built = coverageIndexFor(alnFile, 20)
+        sidecar = RI.sidecarFilename(inputFilename, 20, None, extension="gccov")
+        assert os.path.exists(sidecar)
+
+        # Another file object for the same input maps the saved runs
+        sameFile = FakeAlignmentFile(alnFile.index.tStart, alnFile.index.tEnd, alnFile.mapQV)
+        sameFile.tId = alnFile.tId
+        sameFile.referenceInfo = alnFile.referenceInfo
+        loaded = coverageIndexFor(sameFile, 20)
+        assert isinstance(loaded.contig(0).depth, np.memmap)
+        for window in ((0, 0, 2000), (1, 500, 600), (2, 1990, 2100), (5, 0, 100)):
+            assert_equal(built.depthInWindow(window).tolist(),
+                         loaded.depthInWindow(window).tolist())
+            assert_equal(built.coveredIntervals(window, 5),
+                         loaded.coveredIntervals(window, 5))
+
+        # A sidecar written for other filters is not used
+        fingerprint = RI.sidecarFingerprint(inputFilename, sameFile, 30, None)
+        assert CoverageIndex.load(sidecar, RI.ReadIndex(sameFile, 30), fingerprint) is None
+    finally:
+        RI.setSidecarInput(None)
+        shutil.rmtree(tmpDir)
@@ -107,3 +107,64 @@ def test_enumerateIntervals():
     assert_equals(list(enumerateIntervals((99,100), 100)), [(99,100)])
     assert_equals(list(enumerateIntervals((99,101), 100)), [(99,100), (100, 101)])
     assert_equals(list(enumerateIntervals((99,200), 100)), [(99,100), (100, 200)])
+
+
+def originalKSpannedIntervals(refWindow, k, start, end, minLength=0):
+    # The search as it was done before it became a sweep over the reads
+    winId, winStart_, winEnd_ = refWindow
+    start = np.clip(start, winStart_, winEnd_) - winStart_
+    end   = np.clip(end, winStart_, winEnd_) - winStart_
+    winEnd = winEnd_ - winStart_
+    positions = np.arange(winEnd, dtype=int)
+    coverage = np.zeros(winEnd, dtype=int)
+    for (s, e) in zip(start, end):
+        coverage[s:e] += 1
+    y = 0
+    intervalsFound = []
+    while y < winEnd:
+        eligible = np.flatnonzero((positions >= y) & (coverage >= k))
+        if len(eligible) > 0:
+            x = eligible[0]
+        else:
+            break
+        eligible = end[(start <= x)]
+        eligible.sort()
+        if len(eligible) >= k:
+            y = eligible[-k]
+        else:
+            break
+        intervalsFound.append((x, y))
+    return [ (s + winStart_, e + winStart_)
+             for (s, e) in intervalsFound
+             if e - s >= minLength ]
+
+def randomReads(rng, numReads, winStart, winEnd, maxLength):
+    start = np.sort(rng.randint(winStart - maxLength, winEnd, size=numReads))
+    end   = start + rng.randint(1, maxLength, size=numReads)
+    return np.maximum(start, 0), end
+
+def test_kSpannedIntervals_random():
+    rng = np.random.RandomState(42)
+    for trial in xrange(300):
+        winStart = rng.randint(0, 1000)
+        refWindow = (0, winStart, winStart + rng.randint(1, 500))
+        start, end = randomReads(rng, rng.randint(0, 60), winStart, refWindow[2],
+                                 maxLength=rng.choice([5, 50, 500]))
+        for k in (1, 2, 3, 5):
+            for minLength in (0, 10):
+                assert_equals(originalKSpannedIntervals(refWindow, k, start, end, minLength),
+                              kSpannedIntervals(refWindow, k, start, end, minLength))
+
+
+if __name__ == "__main__":
+    # Microbenchmark: python tests/unit/test_coverage_intervals.py
+    import timeit
+    rng = np.random.RandomState(42)
+    for (winLength, numReads) in ((500, 100), (20000, 2000), (100000, 20000)):
+        refWindow = (0, 0, winLength)
+        start, end = randomReads(rng, numReads, 0, winLength, maxLength=10000)
+        for name, f in (("original", originalKSpannedIntervals),
+                        ("sweep", kSpannedIntervals)):
+            t = min(timeit.repeat(lambda: f(refWindow, 5, start, end, 10),
+                                  number=1, repeat=3))
+            print "%-8s window=%-6d reads=%-5d %8.2f ms" % (name, winLength, numReads, 1000 * t)
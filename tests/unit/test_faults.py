@@ -0,0 +1,128 @@
+import json, os, shutil, tempfile, threading, time, Queue
+from nose.tools import assert_equal, assert_raises
+
+from GenomicConsensus import reference
+from GenomicConsensus.options import options
+from GenomicConsensus.consensus import Consensus
+from GenomicConsensus.reference import WorkChunk
+from GenomicConsensus.faults import (ChunkFailure, ChunkWatch, SynchronousQueue,
+                                     writeFailureSummary)
+from GenomicConsensus.Worker import Worker
+
+def test_chunkWatch():
+    watch = ChunkWatch()
+    assert_equal(0.0, watch.busySeconds(100.0))
+    unit = [ WorkChunk(("ctg1", 0, 500), True), WorkChunk(("ctg1", 500, 1000), False) ]
+    watch.beginUnit(unit, { 1 : 2 })
+    watch.beginChunk(1, 2)
+    assert watch.busySeconds(watch._since.value + 5) == 5
+    recordedUnit, attempts, index, attempt = watch.current()
+    assert_equal([ c.window for c in unit ], [ c.window for c in recordedUnit ])
+    assert_equal(({ 1 : 2 }, 1, 2), (attempts, index, attempt))
+    watch.endChunk()
+    assert_equal(0.0, watch.busySeconds(100.0))
+
+    # A unit too large to record cannot be recovered
+    watch.beginUnit([ WorkChunk(("ctg1", i, i + 1), True) for i in xrange(10000) ], {})
+    assert watch.current() is None
+
+def test_synchronousQueue():
+    q = SynchronousQueue(2)
+    q.put("a")
+    q.put("b")
+    # Written to the pipe by put itself: no feeder thread
+    assert q._thread is None
+    assert_raises(Queue.Full, q.put, "c", False)
+    assert_equal(["a", "b"], [ q.get(timeout=1), q.get(timeout=1) ])
+
+    # No write gets through while writes are held
+    writer = threading.Thread(target=q.put, args=("c",))
+    with q.writesHeld():
+        writer.start()
+        time.sleep(0.05)
+        assert_raises(Queue.Empty, q.get, True, 0.05)
+    writer.join()
+    assert_equal("c", q.get(timeout=1))
+
+def test_failureSummary():
+    failures = [ ChunkFailure(("ctg1", 0, 500), 1, "Traceback...\nValueError\n", "Worker-1"),
+                 ChunkFailure(("ctg1", 0, 500), 2, "Timed out after 60 seconds", "Worker-2") ]
+    assert_equal(["fallback", "noCall"], [ f.outcome for f in failures ])
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "failures.json")
+        writeFailureSummary(filename, failures, lambda (refId, s, e): "%s:%d-%d" % (refId, s, e))
+        with open(filename) as f:
+            summary = json.load(f)
+        assert_equal({ "window"  : "ctg1:0-500",
+                       "attempt" : 2,
+                       "outcome" : "noCall",
+                       "worker"  : "Worker-2",
+                       "error"   : "Timed out after 60 seconds" },
+                     summary[1])
+    finally:
+        shutil.rmtree(tmpDir)
+
+class FlakyWorker(Worker):
+    name = "FlakyWorker-1"
+
+    def __init__(self, resultsQueue, failures):
+        super(FlakyWorker, self).__init__(None, resultsQueue, None)
+        self.failures = failures
+        self.coverageSeen = []
+
+    def onChunk(self, workChunk, depthLimit=None):
+        self.coverageSeen.append(depthLimit or options.coverage)
+        if len(self.coverageSeen) <= self.failures:
+            raise ValueError("corrupt read")
+        css = Consensus.referenceAsConsensus(workChunk.window, "ACGT")
+        return (workChunk.window, (css, []))
+
+def withReference(f):
+    def wrapper():
+        savedOptions = dict(vars(options))
+        savedFilename = reference.filename
+        reference.byName["ctg1"] = reference.ReferenceContig(0, "ctg1", "ctg1", "ACGTACGT", 8)
+        reference.filename = "ctg1.fasta"
+        options.__dict__.update(chunkTimeout=0, pdb=False, coverage=100, fallbackCoverage=20,
+                                noEvidenceConsensusCall="nocall")
+        try:
+            f()
+        finally:
+            del reference.byName["ctg1"]
+            reference.filename = savedFilename
+            options.__dict__.clear()
+            options.__dict__.update(savedOptions)
+    wrapper.__name__ = f.__name__
+    return wrapper
+
+@withReference
+def test_retry_with_fallback():
+    resultsQueue = Queue.Queue()
+    worker = FlakyWorker(resultsQueue, failures=1)
+    window, (css, variants) = worker._attemptChunk(WorkChunk(("ctg1", 0, 4), True), 0, 1)
+    assert_equal("ACGT", css.sequence)
+    assert_equal([100, 20], worker.coverageSeen)
+    assert_equal(100, options.coverage)
+    failure = resultsQueue.get_nowait()
+    assert_equal((("ctg1", 0, 4), 1, "fallback"), (failure.window, failure.attempt, failure.outcome))
+    assert "ValueError: corrupt read" in failure.error
+    assert resultsQueue.empty()
+
+@withReference
+def test_noCall_after_fallback_fails():
+    resultsQueue = Queue.Queue()
+    worker = FlakyWorker(resultsQueue, failures=2)
+    window, (css, variants) = worker._attemptChunk(WorkChunk(("ctg1", 0, 4), True), 0, 1)
+    assert_equal(("NNNN", []), (css.sequence, variants))
+    assert_equal([1, 2], [ resultsQueue.get_nowait().attempt for i in xrange(2) ])
+
+@withReference
+def test_resume_at_attempt():
+    # A chunk redone after a timeout on its fallback goes straight to
+    # a no-call
+    resultsQueue = Queue.Queue()
+    worker = FlakyWorker(resultsQueue, failures=0)
+    window, (css, variants) = worker._attemptChunk(WorkChunk(("ctg1", 0, 4), True), 0, 3)
+    assert_equal("NNNN", css.sequence)
+    assert_equal([], worker.coverageSeen)
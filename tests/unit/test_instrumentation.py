@@ -0,0 +1,76 @@
+import cPickle, json, os, shutil, tempfile, threading
+from nose.tools import assert_equal, assert_raises
+
+from GenomicConsensus.instrumentation import (RunStats, workerStats, takeWorkerStats,
+                                              timed, count, writeRunReport)
+
+def test_timed_and_count():
+    stats = workerStats()
+    callsBefore = stats.stageCalls["test.stage"]
+    with timed("test.stage"):
+        pass
+    with assert_raises(ValueError):
+        with timed("test.stage"):
+            raise ValueError
+    count("test.events")
+    count("test.events", 4)
+    assert_equal(callsBefore + 2, stats.stageCalls["test.stage"])
+    assert stats.stageSeconds["test.stage"] >= 0
+    assert_equal(5, stats.counters["test.events"])
+
+def test_threads_have_separate_stats():
+    seen = []
+    def work():
+        count("test.threaded", 3)
+        seen.append(workerStats())
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    assert seen[0] is not workerStats()
+    assert_equal(3, seen[0].counters["test.threaded"])
+    assert_equal(0, workerStats().counters.get("test.threaded", 0))
+
+def test_takeWorkerStats():
+    def work():
+        count("test.taken", 2)
+        seen.append(takeWorkerStats())
+        count("test.taken")
+        seen.append(takeWorkerStats())
+    seen = []
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    # Each piece holds only what was counted since the last one
+    assert_equal([2, 1], [ stats.counters["test.taken"] for stats in seen ])
+
+def test_merge_and_pickle():
+    a, b = RunStats(), RunStats()
+    a.addTime("poa", 1.5)
+    a.count("readsFetched", 10)
+    b.addTime("poa", 0.5)
+    b.addTime("polish", 2.0)
+    b.count("readsFetched", 5)
+    b.count("polish.notConverged")
+    a.merge(cPickle.loads(cPickle.dumps(b, cPickle.HIGHEST_PROTOCOL)))
+    assert_equal({ "stages"   : { "poa"    : { "calls" : 2, "seconds" : 2.0 },
+                                  "polish" : { "calls" : 1, "seconds" : 2.0 } },
+                   "counters" : { "readsFetched" : 15, "polish.notConverged" : 1 } },
+                 a.toDict())
+    assert_equal("poa 2.0s, polish 2.0s", a.summary())
+
+def test_writeRunReport():
+    stats = RunStats()
+    stats.addTime("fetch", 0.25)
+    stats.count("windows", 3)
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "report.json")
+        writeRunReport(filename, stats, algorithm="arrow", numWorkers=4)
+        with open(filename) as f:
+            report = json.load(f)
+        assert_equal("arrow", report["algorithm"])
+        assert_equal(4, report["numWorkers"])
+        assert_equal({ "calls" : 1, "seconds" : 0.25 }, report["stages"]["fetch"])
+        assert_equal(3, report["counters"]["windows"])
+    finally:
+        shutil.rmtree(tmpDir)
@@ -0,0 +1,140 @@
+import random, numpy as np
+from collections import Counter
+from itertools import izip
+from nose.tools import assert_equal
+
+from GenomicConsensus.pileup import Pileup, RollingPileup, encodeAlignment, SIMPLE_ALLELES
+from GenomicConsensus.polishing import agreesWithReference
+from AlignmentHitStubs import *
+
+def tabulateBaseCalls(refWindow, alns):
+    """
+    The original, column-at-a-time, plurality tabulation
+    """
+    _, refStart, refEnd = refWindow
+    baseCallsMatrix = np.zeros(shape=(len(alns), refEnd - refStart), dtype="S8")
+    for i, aln in enumerate(alns):
+        aln = aln.clippedTo(refStart, refEnd)
+        readBases = []
+        accum = []
+        for (refBase, readBase) in izip(aln.reference(orientation="genomic"),
+                                        aln.read(orientation="genomic")):
+            if readBase != "-":
+                readBases.append(readBase)
+            if refBase != "-":
+                accum.append("".join(readBases) if readBases else "-")
+                readBases = []
+        baseCallsMatrix[i, aln.referenceStart - refStart:aln.referenceEnd - refStart] = accum
+    return baseCallsMatrix
+
+def pileupCounters(pileup):
+    counters = []
+    for j in xrange(pileup.windowSize):
+        counter = Counter()
+        for code, allele in enumerate(SIMPLE_ALLELES):
+            if pileup.counts[code + 1, j]:
+                counter[allele] = pileup.counts[code + 1, j]
+        counter.update(pileup.complexCounts.get(j, {}))
+        counters.append(counter)
+    return counters
+
+def mostCommon(column):
+    """
+    The top two alleles of a column of the tabulation, with their
+    frequencies, as Counter.most_common(2) gives them: alleles of
+    equal frequency in order of first occurrence.  (Python 2's Counter
+    iterates in hash order, so the order is made explicit here.)
+    """
+    counter = Counter(column)
+    counter.pop("", None)
+    firstSeen = {}
+    for i, allele in enumerate(column):
+        firstSeen.setdefault(allele, i)
+    ranked = sorted(counter.iteritems(), key=lambda (allele, n): (-n, firstSeen[allele]))
+    return (ranked + [("N", 0), ("N", 0)])[:2]
+
+def randomAlignment(refLength, rng, alleles="ACGTN-"):
+    ref, read = [], []
+    for i in xrange(refLength):
+        if rng.random() < 0.1:
+            for k in xrange(rng.randint(1, 10)):
+                ref.append("-")
+                read.append(rng.choice("ACGT"))
+        ref.append(rng.choice("ACGT"))
+        read.append(rng.choice(alleles))
+    return "".join(ref), "".join(read)
+
+def test_encodeAlignment():
+    # Insertion before a deleted base; insertion before a matched
+    # base; an unusual base
+    codes, complexAlleles = encodeAlignment("GA-TT-ACA", "GAC-TGAxA")
+    assert_equal([3, 1, 2, 4, 7, 7, 1], codes.tolist())
+    assert_equal([(4, "GA"), (5, "x")], sorted(complexAlleles))
+
+def test_pileup_matches_tabulation():
+    rng = random.Random(42)
+    for trial in xrange(20):
+        refWindow = (1, 0, 60)
+        alns = []
+        for i in xrange(rng.randint(1, 30)):
+            length = rng.randint(5, 60)
+            start = rng.randint(0, 60 - length)
+            alnRef, alnRead = randomAlignment(length, rng)
+            alns.append(AlignmentHitStub(start, FORWARD, alnRef, alnRead))
+        pileup = Pileup.fromAlignments(refWindow, alns)
+        matrix = tabulateBaseCalls(refWindow, alns)
+        expected = [ Counter(matrix[:, j]) for j in xrange(60) ]
+        for counter in expected:
+            counter.pop("", None)
+        assert_equal(expected, pileupCounters(pileup))
+
+        coverage, allele1, frequency1, allele2, frequency2 = pileup.topAlleles()
+        assert_equal([ sum(counter.values()) for counter in expected ], coverage.tolist())
+        assert_equal([ mostCommon(matrix[:, j].tolist()) for j in xrange(60) ],
+                     [ [(allele1[j], frequency1[j]), (allele2[j], frequency2[j])]
+                       for j in xrange(60) ])
+
+def topAlleles(pileup):
+    coverage, allele1, frequency1, allele2, frequency2 = pileup.topAlleles()
+    return [ [(allele1[j], frequency1[j]), (allele2[j], frequency2[j])]
+             for j in xrange(pileup.windowSize) ]
+
+def test_topAlleles_matches_tabulation():
+    # Few reads, with few alleles, so that most columns have ties.
+    # The reads are piled up all at once, and one at a time in a
+    # rolling pileup, as for the sweep.
+    rng = random.Random(42)
+    refWindow = (1, 0, 40)
+    for trial in xrange(200):
+        alns = []
+        for i in xrange(rng.randint(1, 8)):
+            length = rng.randint(5, 40)
+            start = rng.randint(0, 40 - length)
+            alnRef, alnRead = randomAlignment(length, rng,
+                                              alleles=rng.choice(["AC", "GT-", "ACGTN-"]))
+            alns.append(AlignmentHitStub(start, FORWARD, alnRef, alnRead))
+        alns.sort(key=lambda aln: aln.referenceStart)
+        matrix = tabulateBaseCalls(refWindow, alns)
+        expected = [ mostCommon(matrix[:, j].tolist()) for j in xrange(40) ]
+        assert_equal(expected, topAlleles(Pileup.fromAlignments(refWindow, alns)))
+
+        rollingPileup = RollingPileup(1, 0)
+        for aln in alns:
+            rollingPileup.addEncodedAlignment(aln.referenceStart,
+                                              *encodeAlignment(aln.reference(), aln.read()))
+        assert_equal(expected[:25], topAlleles(rollingPileup.popPileup(25)))
+        assert_equal(expected[25:], topAlleles(rollingPileup.popPileup(40)))
+
+def test_nonReferenceFraction():
+    # Reads over GATTACA: a mismatch at column 1, insertions before
+    # column 4 in two reads, and a deletion of column 5 in a read
+    # ending there
+    refWindow = (1, 0, 7)
+    alns = [ AlignmentHitStub(0, FORWARD, "GATTACA",  "GCTTACA"),
+             AlignmentHitStub(0, FORWARD, "GATT-ACA", "GATTGACA"),
+             AlignmentHitStub(0, FORWARD, "GATT-ACA", "GATTTACA"),
+             AlignmentHitStub(0, FORWARD, "GATTAC",   "GATTA-") ]
+    fraction = Pileup.fromAlignments(refWindow, alns).nonReferenceFraction("GATTACA")
+    assert_equal([0, 0.25, 0, 0, 0.5, 0.25, 0], fraction.tolist())
+    assert agreesWithReference(refWindow, "GATTACA", alns, 0.5)
+    assert not agreesWithReference(refWindow, "GATTACA", alns, 0.3)
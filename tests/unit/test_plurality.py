@@ -1,9 +1,13 @@
 from numpy.testing import assert_array_almost_equal
 from nose.tools import assert_equal
-import operator, numpy as np
+import operator, random, warnings, numpy as np
 
+from GenomicConsensus.pileup import Pileup, encodeAlignment
 from GenomicConsensus.plurality.plurality import (PluralityConfig,
                                                   pluralityConsensusAndVariants,
+                                                  pluralitySweep,
+                                                  posteriorConfidences,
+                                                  posteriorConfidenceArrays,
                                                   _computeVariants)
 from AlignmentHitStubs import *
 
@@ -33,6 +37,67 @@ def test_plurality2():
                  variants)
 
 
+def test_pluralitySweep():
+    # The sweep gives the same results as the windowed algorithm,
+    # whatever the segment size
+    rng = random.Random(42)
+    refWindow = (1, 0, 120)
+    reference = "".join(rng.choice("ACGT") for i in xrange(120))
+    for diploid in (False, True):
+        config = PluralityConfig(minConfidence=0, minCoverage=2, diploid=diploid)
+        for trial in xrange(5):
+            hits = []
+            for i in xrange(rng.randint(5, 40)):
+                length = rng.randint(10, 80)
+                start = rng.randint(0, 120 - length)
+                ref, read = [], []
+                for refBase in reference[start:start+length]:
+                    if rng.random() < 0.05:
+                        ref.append("-")
+                        read.append(rng.choice("ACGT"))
+                    ref.append(refBase)
+                    read.append(refBase if rng.random() < 0.8 else rng.choice("ACGT-"))
+                hits.append(AlignmentHitStub(start, FORWARD, "".join(ref), "".join(read)))
+            hits.sort(key=lambda hit: hit.referenceStart)
+            expectedCss, expectedVariants = \
+                pluralityConsensusAndVariants(refWindow, reference, hits, config)
+            for segmentSize in (7, 50, 1000):
+                css, variants = pluralitySweep(refWindow, reference, hits, config,
+                                               segmentSize=segmentSize)
+                assert_equal(refWindow, css.refWindow)
+                assert_equal(expectedCss.sequence, css.sequence)
+                assert_equal(list(expectedCss.confidence), list(css.confidence))
+                assert_equal(expectedVariants, variants)
+
+
+def test_posteriorConfidenceArrays():
+    sites = [ (depth, cssFreq, altFreq)
+              for depth in (0, 1, 5, 20, 100, 500, 2000)
+              for cssFreq in set([0, depth // 5, depth // 2, depth])
+              for altFreq in set([0, depth // 5, depth - cssFreq]) ]
+    depth, cssFreq, altFreq = map(np.array, zip(*sites))
+    for diploid in (False, True):
+        with warnings.catch_warnings():
+            # The deep sites with no clear plurality are 0/0
+            warnings.simplefilter("ignore")
+            expected = [ posteriorConfidences(d, c, a, diploid) for (d, c, a) in sites ]
+        with warnings.catch_warnings():
+            warnings.simplefilter("error")
+            cssConf, hetConf = posteriorConfidenceArrays(depth, cssFreq, altFreq, diploid)
+        assert_equal(expected, zip(cssConf.tolist(), hetConf.tolist()))
+
+def test_topAlleles_ties():
+    pileup = Pileup((1, 0, 3))
+    for read in ("GTA", "GTC", "TGA", "TGC"):
+        pileup.addEncodedAlignment(0, *encodeAlignment("NNN", read))
+    coverage, allele1, frequency1, allele2, frequency2 = pileup.topAlleles()
+    # Ties go to the allele of the earlier read
+    assert_equal(["G", "T", "A"], allele1)
+    assert_equal(["T", "G", "C"], allele2)
+    assert_equal([2, 2, 2], frequency1.tolist())
+    assert_equal([2, 2, 2], frequency2.tolist())
+
+
 def test_computeHaploidVariants():
     config = PluralityConfig(minConfidence=0,
                              minCoverage=0)
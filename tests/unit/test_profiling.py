@@ -0,0 +1,92 @@
+import cProfile, os, pstats, resource, shutil, tempfile, time
+from nose.tools import assert_equal
+
+from GenomicConsensus.profiling import (mergeProfiles, writeProfileReport,
+                                        sampledStacks, mergeSamples)
+
+def spin(seconds):
+    endTime = time.clock() + seconds
+    total = 0
+    while time.clock() < endTime:
+        total += 1
+    return total
+
+def nativeSpin(n):
+    # A single bytecode: the loop runs in C, so no signal handler runs
+    # until it returns
+    return sum(xrange(n))
+
+def readSamples(filename):
+    samples = {}
+    with open(filename) as f:
+        for line in f:
+            stack, n = line.rsplit(" ", 1)
+            samples[stack] = int(n)
+    return samples
+
+def leafSamples(samples, function):
+    return sum(n for (stack, n) in samples.iteritems()
+               if stack.split(";")[-1].startswith("test_profiling.py:%s:" % function))
+
+def cpuSeconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def spinCalls(stats):
+    # stats.stats maps (file, line, function) to (calls, ...)
+    return sum(stats.stats[key][1] for key in stats.stats if key[2] == "spin")
+
+def test_mergeProfiles():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filenames = [ os.path.join(tmpDir, "profile-%d.out" % i) for i in xrange(3) ]
+        for filename in filenames:
+            cProfile.runctx("spin(0.01)", globals(), locals(), filename=filename)
+        stats = mergeProfiles(filenames)
+        assert_equal(3, spinCalls(stats))
+        assert mergeProfiles([]) is None
+
+        prefix = os.path.join(tmpDir, "merged")
+        writeProfileReport(stats, prefix)
+        assert_equal(3, spinCalls(pstats.Stats(prefix + ".pstats")))
+        with open(prefix + ".txt") as f:
+            assert "spin" in f.read()
+    finally:
+        shutil.rmtree(tmpDir)
+
+def test_sampledStacks():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filenames = [ os.path.join(tmpDir, "samples-%d.folded" % i) for i in xrange(2) ]
+        for filename in filenames:
+            with sampledStacks(filename, interval=0.005):
+                spin(0.1)
+        with sampledStacks(None):
+            pass
+
+        mergedFilename = os.path.join(tmpDir, "merged.folded")
+        mergeSamples(filenames, mergedFilename)
+        samples = readSamples(mergedFilename)
+        assert leafSamples(samples, "spin") >= 10
+        assert all(";" in stack for stack in samples)
+    finally:
+        shutil.rmtree(tmpDir)
+
+def test_sampledStacks_nativeCalls():
+    # Each long call into C gets a single handler call, at its end,
+    # which must stand for all the CPU time of the call
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "samples.folded")
+        interval = 0.005
+        with sampledStacks(filename, interval):
+            startCpu = cpuSeconds()
+            for i in xrange(3):
+                nativeSpin(10**7)
+            nativeCpu = cpuSeconds() - startCpu
+        weight = leafSamples(readSamples(filename), "nativeSpin")
+        expected = nativeCpu / interval
+        assert expected >= 30
+        assert 0.7 * expected <= weight <= 1.3 * expected, (weight, expected)
+    finally:
+        shutil.rmtree(tmpDir)
@@ -0,0 +1,67 @@
+import json, os, shutil, tempfile
+from nose.tools import assert_equal
+
+from GenomicConsensus.progress import (WorkerActivity, ProgressTracker, ProgressReporter,
+                                       prometheusText)
+
+def test_workerActivity():
+    activity = WorkerActivity(2)
+    assert_equal([0, 1, None], [ activity.claimSlot() for i in xrange(3) ])
+    activity.releaseSlot(0)
+    assert_equal(0, activity.claimSlot())
+    activity.recordDispatch(5)
+    activity.recordChunk(0, 1.5)
+    activity.recordChunk(0, 0.5)
+    activity.recordChunk(1, 1.0)
+    assert_equal([2.0, 1.0], list(activity.busySeconds))
+    assert_equal([2, 1], list(activity.chunksProcessed))
+    assert_equal(2, activity.chunksQueued)
+
+def test_progressTracker():
+    activity = WorkerActivity(2)
+    activity.recordDispatch(3)
+    activity.recordChunk(1, 0.0)
+    tracker = ProgressTracker([ ("chr1", 1000), ("chr2", 500) ], activity)
+    tracker.recordChunk(("chr1", 0, 500), replayed=True)
+    tracker.recordChunk(("chr1", 500, 1000))
+    tracker.recordChunk(("chr2", 0, 250))
+    status = tracker.status()
+    assert_equal("running", status["state"])
+    assert_equal((1250, 1500, 0.8333), (status["basesCompleted"], status["basesTotal"],
+                                        status["fractionCompleted"]))
+    assert_equal(2, status["chunksCompleted"])
+    assert_equal([ { "name" : "chr1", "basesCompleted" : 1000, "basesTotal" : 1000 },
+                   { "name" : "chr2", "basesCompleted" : 250,  "basesTotal" : 500 } ],
+                 status["contigs"])
+    assert_equal({ "work" : 2, "results" : None }, status["queues"])
+    assert_equal([0, 1], [ w["chunks"] for w in status["workers"] ])
+    assert status["etaSeconds"] >= 0
+
+    text = prometheusText(status)
+    assert 'genomicconsensus_bases_completed{contig="chr2"} 250.0\n' in text
+    assert 'genomicconsensus_queue_depth{queue="work"} 2.0\n' in text
+    assert 'queue="results"' not in text
+    assert "# TYPE genomicconsensus_eta_seconds gauge\n" in text
+
+def test_progressReporter():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        progressFilename = os.path.join(tmpDir, "progress.json")
+        prometheusFilename = os.path.join(tmpDir, "gc.prom")
+        tracker = ProgressTracker([ ('odd "name"', 100) ])
+        reporter = ProgressReporter(tracker, progressFilename, prometheusFilename,
+                                    interval=0.01)
+        reporter.start()
+        tracker.recordChunk(('odd "name"', 0, 100))
+        reporter.stop()
+        assert_equal([ "gc.prom", "progress.json" ], sorted(os.listdir(tmpDir)))
+        with open(progressFilename) as f:
+            status = json.load(f)
+        assert_equal(("finished", 100, 0.0), (status["state"], status["basesCompleted"],
+                                              status["etaSeconds"]))
+        with open(prometheusFilename) as f:
+            text = f.read()
+        assert 'genomicconsensus_bases_total{contig="odd \\"name\\""} 100.0\n' in text
+        assert "genomicconsensus_running 0.0\n" in text
+    finally:
+        shutil.rmtree(tmpDir)
@@ -0,0 +1,87 @@
+import numpy as np
+from collections import namedtuple
+from nose.tools import assert_equal, assert_is, assert_is_none
+
+from GenomicConsensus.readCache import (DecodedReadCache, CachingAlignmentFile,
+                                        RECORD_OVERHEAD_BYTES, RECORD_BYTES_PER_BASE)
+
+Index = namedtuple("Index", ("tStart", "tEnd"))
+
+class FakeAlignment(object):
+    def __init__(self, rowNumber, readStart, readEnd):
+        self.rowNumber = rowNumber
+        self.readStart = readStart
+        self.readEnd   = readEnd
+
+class FakeAlignmentFile(object):
+    def __init__(self, numRows, span=100):
+        self.index = Index(np.zeros(numRows, dtype=int), np.repeat(span, numRows))
+        self.fetched = []
+        self.closed = False
+
+    def __getitem__(self, rowNumber):
+        self.fetched.append(rowNumber)
+        return FakeAlignment(rowNumber, 1000, 1100)
+
+    def close(self):
+        self.closed = True
+
+ENTRY_BYTES = RECORD_OVERHEAD_BYTES + 100 * RECORD_BYTES_PER_BASE
+
+def test_hits_and_misses():
+    alnFile = FakeAlignmentFile(10)
+    cached = CachingAlignmentFile(alnFile, DecodedReadCache(10 * ENTRY_BYTES))
+    first = cached[[1, 2, 3]]
+    again = cached[np.array([3, 2])]
+    assert_is(first[2], again[0])
+    assert_is(first[0], cached[1])
+    assert_equal([1, 2, 3], alnFile.fetched)
+    stats = cached._cache.stats()
+    assert_equal((3, 3), (stats["hits"], stats["misses"]))
+    # Other attributes pass through
+    cached.close()
+    assert alnFile.closed
+
+def test_eviction_by_bytes():
+    alnFile = FakeAlignmentFile(10)
+    cache = DecodedReadCache(3 * ENTRY_BYTES)
+    for row in (0, 1, 2, 0, 3):
+        cache.alignment(alnFile, row)
+    # Row 1 was least recently used
+    assert_equal(1, cache.evictions)
+    assert_equal(3 * ENTRY_BYTES, cache.currentBytes)
+    cache.alignment(alnFile, 0)
+    cache.alignment(alnFile, 1)
+    assert_equal([0, 1, 2, 3, 1], alnFile.fetched)
+
+def test_nativeReadAndFeatures():
+    alnFile = FakeAlignmentFile(10)
+    cache = DecodedReadCache(10 * ENTRY_BYTES)
+    decoded = []
+    def decode(aln):
+        decoded.append(aln.rowNumber)
+        return "ACGT" * 25, (np.arange(100, dtype=np.uint8),)
+
+    # Not cached: the caller decodes
+    assert_is_none(cache.nativeReadAndFeatures(FakeAlignment(5, 1000, 1100), decode))
+
+    cache.alignment(alnFile, 5)
+    for readStart, readEnd in ((1000, 1100), (1010, 1020), (1098, 1100)):
+        read, (feature,) = cache.nativeReadAndFeatures(
+            FakeAlignment(5, readStart, readEnd), decode)
+        assert_equal(("ACGT" * 25)[readStart-1000:readEnd-1000], read)
+        assert_equal(range(readStart-1000, readEnd-1000), feature.tolist())
+    assert_equal([5], decoded)
+    assert_equal(ENTRY_BYTES + 200, cache.currentBytes)
+
+def test_nativeReadAndFeatures_vectors():
+    # Features may be any byte vector that slices, such as those of
+    # the consensus library (a list stands in for one here)
+    alnFile = FakeAlignmentFile(10)
+    cache = DecodedReadCache(10 * ENTRY_BYTES)
+    cache.alignment(alnFile, 5)
+    decode = lambda aln: ("ACGT" * 25, (range(100), range(100, 200)))
+    read, (ipd, pw) = cache.nativeReadAndFeatures(FakeAlignment(5, 1010, 1020), decode)
+    assert_equal(range(10, 20), ipd)
+    assert_equal(range(110, 120), pw)
+    assert_equal(ENTRY_BYTES + 300, cache.currentBytes)
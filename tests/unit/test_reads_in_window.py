@@ -0,0 +1,175 @@
+import numpy as np
+from collections import namedtuple
+from nose.tools import assert_equal
+
+from GenomicConsensus.utils import readRowsInWindow, selectReadRows, readsInWindow
+
+Index = namedtuple("Index", ("tStart", "tEnd"))
+ReferenceInfo = namedtuple("ReferenceInfo", ("ID",))
+
+class FakeAlignmentFile(object):
+    """
+    Just the index of an alignment file, for a single contig;
+    "records" are row numbers
+    """
+    def __init__(self, tStart, tEnd, mapQV):
+        self.index = Index(np.array(tStart, dtype=np.uint32),
+                           np.array(tEnd, dtype=np.uint32))
+        self.mapQV = np.array(mapQV)
+        self.tId = np.zeros(len(tStart), dtype=int)
+
+    def referenceInfo(self, refId):
+        return ReferenceInfo(0)
+
+    def readsInRange(self, refId, start, end, justIndices=False):
+        assert justIndices
+        return np.flatnonzero((self.index.tStart < end) & (self.index.tEnd > start))
+
+    def __getitem__(self, rowNumbers):
+        return list(rowNumbers)
+
+def randomAlignmentFile(rng, numReads=200, contigLength=2000):
+    tStart = rng.randint(0, contigLength - 1, size=numReads)
+    tEnd = np.minimum(tStart + rng.randint(1, 400, size=numReads), contigLength)
+    return FakeAlignmentFile(tStart, tEnd, rng.randint(0, 60, size=numReads))
+
+def originalReadsInWindow(alnFile, window, depthLimit, minMapQV, strategy):
+    # The selection as it was done before it moved to the index arrays
+    winId, winStart, winEnd = window
+    def lengthInWindow(hit):
+        return int(min(alnFile.index.tEnd[hit], winEnd) -
+                   max(alnFile.index.tStart[hit], winStart))
+    hits = [ hit for hit in alnFile.readsInRange(winId, winStart, winEnd, justIndices=True)
+             if alnFile.mapQV[hit] >= minMapQV ]
+    if strategy == "spanning":
+        hits = [ hit for hit in hits if lengthInWindow(hit) == winEnd - winStart ]
+    elif strategy == "longest":
+        hits = sorted(hits, key=lengthInWindow, reverse=True)
+    elif strategy == "long-and-strand-balanced":
+        hits = sorted(hits, key=lambda hit: (-lengthInWindow(hit),
+                                             alnFile.index.tStart[hit],
+                                             alnFile.index.tEnd[hit]))
+    return hits[:depthLimit]
+
+def test_selection_strategies():
+    rng = np.random.RandomState(42)
+    for trial in xrange(10):
+        alnFile = randomAlignmentFile(rng)
+        for strategy in ("fileorder", "spanning", "longest", "long-and-strand-balanced"):
+            for depthLimit in (None, 5):
+                start = rng.randint(0, 1900)
+                window = (0, start, start + rng.randint(1, 100))
+                assert_equal(originalReadsInWindow(alnFile, window, depthLimit, 20, strategy),
+                             readsInWindow(alnFile, window, depthLimit, 20, strategy))
+
+def test_candidateRows():
+    # Narrowing down the rows of an enclosing window gives the same
+    # rows as a fresh lookup
+    rng = np.random.RandomState(42)
+    alnFile = randomAlignmentFile(rng)
+    candidateRows = readRowsInWindow(alnFile, (0, 500, 1500), minMapQV=20)
+    for interval in ((500, 1500), (500, 501), (700, 900), (1499, 1500)):
+        window = (0,) + interval
+        assert_equal(readRowsInWindow(alnFile, window, minMapQV=20).tolist(),
+                     readRowsInWindow(alnFile, window, candidateRows=candidateRows).tolist())
+        assert_equal(readsInWindow(alnFile, window, 10, 20, "longest"),
+                     readsInWindow(alnFile, window, 10, 20, "longest",
+                                   candidateRows=candidateRows))
+
+class LoadingAlignmentFile(FakeAlignmentFile):
+    """
+    Records are named after their rows, which are logged as they are
+    read
+    """
+    def __init__(self, *args):
+        super(LoadingAlignmentFile, self).__init__(*args)
+        self.rowsRead = []
+
+    def __getitem__(self, rowNumbers):
+        self.rowsRead.extend(rowNumbers)
+        return [ "record%d" % row for row in rowNumbers ]
+
+def test_loadedReads():
+    # Records already loaded are used rather than read again
+    rng = np.random.RandomState(42)
+    reads = randomAlignmentFile(rng)
+    alnFile = LoadingAlignmentFile(reads.index.tStart, reads.index.tEnd, reads.mapQV)
+    enclosing = (0, 500, 1500)
+    candidateRows = readRowsInWindow(alnFile, enclosing, minMapQV=20)
+    windowRows = selectReadRows(alnFile, candidateRows, enclosing, 10,
+                                "long-and-strand-balanced").tolist()
+    loadedReads = dict(zip(windowRows, alnFile[windowRows]))
+    numReused = 0
+    for interval in ((500, 600), (700, 900), (1400, 1500)):
+        window = (0,) + interval
+        expected = readsInWindow(alnFile, window, 10, 20, "long-and-strand-balanced")
+        alnFile.rowsRead = []
+        assert_equal(expected,
+                     readsInWindow(alnFile, window, 10, 20, "long-and-strand-balanced",
+                                   candidateRows=candidateRows, loadedReads=loadedReads))
+        assert_equal([ record for record in expected
+                       if int(record[len("record"):]) not in loadedReads ],
+                     [ "record%d" % row for row in alnFile.rowsRead ])
+        numReused += len(expected) - len(alnFile.rowsRead)
+    assert numReused > 0
+
+def test_readIndex():
+    from GenomicConsensus.readIndex import ReadIndex
+    rng = np.random.RandomState(42)
+    alnFile = randomAlignmentFile(rng, numReads=500)
+    alnFile.tId = rng.randint(0, 3, size=500)
+    alnFile.referenceInfo = lambda refId: ReferenceInfo(refId)
+    readIndex = ReadIndex(alnFile, minMapQV=20)
+    tStart, tEnd = alnFile.index
+    for trial in xrange(200):
+        refId = rng.randint(0, 3)
+        start = rng.randint(0, 2000)
+        end = start + rng.randint(1, 300)
+        expected = np.flatnonzero((alnFile.tId == refId) & (alnFile.mapQV >= 20) &
+                                  (tStart < end) & (tEnd > start))
+        assert_equal(expected.tolist(),
+                     readIndex.rowsInWindow((refId, start, end)).tolist())
+
+def test_readIndex_emptyContig():
+    from GenomicConsensus.readIndex import ReadIndex
+    alnFile = randomAlignmentFile(np.random.RandomState(42))
+    alnFile.referenceInfo = lambda refId: ReferenceInfo(refId)
+    readIndex = ReadIndex(alnFile)
+    assert_equal(0, len(readIndex.contig(7)))
+    assert_equal([], readIndex.rowsInWindow((7, 0, 100)).tolist())
+
+def test_readIndex_sidecar():
+    import os, shutil, tempfile
+    from GenomicConsensus import readIndex
+    tmpDir = tempfile.mkdtemp()
+    try:
+        inputFilename = os.path.join(tmpDir, "aligned.bam")
+        with open(inputFilename, "w") as f:
+            f.write("BAM")
+        alnFile = randomAlignmentFile(np.random.RandomState(42))
+        readIndex.setSidecarInput(inputFilename)
+        built = readIndex.readIndexFor(alnFile, 20)
+        sidecar = readIndex.sidecarFilename(inputFilename, 20, None)
+        assert os.path.exists(sidecar)
+
+        # A fresh process (here, a fresh file object) loads the sidecar
+        # instead of partitioning the index
+        def noPartition(*args):
+            raise AssertionError("index was rebuilt")
+        originalPartition = readIndex.ReadIndex._partition
+        readIndex.ReadIndex._partition = staticmethod(noPartition)
+        try:
+            sameFile = FakeAlignmentFile(alnFile.index.tStart, alnFile.index.tEnd, alnFile.mapQV)
+            loaded = readIndex.readIndexFor(sameFile, 20)
+        finally:
+            readIndex.ReadIndex._partition = staticmethod(originalPartition)
+        for window in ((0, 0, 2000), (0, 500, 600)):
+            assert_equal(built.rowsInWindow(window).tolist(),
+                         loaded.rowsInWindow(window).tolist())
+
+        # Different filters get their own sidecar
+        readIndex.readIndexFor(sameFile, 30)
+        assert os.path.exists(readIndex.sidecarFilename(inputFilename, 30, None))
+    finally:
+        readIndex.setSidecarInput(None)
+        shutil.rmtree(tmpDir)
@@ -0,0 +1,173 @@
+import os, random, shutil, tempfile
+import numpy as np
+from collections import OrderedDict
+from Queue import Queue
+from nose.tools import assert_equal
+
+from GenomicConsensus import reference
+from GenomicConsensus.consensus import Consensus
+from GenomicConsensus.options import options
+from GenomicConsensus.ResultCollector import ResultCollector
+from GenomicConsensus.faults import ChunkFailure
+from GenomicConsensus.variants import Variant
+
+CHUNK_SIZE = 20
+CONTIGS    = [ ("ctg1", 95), ("ctg2", 40) ]
+
+def randomSequence(rng, length):
+    return "".join(rng.choice("ACGT") for _ in xrange(length))
+
+class ResultCollectorFixture(object):
+    """
+    Two small contigs, output files in a temporary directory, and one
+    result per chunk
+    """
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.savedOptions = dict(vars(options))
+        self.savedReference = (OrderedDict(reference.byName), reference.filename)
+        rng = random.Random(42)
+        reference.byName.clear()
+        for i, (name, length) in enumerate(CONTIGS):
+            reference.byName[name] = reference.ReferenceContig(
+                i, name, name, randomSequence(rng, length), length)
+        reference.filename = "contigs.fasta"
+        options.__dict__.update(
+            referenceWindows=(), numWorkers=1,
+            fastaOutputFilename=self.path("out.fasta"),
+            fastqOutputFilename=self.path("out.fastq"),
+            gffOutputFilename=self.path("out.gff"),
+            shellCommand="variantCaller", inputFilename="in.bam",
+            referenceFilename=reference.filename,
+            checkpointDir=None, progressFile=None, prometheusFile=None,
+            failureSummary=None, runReport=None, traceFile=None)
+
+    def teardown(self):
+        reference.byName.clear()
+        reference.byName.update(self.savedReference[0])
+        reference.filename = self.savedReference[1]
+        options.__dict__.clear()
+        options.__dict__.update(self.savedOptions)
+        shutil.rmtree(self.directory)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def results(self):
+        """
+        One result per chunk, in genome order: the reference as the
+        consensus, and a SNP at the chunk start
+        """
+        results = []
+        for name, length in CONTIGS:
+            sequence = reference.byName[name].sequence
+            for start in xrange(0, length, CHUNK_SIZE):
+                window = (name, start, min(start + CHUNK_SIZE, length))
+                css = Consensus(window, sequence[window[1]:window[2]],
+                                np.arange(window[1], window[2], dtype=np.uint8) % 50)
+                variant = Variant(name, start, start + 1, sequence[start], "N",
+                                  confidence=40, coverage=10)
+                results.append((window, (css, [variant])))
+        return results
+
+    def collector(self):
+        return ResultCollector(None, "arrow", None)
+
+    def outputs(self):
+        return [ open(self.path(filename)).read()
+                 for filename in ("out.fasta", "out.fastq") ]
+
+    def expectedOutputs(self):
+        """
+        What a collector writes for results that arrive in genome order
+        """
+        collector = self.collector()
+        collector.onStart()
+        for result in self.results():
+            collector.onResult(result)
+            assert_equal(0, collector.numPendingChunks)
+        collector.onFinish()
+        return self.outputs(), self.variantsWritten()
+
+    def variantsWritten(self):
+        return [ (line.split("\t")[0], int(line.split("\t")[3]))
+                 for line in open(self.path("out.gff"))
+                 if not line.startswith("#") ]
+
+    def assertDrained(self, collector):
+        assert_equal(0, collector.numPendingChunks)
+        assert_equal({}, dict(collector.pendingChunksByRefId))
+        assert_equal(0, len(collector.contigsToWrite))
+
+class TestResultCollector(ResultCollectorFixture):
+    """
+    Results arrive in any order, singly or batched; the collector
+    must write them out in genome order and hold no chunk longer than
+    it has to.
+    """
+    def test_genomeOrder(self):
+        expected = self.expectedOutputs()
+        assert_equal([ ("ctg1", 1), ("ctg1", 21), ("ctg1", 41), ("ctg1", 61),
+                       ("ctg1", 81), ("ctg2", 1), ("ctg2", 21) ], expected[1])
+
+        results = self.results()
+        collector = self.collector()
+        collector.onStart()
+        # Chunks past the prefix are held until it catches up to them
+        pendingAfter = []
+        for i in (2, 0, 6, 5, 3, 1, 4):
+            collector.onResult(results[i])
+            pendingAfter.append(collector.numPendingChunks)
+        assert_equal([1, 1, 2, 3, 4, 2, 0], pendingAfter)
+        assert_equal(5, collector.maxPendingChunks)
+        self.assertDrained(collector)
+        collector.onFinish()
+        assert_equal(expected, (self.outputs(), self.variantsWritten()))
+
+    def test_batchedResults(self):
+        expected = self.expectedOutputs()
+        results = self.results()
+        queue = Queue()
+        options.numWorkers = 2
+        for item in ([results[6], results[3], results[4]], results[5],
+                     None, [results[1], results[0]], results[2], None):
+            queue.put(item)
+        collector = ResultCollector(queue, "arrow", None)
+        collector._run()
+        self.assertDrained(collector)
+        assert_equal(expected, (self.outputs(), self.variantsWritten()))
+
+    def test_repeatedFailures(self):
+        # A worker redoing a hung worker's unit fails the first chunk
+        # again; the failure is only counted once
+        results = self.results()
+        queue = Queue()
+        window = results[0][0]
+        for item in (ChunkFailure(window, 1, "corrupt read", "Worker-1"),
+                     ChunkFailure(window, 2, "Timed out", "Worker-1"),
+                     ChunkFailure(window, 1, "corrupt read", "Worker-2"),
+                     ChunkFailure(window, 2, "corrupt read", "Worker-2")) + \
+                    tuple(results) + (None,):
+            queue.put(item)
+        collector = ResultCollector(queue, "arrow", None)
+        collector._run()
+        assert_equal([ (1, "Worker-1"), (2, "Worker-1") ],
+                     [ (failure.attempt, failure.workerName)
+                       for failure in collector.failures ])
+
+    def test_costOrderingLookahead(self):
+        # Chunks dispatched most expensive first and finished in
+        # dispatch order: a global sort makes the collector hold all
+        # of them, the lookahead at most a block's worth
+        results = self.results()
+        chunks = [ reference.WorkChunk(window, True, cost=i)
+                   for i, (window, _) in enumerate(results) ]
+        resultsByWindow = dict(results)
+        for lookahead, maxPending in ((0, 7), (3, 3), (1, 1)):
+            collector = self.collector()
+            collector.onStart()
+            for chunk in reference.costOrderedChunks(chunks, lookahead):
+                collector.onResult((chunk.window, resultsByWindow[chunk.window]))
+            assert_equal(maxPending, collector.maxPendingChunks)
+            self.assertDrained(collector)
+            collector.onFinish()
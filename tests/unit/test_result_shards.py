@@ -0,0 +1,75 @@
+import numpy as np, os, shutil, tempfile
+from nose.tools import assert_equal
+
+from GenomicConsensus.consensus import Consensus
+from GenomicConsensus.variants import Variant
+from GenomicConsensus.resultShards import ResultShardWriter, closeShards, _mappedShards
+from GenomicConsensus.io.StreamingFastxWriters import (StreamingFastaWriter,
+                                                       StreamingFastqWriter)
+
+class TestResultShards(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown(self):
+        closeShards()
+        shutil.rmtree(self.directory)
+
+    def test_roundtrip(self):
+        writer = ResultShardWriter(self.directory, "worker1")
+        variants = [ Variant("ref1", 10, 11, "A", "T", confidence=40, coverage=20),
+                     Variant("ref1", 15, 15, "", "GG", "", confidence=30, coverage=12,
+                             frequency1=6, frequency2=6, annotations=[("rows", "1,2")]) ]
+        css0 = Consensus(("ref1", 0, 20), "ACGTACGTACGTACGTACGT", np.arange(20, dtype=np.uint8))
+        css1 = Consensus(("ref1", 20, 25), "NNNNN", np.zeros(5, dtype=np.uint8))
+        d0 = writer.write((css0.refWindow, (css0, variants)))
+        d1 = writer.write((css1.refWindow, (css1, [])))
+        writer.close()
+
+        assert_equal(("ref1", 0, 20), d0.window)
+        assert_equal(css0.sequence, d0.sequence)
+        assert_equal(css0.confidence.tolist(), d0.confidence.tolist())
+        assert_equal(variants, list(d0.variants))
+        assert_equal("NNNNN", d1.sequence)
+        assert_equal([], list(d1.variants))
+
+    def test_growingShard(self):
+        # Each record is read back as soon as it is written; the shard
+        # is remapped only as it doubles
+        writer = ResultShardWriter(self.directory, "worker1")
+        for i in xrange(1000):
+            window = ("ref1", 100 * i, 100 * (i + 1))
+            sequence = "ACGT"[i % 4] * 100
+            css = Consensus(window, sequence, np.repeat(np.uint8(i % 50), 100))
+            d = writer.write((window, (css, [])))
+            assert_equal(sequence, d.sequence)
+            assert_equal([i % 50] * 100, d.confidence.tolist())
+        writer.close()
+        # Records are 200 bytes; maps of 200, 400, ..., 102400 bytes
+        shard = _mappedShards[writer.filename]
+        assert_equal(10, shard.numMaps)
+        assert_equal(102400, shard.mappedLength)
+
+    def test_streaming_writers(self):
+        fasta = os.path.join(self.directory, "out.fasta")
+        writer = StreamingFastaWriter(fasta)
+        writer.beginRecord("ref1|arrow")
+        for piece in ("A" * 50, "C" * 20, "G" * 50):
+            writer.extend(piece)
+        writer.endRecord()
+        writer.writeRecord("ref2|arrow", "T" * 60)
+        writer.close()
+        assert_equal(">ref1|arrow\n" + "A" * 50 + "C" * 10 + "\n" +
+                     "C" * 10 + "G" * 50 + "\n" +
+                     ">ref2|arrow\n" + "T" * 60 + "\n",
+                     open(fasta).read())
+
+        fastq = os.path.join(self.directory, "out.fastq")
+        writer = StreamingFastqWriter(fastq)
+        writer.beginRecord("ref1|arrow")
+        writer.extend("AC", np.array([40, 0], dtype=np.uint8))
+        writer.extend("G", np.array([10], dtype=np.uint8))
+        writer.endRecord()
+        writer.close()
+        assert_equal("@ref1|arrow\nACG\n+\nI!+\n", open(fastq).read())
@@ -0,0 +1,73 @@
+import os, shutil, tempfile
+from nose.tools import assert_equal, assert_raises
+
+from GenomicConsensus.scatter import (PlannedContig, planShards,
+                                      writePlan, readPlan, gather)
+
+def contig(name, alignedBases):
+    return PlannedContig(name, name + " description", 1000, alignedBases)
+
+def test_planShards_balances_aligned_bases():
+    contigs = [ contig("c1", 10), contig("c2", 70), contig("c3", 40),
+                contig("c4", 30), contig("c5", 50) ]
+    shards = planShards(contigs, 2)
+    loads = sorted(sum(c.alignedBases for c in shard) for shard in shards)
+    assert_equal([100, 100], loads)
+    # Contigs within a shard stay in reference order
+    for shard in shards:
+        names = [ c.name for c in shard ]
+        assert_equal(sorted(names), names)
+
+def test_planShards_more_shards_than_contigs():
+    shards = planShards([ contig("c1", 10), contig("c2", 20) ], 4)
+    assert_equal(2, len(shards))
+
+class TestGather(object):
+
+    def setup(self):
+        self.directory = tempfile.mkdtemp()
+        self.contigs = [ contig("c1", 10), contig("c2", 70), contig("c3", 40) ]
+
+    def teardown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        fn = os.path.join(self.directory, name)
+        with open(fn, "w") as f:
+            f.write(content)
+        return fn
+
+    def test_plan_roundtrip(self):
+        fn = os.path.join(self.directory, "plan.json")
+        writePlan(fn, planShards(self.contigs, 2), self.contigs, "in.bam", "ref.fa")
+        plan = readPlan(fn)
+        assert_equal(self.contigs, plan["contigs"])
+        assert_equal(["c1:0-1000,c3:0-1000", "c2:0-1000"],
+                     sorted(shard["referenceWindows"] for shard in plan["shards"]))
+
+    def test_gather_fastx_in_reference_order(self):
+        shard1 = self.write("shard1.fasta",
+                            ">c3 description|arrow\nGGGG\nGG\n"
+                            ">c1 description|arrow\nAAAA\n")
+        shard2 = self.write("shard2.fasta", ">c2 description|arrow\nCCCC\n")
+        shard1q = self.write("shard1.fastq",
+                             "@c3 description|arrow\nGG\n+\n@@\n"
+                             "@c1 description|arrow\nAA\n+\n!!\n")
+        shard2q = self.write("shard2.fastq", "@c2 description|arrow\nCC\n+\n##\n")
+        fasta = os.path.join(self.directory, "out.fasta")
+        fastq = os.path.join(self.directory, "out.fastq")
+        gather({ "contigs" : self.contigs }, [fasta, fastq],
+               [shard1, shard2, shard1q, shard2q], {})
+        assert_equal(">c1 description|arrow\nAAAA\n"
+                     ">c2 description|arrow\nCCCC\n"
+                     ">c3 description|arrow\nGGGG\nGG\n",
+                     open(fasta).read())
+        assert_equal("@c1 description|arrow\nAA\n+\n!!\n"
+                     "@c2 description|arrow\nCC\n+\n##\n"
+                     "@c3 description|arrow\nGG\n+\n@@\n",
+                     open(fastq).read())
+
+    def test_gather_unrecognized_format(self):
+        shard = self.write("shard1.fasta", ">c1 description|arrow\nAAAA\n")
+        assert_raises(ValueError, gather, { "contigs" : self.contigs },
+                      [os.path.join(self.directory, "out.txt")], [shard], {})
@@ -0,0 +1,39 @@
+import numpy as np
+from nose.tools import assert_equal
+
+from GenomicConsensus.consensus import Consensus
+from GenomicConsensus.targeted import candidateIntervals, targetedConsensusAndVariants
+from AlignmentHitStubs import AlignmentHitStub, FORWARD
+
+def test_candidateIntervals():
+    window = (0, 100, 400)
+    assert_equal([], candidateIntervals(window, []))
+    assert_equal([(100, 151), (170, 301)],
+                 candidateIntervals(window, [100, 250, 220], flank=50))
+    # Neighborhoods that abut are merged; clipped at the window end
+    assert_equal([(100, 400)],
+                 candidateIntervals(window, [150, 251, 350], flank=50))
+
+def test_targetedConsensusAndVariants():
+    # Three reads over 0-300, the last 100 bases covered by just one;
+    # all three have a mismatch at 150
+    refSequence = "ACGT" * 75
+    read = refSequence[:150] + "T" + refSequence[151:200]
+    alns = [ AlignmentHitStub(0, FORWARD, refSequence[:200], read),
+             AlignmentHitStub(0, FORWARD, refSequence[:200], read),
+             AlignmentHitStub(0, FORWARD, refSequence, read + refSequence[200:]) ]
+    calledWindows = []
+    def callWindow(subWin):
+        calledWindows.append(subWin)
+        _, s, e = subWin
+        return (Consensus(subWin, "x" * (e - s), np.ones(e - s, dtype=int)),
+                ["variant"])
+
+    css, variants = targetedConsensusAndVariants((0, 0, 300), refSequence, alns, callWindow,
+                                                 minCoverage=3, maxAlleleFraction=0.3,
+                                                 noEvidenceConsensus="nocall")
+    assert_equal([(0, 100, 201)], calledWindows)
+    assert_equal(["variant"], variants)
+    assert_equal((0, 0, 300), css.refWindow)
+    assert_equal(refSequence[:100] + "x" * 101 + "N" * 99, css.sequence)
+    assert_equal([0] * 100 + [1] * 101 + [0] * 99, css.confidence.tolist())
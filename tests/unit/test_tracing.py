@@ -0,0 +1,40 @@
+import json, os, shutil, tempfile, time
+from nose.tools import assert_equal
+
+from GenomicConsensus.instrumentation import timed
+from GenomicConsensus.tracing import (startTracing, stopTracing, tracing, traceSpan,
+                                      traceCounter, mergeTraces)
+
+def test_mergeTraces():
+    tmpDir = tempfile.mkdtemp()
+    try:
+        traceSpan("notTracing", "test", 0, 1)
+        startTracing(tmpDir, "worker-1")
+        assert tracing()
+        traceSpan("chunk", "worker", 10.0, 10.5, window="ctg:0-100", reads=7)
+        with timed("test.quick"):
+            pass
+        with timed("test.slow"):
+            time.sleep(0.002)
+        traceCounter("reorderBuffer", pendingChunks=3)
+        stopTracing()
+        assert not tracing()
+
+        # A process killed mid-write leaves a partial last line
+        with open(os.path.join(tmpDir, "trace-worker-2.json"), "w") as f:
+            f.write('{"ph":"X","name":"chunk","ts":1,"dur":2,"pid":2,"tid":2}\n{"ph":"X",')
+
+        filename = os.path.join(tmpDir, "run.json")
+        mergeTraces(tmpDir, filename)
+        with open(filename) as f:
+            events = json.load(f)["traceEvents"]
+        assert_equal(["thread_name", "chunk", "test.slow", "reorderBuffer", "chunk"],
+                     [ e["name"] for e in events ])
+        chunk = events[1]
+        assert_equal(("X", 10000000, 500000), (chunk["ph"], chunk["ts"], chunk["dur"]))
+        assert_equal({ "window" : "ctg:0-100", "reads" : 7 }, chunk["args"])
+        assert_equal(os.getpid(), chunk["pid"])
+        assert_equal({ "pendingChunks" : 3 }, events[3]["args"])
+    finally:
+        stopTracing()
+        shutil.rmtree(tmpDir)
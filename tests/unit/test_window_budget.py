@@ -0,0 +1,266 @@
+import numpy as np
+from contextlib import contextmanager
+from nose.tools import assert_equal
+
+from GenomicConsensus.instrumentation import workerStats
+from GenomicConsensus.polishing import WindowBudget, noConfidence
+import GenomicConsensus.arrow.utils as AU
+import GenomicConsensus.quiver.utils as QU
+
+WINDOW = ("ctg1", 0, 12)
+DRAFT  = "ACGTACGTACGT"
+BUDGET = 10.0
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+_missing = object()
+
+@contextmanager
+def patched(module, **attributes):
+    saved = dict((name, getattr(module, name, _missing)) for name in attributes)
+    for name, value in attributes.iteritems():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.iteritems():
+            if value is _missing:
+                delattr(module, name)
+            else:
+                setattr(module, name, value)
+
+def exceededCounts():
+    counters = workerStats().counters
+    return dict((name, counters[name]) for name in
+                ("windowBudget.exceeded",
+                 "windowBudget.exceeded.draft",
+                 "windowBudget.exceeded.polish",
+                 "windowBudget.exceeded.confidence"))
+
+def countsSince(before):
+    after = exceededCounts()
+    return dict((name, after[name] - before[name]) for name in after
+                if after[name] != before[name])
+
+def fullConfidence(scorer):
+    return np.repeat(np.uint8(40), len(str(scorer)))
+
+class FakeConfig(object):
+    maxIterations             = 40
+    mutationSeparation        = 10
+    mutationNeighborhood      = 20
+    computeConfidence         = True
+    noEvidenceConsensus       = "nocall"
+    refineDinucleotideRepeats = False
+
+
+#
+# WindowBudget
+#
+
+def test_unlimitedBudget():
+    clock = FakeClock()
+    budget = WindowBudget(0, WINDOW, clock)
+    clock.now = 10**6
+    assert not budget.limited
+    assert not budget.exceeded
+    assert not budget.exceededAt("polish")
+
+def test_limitedBudget():
+    clock = FakeClock()
+    budget = WindowBudget(BUDGET, WINDOW, clock)
+    assert budget.limited
+    clock.now = BUDGET
+    assert not budget.exceeded
+    before = exceededCounts()
+    clock.now = BUDGET + 0.5
+    assert budget.exceeded
+    assert budget.exceededAt("polish")
+    assert_equal({ "windowBudget.exceeded"        : 1,
+                   "windowBudget.exceeded.polish" : 1 }, countsSince(before))
+
+def test_budgetConfidence():
+    clock = FakeClock()
+    budget = WindowBudget(BUDGET, WINDOW, clock)
+    qvs = budget.confidence(fullConfidence, DRAFT, len(DRAFT), True)
+    assert_equal([40] * len(DRAFT), qvs.tolist())
+    qvs = budget.confidence(fullConfidence, DRAFT, len(DRAFT), False)
+    assert_equal([0] * len(DRAFT), qvs.tolist())
+    assert_equal(np.uint8, qvs.dtype)
+
+    before = exceededCounts()
+    clock.now = BUDGET + 1
+    qvs = budget.confidence(fullConfidence, DRAFT, len(DRAFT), True)
+    assert_equal([0] * len(DRAFT), qvs.tolist())
+    assert_equal(np.uint8, qvs.dtype)
+    assert_equal({ "windowBudget.exceeded"            : 1,
+                   "windowBudget.exceeded.confidence" : 1 }, countsSince(before))
+
+
+#
+# Arrow: cc.Polish is stubbed by FakeIntegrator.polish, which adds a
+# base to the template at each iteration, taking `secondsPerIteration`
+#
+
+class FakePolishResult(object):
+    def __init__(self, hasConverged):
+        self.hasConverged     = hasConverged
+        self.mutationsTested  = 0
+        self.mutationsApplied = 0
+
+class FakeIntegrator(object):
+    def __init__(self, clock, convergeAfter, secondsPerIteration):
+        self.clock = clock
+        self.convergeAfter = convergeAfter
+        self.secondsPerIteration = secondsPerIteration
+        self.iterations = 0
+        self.calls = []
+
+    def __str__(self):
+        return DRAFT + "A" * self.iterations
+
+    def polish(self, ai, maxIterations):
+        assert ai is self
+        self.calls.append(maxIterations)
+        n = min(maxIterations, self.convergeAfter - self.iterations)
+        self.iterations += n
+        self.clock.now += n * self.secondsPerIteration
+        return FakePolishResult(self.iterations == self.convergeAfter)
+
+@contextmanager
+def fakePolish(ai):
+    with patched(AU.cc,
+                 Polish=ai.polish,
+                 PolishConfig=lambda maxIterations, separation, neighborhood: maxIterations):
+        with patched(AU, consensusConfidence=fullConfidence):
+            yield
+
+def arrowConsensus(convergeAfter, secondsPerIteration, startAt=0):
+    clock = FakeClock()
+    budget = WindowBudget(BUDGET, WINDOW, clock)
+    clock.now = startAt
+    ai = FakeIntegrator(clock, convergeAfter, secondsPerIteration)
+    with fakePolish(ai):
+        css = AU.consensusFromIntegrator(WINDOW, DRAFT, ai, DRAFT, FakeConfig(), budget)
+    return css, ai.calls
+
+def test_arrow_refineConsensus():
+    clock = FakeClock()
+    # Without a budget, a single call does all the iterations
+    ai = FakeIntegrator(clock, 30, 0.0)
+    with fakePolish(ai):
+        assert_equal((DRAFT + "A" * 30, True), AU.refineConsensus(ai, FakeConfig()))
+    assert_equal([40], ai.calls)
+
+    # With one, the calls grow geometrically; most windows converge
+    # within the first
+    ai = FakeIntegrator(clock, 5, 0.0)
+    with fakePolish(ai):
+        AU.refineConsensus(ai, FakeConfig(), WindowBudget(BUDGET, WINDOW, clock))
+    assert_equal([8], ai.calls)
+    ai = FakeIntegrator(clock, 30, 0.0)
+    with fakePolish(ai):
+        assert_equal((DRAFT + "A" * 30, True),
+                     AU.refineConsensus(ai, FakeConfig(), WindowBudget(BUDGET, WINDOW, clock)))
+    assert_equal([8, 16, 16], ai.calls)
+
+    # Polishing stops, unconverged, at the first check past the budget
+    clock = FakeClock()
+    ai = FakeIntegrator(clock, 40, 1.0)
+    with fakePolish(ai):
+        assert_equal((DRAFT + "A" * 24, False),
+                     AU.refineConsensus(ai, FakeConfig(), WindowBudget(BUDGET, WINDOW, clock)))
+    assert_equal([8, 16], ai.calls)
+
+def test_arrow_withinBudget():
+    before = exceededCounts()
+    css, calls = arrowConsensus(5, 1.0)
+    assert_equal(DRAFT + "A" * 5, css.sequence)
+    assert_equal([40] * len(css.sequence), css.confidence.tolist())
+    assert_equal({}, countsSince(before))
+
+def test_arrow_draftFallback():
+    before = exceededCounts()
+    css, calls = arrowConsensus(5, 1.0, startAt=BUDGET + 1)
+    assert_equal([], calls)
+    assert_equal(DRAFT, css.sequence)
+    assert_equal(noConfidence(len(DRAFT)).tolist(), css.confidence.tolist())
+    assert_equal({ "windowBudget.exceeded"       : 1,
+                   "windowBudget.exceeded.draft" : 1 }, countsSince(before))
+
+def test_arrow_polishFallback():
+    before = exceededCounts()
+    css, calls = arrowConsensus(40, 1.0)
+    # The template polished so far, rather than a no-call
+    assert_equal(DRAFT + "A" * 24, css.sequence)
+    assert_equal([0] * len(css.sequence), css.confidence.tolist())
+    assert css.ai is not None
+    assert_equal({ "windowBudget.exceeded"        : 1,
+                   "windowBudget.exceeded.polish" : 1 }, countsSince(before))
+
+def test_arrow_confidenceFallback():
+    before = exceededCounts()
+    css, calls = arrowConsensus(5, 3.0)
+    assert_equal(DRAFT + "A" * 5, css.sequence)
+    assert_equal([0] * len(css.sequence), css.confidence.tolist())
+    assert_equal({ "windowBudget.exceeded"            : 1,
+                   "windowBudget.exceeded.confidence" : 1 }, countsSince(before))
+
+
+#
+# Quiver: cc.RefineConsensus cannot be split, so the budget is only
+# checked between stages
+#
+
+class FakeScorer(object):
+    def __init__(self, clock, refineSeconds):
+        self.clock = clock
+        self.refineSeconds = refineSeconds
+        self.template = DRAFT
+
+    def Template(self):
+        return self.template
+
+    def __str__(self):
+        return self.template
+
+    def refine(self, mms):
+        self.template = DRAFT + "A"
+        self.clock.now += self.refineSeconds
+        return True
+
+def quiverConsensus(refineSeconds, dinucleotideSeconds=0.0, startAt=0):
+    clock = FakeClock()
+    budget = WindowBudget(BUDGET, WINDOW, clock)
+    clock.now = startAt
+    mms = FakeScorer(clock, refineSeconds)
+    config = FakeConfig()
+    config.refineDinucleotideRepeats = True
+    def refineDinucleotideRepeats(mms):
+        clock.now += dinucleotideSeconds
+    with patched(QU.cc, RefineConsensus=mms.refine):
+        with patched(QU, consensusConfidence=fullConfidence,
+                     refineDinucleotideRepeats=refineDinucleotideRepeats):
+            return QU.consensusFromScorer(WINDOW, DRAFT, mms, DRAFT, config, budget)
+
+def test_quiver_fallbacks():
+    before = exceededCounts()
+    css = quiverConsensus(1.0)
+    assert_equal(DRAFT + "A", css.sequence)
+    assert_equal([40] * len(css.sequence), css.confidence.tolist())
+    assert_equal({}, countsSince(before))
+
+    css = quiverConsensus(1.0, startAt=BUDGET + 1)
+    assert_equal((DRAFT, [0] * len(DRAFT)), (css.sequence, css.confidence.tolist()))
+    css = quiverConsensus(BUDGET + 1)
+    assert_equal((DRAFT + "A", [0] * (len(DRAFT) + 1)), (css.sequence, css.confidence.tolist()))
+    css = quiverConsensus(1.0, dinucleotideSeconds=BUDGET)
+    assert_equal((DRAFT + "A", [0] * (len(DRAFT) + 1)), (css.sequence, css.confidence.tolist()))
+    assert_equal({ "windowBudget.exceeded"            : 3,
+                   "windowBudget.exceeded.draft"      : 1,
+                   "windowBudget.exceeded.polish"     : 1,
+                   "windowBudget.exceeded.confidence" : 1 }, countsSince(before))
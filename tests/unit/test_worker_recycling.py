@@ -0,0 +1,61 @@
+import Queue
+from nose.tools import assert_equal, assert_true, assert_false
+
+from GenomicConsensus.options import options
+from GenomicConsensus.instrumentation import RunStats
+from GenomicConsensus.Worker import Worker, WorkerHandoff, residentMegabytes
+
+class FakeWorker(Worker):
+    name = "FakeWorker-1"
+
+def withOptions(**kwargs):
+    def decorator(f):
+        def wrapper():
+            saved = dict((k, getattr(options, k, None)) for k in kwargs)
+            options.__dict__.update(kwargs)
+            try:
+                f()
+            finally:
+                options.__dict__.update(saved)
+        wrapper.__name__ = f.__name__
+        return wrapper
+    return decorator
+
+@withOptions(maxChunksPerWorker=3, maxWorkerRss=0, chunkTimeout=0)
+def test_retire_after_chunks():
+    worker = FakeWorker(None, None, None)
+    worker._chunksProcessed = 2
+    assert_false(worker._shouldRetire())
+    worker._chunksProcessed = 3
+    assert_true(worker._shouldRetire())
+
+@withOptions(maxChunksPerWorker=0, maxWorkerRss=0, chunkTimeout=0)
+def test_no_limits():
+    worker = FakeWorker(None, None, None)
+    worker._chunksProcessed = 10**6
+    assert_false(worker._shouldRetire())
+
+@withOptions(maxChunksPerWorker=0, maxWorkerRss=0, chunkTimeout=0)
+def test_retire_on_rss():
+    rss = residentMegabytes()
+    assert rss > 0
+    worker = FakeWorker(None, None, None)
+    options.maxWorkerRss = int(rss) + 1000
+    assert_false(worker._shouldRetire())
+    options.maxWorkerRss = max(1, int(rss) - 1)
+    assert_true(worker._shouldRetire())
+
+@withOptions(chunkTimeout=0)
+def test_handoff():
+    resultsQueue = Queue.Queue()
+    worker = FakeWorker(None, resultsQueue, None)
+    worker._chunksProcessed = 7
+    assert_false(worker.retired)
+    worker._retire()
+    assert_true(worker.retired)
+    assert isinstance(resultsQueue.get_nowait(), RunStats)
+    handoff = resultsQueue.get_nowait()
+    assert isinstance(handoff, WorkerHandoff)
+    assert_equal(("FakeWorker-1", 7), (handoff.workerName, handoff.chunksProcessed))
+    # The handoff replaces the end-of-work sentinel
+    assert resultsQueue.empty()